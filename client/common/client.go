@@ -1,9 +1,12 @@
 package common
 
 import (
+	"bytes"
+	"compress/zlib"
+	"encoding/binary"
 	"io"
 
-	// "fmt"
+	"fmt"
 	"net"
 	"time"
 	"os"
@@ -30,6 +33,24 @@ type ClientConfig struct {
 	LoopAmount             int
 	LoopPeriod             time.Duration
 	MaxBetAmountInBatch    int
+	// Batches in flight, 1 or less does not negotiate pipelining
+	BatchWindow            int
+	// Send batches compressed, if the server agrees
+	Compression            bool
+	// Bets encoding to ask for, ProtocolV1 does not negotiate it
+	Protocol               int
+	// Skip the batches the server already stored, only when pipelining
+	Resume                 bool
+}
+
+// What the server agreed on at the handshake. A window of 0 means waiting
+// for every ack before sending the next batch
+type connectionOptions struct {
+	window        int
+	compression   bool
+	version       int
+	// Sequence number of the first batch the server does not have
+	resumeFrom    uint64
 }
 
 type Bet struct {
@@ -47,6 +68,28 @@ const (
 	ClientBet ClientValues = 0
 	ClientBetBatch ClientValues = 1
 	ClientBetEnd ClientValues = 2
+	// Handshake of a client that pipelines its batches
+	ClientHandshakePipelined ClientValues = 3
+	// Handshake of a client that negotiates options
+	ClientHandshakeOptions ClientValues = 4
+	// Batch compressed with zlib, its bets without the agency field
+	ClientBetBatchCompressed ClientValues = 4
+)
+
+// Options of a ClientHandshakeOptions
+const (
+	OptionWindow uint8 = 0
+	OptionCompression uint8 = 1
+	OptionVersion uint8 = 2
+	OptionResume uint8 = 3
+	CompressionZlib uint8 = 1
+)
+
+// Bets encodings
+const (
+	ProtocolV1 int = 1
+	// Varints, packed birthday, no type tags, 2 bytes length
+	ProtocolV2 int = 2
 )
 
 // A Bet is serialized as the following:
@@ -82,6 +125,64 @@ func (b *Bet) serialize(ID string) []byte {
 	return buffer
 }
 
+// A Bet is serialized in protocol v2 as the following:
+// 2 bytes with the length of the rest, big-endian
+// The agency as a varint
+// Name, surname and document as varint length + UTF-8 bytes
+// The birthday in 4 bytes: year (2), month and day
+// The amount as a varint
+func (b *Bet) serializeV2(ID string) []byte {
+	agency, _ := strconv.ParseUint(ID, 10, 64)
+	fields := SerializeVarint(agency)
+	fields = append(fields, SerializeVarintString(b.name)...)
+	fields = append(fields, SerializeVarintString(b.surname)...)
+	fields = append(fields, SerializeVarintString(b.document)...)
+
+	// An unparseable birthday goes as 0000-00-00, which the server rejects
+	var birthday [4]byte
+	if date, err := time.Parse("2006-01-02", b.birthday); err == nil {
+		binary.BigEndian.PutUint16(birthday[0:2], uint16(date.Year()))
+		birthday[2] = byte(date.Month())
+		birthday[3] = byte(date.Day())
+	}
+	fields = append(fields, birthday[:]...)
+	fields = append(fields, SerializeVarint(b.amount)...)
+
+	buffer := make([]byte, 2, 2 + len(fields))
+	binary.BigEndian.PutUint16(buffer, uint16(len(fields)))
+	return append(buffer, fields...)
+}
+
+func deserializeBetsV2(bets_b []byte) []*Bet {
+	var bets []*Bet
+	for offset := 0; offset + 2 <= len(bets_b); {
+		bet_end := offset + 2 + int(binary.BigEndian.Uint16(bets_b[offset:offset + 2]))
+		_, read := binary.Uvarint(bets_b[offset + 2:])
+		position := offset + 2 + read
+
+		var strings [3]string
+		for i := range strings {
+			length, read := binary.Uvarint(bets_b[position:])
+			position += read
+			strings[i] = DeserializeString(bets_b[position:position + int(length)])
+			position += int(length)
+		}
+		year := binary.BigEndian.Uint16(bets_b[position:position + 2])
+		birthday := fmt.Sprintf("%04d-%02d-%02d", year, bets_b[position + 2], bets_b[position + 3])
+		amount, _ := binary.Uvarint(bets_b[position + 4:bet_end])
+
+		bets = append(bets, &Bet {
+			name: strings[0],
+			surname: strings[1],
+			document: strings[2],
+			birthday: birthday,
+			amount: amount,
+		})
+		offset = bet_end
+	}
+	return bets
+}
+
 func deserialize_bets(bets_b []byte, length int) []*Bet {
 	var bets []*Bet;
 	offset := 0
@@ -214,6 +315,8 @@ type Client struct {
 
 	conn        net.Conn
 	killed      bool
+	// Bets encoding agreed at the handshake
+	version     int
 
 	bet         Bet
 }
@@ -245,6 +348,7 @@ func NewClient(config ClientConfig) (*Client, error) {
 	client := &Client{
 		config: config,
 		killed: false,
+		version: ProtocolV1,
 		agencyFile: *agency_file,
 		agencyReader: *agency_reader,
 	}
@@ -297,7 +401,12 @@ func (c *Client) receiveWinners() ([]*Bet, error) {
 
 	bets_b, err := c.receiveMessage(int(length))
 
-	bets := deserialize_bets(bets_b, int(length))
+	var bets []*Bet
+	if c.version == ProtocolV2 {
+		bets = deserializeBetsV2(bets_b)
+	} else {
+		bets = deserialize_bets(bets_b, int(length))
+	}
 
 	log.Infof("action: consulta_ganadores | result: success | cant_ganadores: %v",
 		len(bets),
@@ -318,7 +427,7 @@ func (c *Client) createBatch(initial_bet *Bet) ([]byte, *Bet, error, bool) {
 	var file_has_lines = true;
 
 	if initial_bet != nil {
-		serialized_bet := initial_bet.serialize(c.config.ID)
+		serialized_bet := c.serializeBet(initial_bet)
 		copy(buffer, serialized_bet)
 		offset += len(serialized_bet)
 	}
@@ -349,7 +458,7 @@ func (c *Client) createBatch(initial_bet *Bet) ([]byte, *Bet, error, bool) {
 			amount: uint64(amount),
 		}
 
-		serialized_bet := bet.serialize(c.config.ID)
+		serialized_bet := c.serializeBet(bet)
 		if offset + len(serialized_bet) > MAX_BATCH_SIZE {
 			// Cotemplates the case where a bet does not fit inside the current batch
 			left_out_bet = bet
@@ -370,6 +479,13 @@ func (c *Client) createBatch(initial_bet *Bet) ([]byte, *Bet, error, bool) {
 	return packaged_batch, left_out_bet, nil, file_has_lines
 }
 
+func (c *Client) serializeBet(bet *Bet) []byte {
+	if c.version == ProtocolV2 {
+		return bet.serializeV2(c.config.ID)
+	}
+	return bet.serialize(c.config.ID)
+}
+
 /// 1 byte de indicador
 /// 8 bytes de longitud
 func (c *Client) packageBets(bets []byte) []byte {
@@ -390,7 +506,7 @@ func (c *Client) receiveMessage(size int) ([]byte, error) {
 	var received = 0
 	var err error
 	for offset := 0 ; offset < size ; offset += received {
-		received, err = c.conn.Read(buffer[received:])
+		received, err = c.conn.Read(buffer[offset:])
 		if err != nil {
 			break
 		}
@@ -402,25 +518,165 @@ func (c *Client) receiveMessage(size int) ([]byte, error) {
 
 // StartClientLoop Send messages to the client until some time threshold is met
 func (c *Client) StartClientLoop() {
-	// There is an autoincremental msgID to identify every message sent
-	// Messages if the message amount threshold has not been surpassed
-	var initial_bet *Bet = nil
-	var file_has_lines = true
 	// TODO: No hacer que se reconecte en cada iteracion
 	// Create the connection the server in every loop iteration. Send an
 	c.createClientSocket()
+
+	options, err := c.handshake()
+	if err != nil {
+		log.Errorf("action: handshake | result: fail | client_id: %v | error: %v", c.config.ID, err)
+		return
+	}
+	c.version = options.version
+
+	if options.window > 0 {
+		err = c.sendBetsPipelined(options)
+	} else {
+		err = c.sendBetsStopAndWait(options)
+	}
+	if err != nil {
+		return
+	}
+
+	// msg, err := bufio.NewReader(c.conn).ReadString('\n')
+	end_indicator := [1]byte { byte(uint8(ClientBetEnd)) };
+	c.sendToServer(end_indicator[:])
+
+	c.receiveWinners()
+
+	// time.Sleep(c.config.LoopPeriod)
+
+	c.conn.Close()
+	log.Infof("action: loop_finished | result: success | client_id: %v", c.config.ID)
+}
+
+// Sends the agency id. Options are only negotiated if any is configured,
+// otherwise the handshake is just the id, as older servers expect
+func (c *Client) handshake() (connectionOptions, error) {
+	options := connectionOptions{version: ProtocolV1}
 	client_id := SerializeString(c.config.ID)
+	if c.config.BatchWindow <= 1 && !c.config.Compression && c.config.Protocol <= ProtocolV1 {
+		return options, c.sendToServer(client_id)
+	}
+
+	var requested []byte
+	if c.config.BatchWindow > 1 {
+		window := c.config.BatchWindow
+		if window > 255 {
+			window = 255
+		}
+		requested = append(requested, OptionWindow, uint8(window))
+	}
+	if c.config.Compression {
+		requested = append(requested, OptionCompression, CompressionZlib)
+	}
+	if c.config.Protocol > ProtocolV1 {
+		requested = append(requested, OptionVersion, uint8(c.config.Protocol))
+	}
+	if c.config.Resume && c.config.BatchWindow > 1 {
+		requested = append(requested, OptionResume, 1)
+	}
+	client_id[0] = byte(ClientHandshakeOptions)
+	handshake := append(client_id, byte(len(requested) / 2))
+	handshake = append(handshake, requested...)
+	if err := c.sendToServer(handshake); err != nil {
+		return options, err
+	}
+
+	amount, err := c.receiveMessage(1)
+	if err != nil {
+		return options, err
+	}
+	granted, err := c.receiveMessage(2 * int(uint8(amount[0])))
+	if err != nil {
+		return options, err
+	}
+	resume := false
+	for i := 0; i + 1 < len(granted); i += 2 {
+		switch granted[i] {
+		case OptionWindow:
+			options.window = int(uint8(granted[i + 1]))
+		case OptionCompression:
+			options.compression = granted[i + 1] == CompressionZlib
+		case OptionVersion:
+			options.version = int(uint8(granted[i + 1]))
+		case OptionResume:
+			resume = granted[i + 1] == 1
+		}
+	}
+	if resume {
+		// The uint64 with the sequence to resume from follows the options
+		next, err := c.receiveMessage(10)
+		if err != nil {
+			return options, err
+		}
+		options.resumeFrom = DeserializeUInteger64(next)
+	}
+	log.Infof("action: handshake | result: success | client_id: %v | window: %v | compression: %v | version: %v | resume_from: %v",
+		c.config.ID,
+		options.window,
+		options.compression,
+		options.version,
+		options.resumeFrom,
+	)
+	return options, nil
+}
+
+// Turns a batch made by packageBets into a compressed one: every bet without
+// its agency field (the server knows it), compressed with zlib
+func (c *Client) compressBatch(packaged []byte) []byte {
+	bets := packaged[1 + 10:]
+
+	var hoisted bytes.Buffer
+	if c.version == ProtocolV2 {
+		agency, _ := strconv.ParseUint(c.config.ID, 10, 64)
+		agency_len := len(SerializeVarint(agency))
+		for offset := 0; offset < len(bets); {
+			bet_size := int(binary.BigEndian.Uint16(bets[offset:offset + 2]))
+			var length [2]byte
+			binary.BigEndian.PutUint16(length[:], uint16(bet_size - agency_len))
+			hoisted.Write(length[:])
+			hoisted.Write(bets[offset + 2 + agency_len:offset + 2 + bet_size])
+			offset += bet_size + 2
+		}
+	} else {
+		agency_len := len(SerializeString(c.config.ID))
+		for offset := 0; offset < len(bets); {
+			bet_size := int(uint8(bets[offset + 1]))
+			hoisted.WriteByte(bets[offset])
+			hoisted.WriteByte(byte(bet_size - agency_len))
+			hoisted.Write(bets[offset + 2 + agency_len:offset + 2 + bet_size])
+			offset += bet_size + 2
+		}
+	}
+
+	var compressed bytes.Buffer
+	writer := zlib.NewWriter(&compressed)
+	writer.Write(hoisted.Bytes())
+	writer.Close()
+
+	header := [1]byte {byte(uint8(ClientBetBatchCompressed))}
+	frame := append(header[:], SerializeUInteger64(uint64(compressed.Len()))...)
+	return append(frame, compressed.Bytes()...)
+}
+
+// Sends every bet, waiting for the ack of each batch before sending the next one
+func (c *Client) sendBetsStopAndWait(options connectionOptions) error {
+	var initial_bet *Bet = nil
+	var file_has_lines = true
 
-	c.sendToServer(client_id)
 	for ; file_has_lines == true; {
 		// If the client is killed, break out of the loop inmediately
 		if c.killed {
 			break
 		}
 
-		bets, left_out_bet, err, still_has_lines := c.createBatch(initial_bet)
+		bets, left_out_bet, _, still_has_lines := c.createBatch(initial_bet)
 		file_has_lines = still_has_lines
 		initial_bet = left_out_bet
+		if options.compression {
+			bets = c.compressBatch(bets)
+		}
 
 
 		c.sendToServer(bets)
@@ -434,7 +690,7 @@ func (c *Client) StartClientLoop() {
 				c.config.ID,
 				err,
 			)
-			return
+			return err
 		}
 
 		exit_status := int8(msg[0])
@@ -443,7 +699,7 @@ func (c *Client) StartClientLoop() {
 				c.config.ID,
 				exit_status,
 			)
-			return
+			return errors.New("batch rejected by the server")
 		}
 
 
@@ -454,14 +710,76 @@ func (c *Client) StartClientLoop() {
 		// time.Sleep(c.config.LoopPeriod)
 
 	}
-	// msg, err := bufio.NewReader(c.conn).ReadString('\n')
-	end_indicator := [1]byte { byte(uint8(ClientBetEnd)) };
-	c.sendToServer(end_indicator[:])
+	return nil
+}
 
-	c.receiveWinners()
+// Sends every bet keeping up to the granted window of batches in flight.
+// Each batch carries a sequence number, which the server acks with
+func (c *Client) sendBetsPipelined(options connectionOptions) error {
+	window := options.window
+
+	// A slot is taken by every batch sent and given back by its ack
+	slots := make(chan struct{}, window)
+	sent := make(chan uint64, window)
+	acks_done := make(chan error, 1)
+
+	go func() {
+		var ack_err error
+		for range sent {
+			msg, err := c.receiveMessage(1 + 10)
+			if err != nil {
+				acks_done <- err
+				// Keep draining so the sender does not block
+				for range sent {
+					<-slots
+				}
+				return
+			}
+			sequence := DeserializeUInteger64(msg[1:11])
+			if int8(msg[0]) != 0 {
+				log.Errorf("action: apuestas_enviadas | result: fail | client_id: %v | batch: %v | server_exit_status: %v",
+					c.config.ID,
+					sequence,
+					int8(msg[0]),
+				)
+				ack_err = errors.New("batch rejected by the server")
+			} else {
+				log.Infof("action: apuestas_enviadas | result: success | batch: %v", sequence)
+			}
+			<-slots
+		}
+		acks_done <- ack_err
+	}()
 
-	// time.Sleep(c.config.LoopPeriod)
+	var initial_bet *Bet = nil
+	var file_has_lines = true
+	var sequence uint64 = 0
+	for ; file_has_lines == true && !c.killed; sequence += 1 {
+		bets, left_out_bet, _, still_has_lines := c.createBatch(initial_bet)
+		file_has_lines = still_has_lines
+		initial_bet = left_out_bet
+		if sequence < options.resumeFrom {
+			// Already stored by the server, batches are cut the same way
+			continue
+		}
+		if options.compression {
+			bets = c.compressBatch(bets)
+		}
 
-	c.conn.Close()
-	log.Infof("action: loop_finished | result: success | client_id: %v", c.config.ID)
+		slots <- struct{}{}
+		sent <- sequence
+		// The batch indicator is followed by the sequence number
+		sequenced := append([]byte{bets[0]}, SerializeUInteger64(sequence)...)
+		sequenced = append(sequenced, bets[1:]...)
+		if err := c.sendToServer(sequenced); err != nil {
+			break
+		}
+	}
+	close(sent)
+
+	if err := <-acks_done; err != nil {
+		log.Errorf("action: receive_message | result: fail | client_id: %v | error: %v", c.config.ID, err)
+		return err
+	}
+	return nil
 }
@@ -85,6 +85,19 @@ func SerializeUInteger64(i uint64) []byte {
 	return buffer
 }
 
+// Unsigned LEB128, as used by the protocol v2 bets
+func SerializeVarint(i uint64) []byte {
+	buffer := make([]byte, binary.MaxVarintLen64)
+	length := binary.PutUvarint(buffer, i)
+	return buffer[:length]
+}
+
+// A protocol v2 string: its length as a varint, then its UTF-8 bytes
+func SerializeVarintString(s string) []byte {
+	bytes := []byte(s)
+	return append(SerializeVarint(uint64(len(bytes))), bytes...)
+}
+
 func SerializeByte(b byte) []byte {
 	length := 1
 
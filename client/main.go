@@ -41,6 +41,10 @@ func InitConfig() (*viper.Viper, error) {
 	v.BindEnv("loop", "period")
 	v.BindEnv("loop", "amount")
 	v.BindEnv("log", "level")
+	v.BindEnv("batch", "window")
+	v.BindEnv("batch", "compression")
+	v.BindEnv("batch", "protocol")
+	v.BindEnv("batch", "resume")
 
 	// Try to read configuration from config file. If config file
 	// does not exists then ReadInConfig will fail but configuration
@@ -123,6 +127,10 @@ func main() {
 		LoopAmount:    v.GetInt("loop.amount"),
 		LoopPeriod:    v.GetDuration("loop.period"),
 		MaxBetAmountInBatch: v.GetInt("batch.maxAmount"),
+		BatchWindow:         v.GetInt("batch.window"),
+		Compression:         v.GetBool("batch.compression"),
+		Protocol:            v.GetInt("batch.protocol"),
+		Resume:              v.GetBool("batch.resume"),
 	}
 
 	// bet, err := common.InitBet();
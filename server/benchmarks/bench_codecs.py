@@ -0,0 +1,47 @@
+"""
+Encoding size and decode throughput of the bets protocol versions
+
+Splits every agency dataset in `.data` in batches of up to 8 kB of v1 bets,
+like the client, and encodes the same bets in v1 and v2. Decoding is
+measured with the server batch decoders, both decoding only and decoding
+plus building every Bet.
+
+Run from the server directory:
+    python -m benchmarks.bench_codecs
+"""
+import timeit
+
+from common.batch import BATCH_DECODERS
+from common import protocol
+from benchmarks.datasets import agency_datasets, client_batches
+
+
+REPEAT = 7
+
+
+def main():
+    datasets = agency_datasets()
+    # Frame header: indicator and uint64 length
+    header = 11
+
+    print(f"{'agency':>6} {'bets':>8} {'version':>7} {'B/bet':>7} {'wire kB':>9} {'ratio':>6} "
+          f"{'decode Mbets/s':>15} {'+ Bet kbets/s':>14}")
+    for agency, bets in datasets.items():
+        batches = client_batches(bets, protocol.SerializeBet)
+        plain = None
+        for version in sorted(protocol.PROTOCOL_VERSIONS):
+            serialize_bet, _ = protocol.CODECS[version]
+            decode = BATCH_DECODERS[version]
+            payloads = [b''.join(serialize_bet(bet) for bet in batch) for batch in batches]
+            wire = sum(header + len(payload) for payload in payloads)
+            if plain is None:
+                plain = wire
+
+            decoding = min(timeit.repeat(lambda: [decode(payload) for payload in payloads], number=1, repeat=REPEAT))
+            building = min(timeit.repeat(lambda: [list(decode(payload)) for payload in payloads], number=1, repeat=REPEAT))
+            print(f"{agency:>6} {len(bets):>8} {f'v{version}':>7} {wire / len(bets):>7.1f} {wire / 1024:>9,.0f} "
+                  f"{plain / wire:>6.2f} {len(bets) / decoding / 1e6:>15,.2f} {len(bets) / building / 1e3:>14,.0f}")
+
+
+if __name__ == '__main__':
+    main()
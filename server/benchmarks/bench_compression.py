@@ -0,0 +1,51 @@
+"""
+Bytes on the wire and inflate throughput of compressed batches
+
+Splits every agency dataset in `.data` in batches of up to 8 kB, like the
+client, and compares the plain batches against compressed ones (agency
+hoisted, then zlib) at a few levels. Inflating includes restoring the agency
+of every bet, as the server does.
+
+Run from the server directory:
+    python -m benchmarks.bench_compression
+"""
+import timeit
+
+from common.compression import BatchInflater, compress_batch, INFLATE_CHUNK_SIZE
+from common import protocol
+from benchmarks.datasets import agency_datasets, client_batches
+
+
+LEVELS = [1, 6, 9]
+REPEAT = 3
+
+
+def inflate(agency: int, compressed: list) -> None:
+    for frame in compressed:
+        inflater = BatchInflater(agency)
+        for i in range(0, len(frame), INFLATE_CHUNK_SIZE):
+            inflater.feed(frame[i:i + INFLATE_CHUNK_SIZE])
+        inflater.finish()
+
+
+def main():
+    datasets = agency_datasets()
+    # Frame header: indicator and uint64 length
+    header = 11
+
+    print(f"{'agency':>6} {'bets':>8} {'frame':<10} {'wire kB':>10} {'ratio':>7} {'inflate MB/s':>13}")
+    for agency, bets in datasets.items():
+        batches = client_batches(bets, protocol.SerializeBet)
+        plain = sum(header + sum(len(protocol.SerializeBet(bet)) for bet in batch) for batch in batches)
+        print(f"{agency:>6} {len(bets):>8} {'plain':<10} {plain / 1024:>10,.0f} {1:>7.2f} {'':>13}")
+
+        for level in LEVELS:
+            compressed = [compress_batch(batch, level) for batch in batches]
+            wire = sum(header + len(frame) for frame in compressed)
+            elapsed = min(timeit.repeat(lambda: inflate(agency, compressed), number=1, repeat=REPEAT))
+            print(f"{agency:>6} {len(bets):>8} {f'zlib -{level}':<10} {wire / 1024:>10,.0f} "
+                  f"{plain / wire:>7.2f} {plain / elapsed / 1e6:>13,.1f}")
+
+
+if __name__ == '__main__':
+    main()
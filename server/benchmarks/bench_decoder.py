@@ -0,0 +1,53 @@
+"""
+Micro-benchmark of the bets batch decoders
+
+Compares the per-bet decoder (`protocol.DeserializeBets`) against the
+columnar one (`batch.decode_batch`), both decoding only and decoding plus
+building every `Bet`.
+
+Run from the server directory:
+    python -m benchmarks.bench_decoder
+"""
+import random
+import timeit
+
+from common.utils import Bet
+from common.batch import decode_batch
+from common import protocol
+
+
+BATCH_SIZES = [1_000, 10_000]
+REPEAT = 5
+
+
+def synthetic_batch(amount: int, agency: int = 1) -> bytes:
+    rng = random.Random(amount)
+    bets = [
+        Bet(str(agency), f'Nombre{i}', f'Apellido{i}', str(rng.randint(10_000_000, 40_000_000)),
+            f'{rng.randint(1950, 2005)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}', rng.randint(0, 9999))
+        for i in range(amount)
+    ]
+    return b''.join(protocol.SerializeBet(bet) for bet in bets)
+
+
+def best_of(fn, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=REPEAT)) / number
+
+
+def main():
+    print(f"{'bets':>8} {'decoder':<28} {'ms/batch':>10} {'bets/s':>12}")
+    for amount in BATCH_SIZES:
+        payload = synthetic_batch(amount)
+        number = max(1, 20_000 // amount)
+        cases = [
+            ('per bet (DeserializeBets)', lambda: protocol.DeserializeBets(payload)),
+            ('columnar (decode_batch)', lambda: decode_batch(payload)),
+            ('columnar + every Bet', lambda: list(decode_batch(payload))),
+        ]
+        for name, fn in cases:
+            elapsed = best_of(fn, number)
+            print(f"{amount:>8} {name:<28} {elapsed * 1000:>10.2f} {amount / elapsed:>12,.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Parallel draw benchmark
+
+Builds a synthetic store (5M bets by default) per backend and times
+`draw.draw` over it with an increasing amount of worker processes, up to
+the cores of the machine.
+
+Run from the server directory:
+    python -m benchmarks.bench_draw [amount of bets] [backend ...]
+"""
+import os
+import sys
+import time
+
+from common.draw import draw
+from common.storage import STORAGE_BACKENDS
+from benchmarks.bench_storage import synthetic_batches, in_directory
+
+
+DEFAULT_BETS = 5_000_000
+
+
+def worker_counts() -> list:
+    cores = os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+    return counts
+
+
+def bench_backend(backend, batches: list, counts: list) -> list:
+    store = backend()
+    for batch in batches:
+        store.store(batch)
+
+    timings = []
+    for workers in counts:
+        started = time.perf_counter()
+        winners = draw(store, workers)
+        timings.append((workers, time.perf_counter() - started, len(winners)))
+    store.close()
+    return timings
+
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BETS
+    backends = sys.argv[2:] or list(STORAGE_BACKENDS)
+    batches = list(synthetic_batches(amount))
+    counts = worker_counts()
+
+    print(f"{'backend':<8} {'bets':>10} {'workers':>8} {'draw s':>8} {'speedup':>8} {'winners':>8}")
+    for name in backends:
+        timings = in_directory(lambda: bench_backend(STORAGE_BACKENDS[name], batches, counts))
+        baseline = timings[0][1]
+        for workers, elapsed, winners in timings:
+            print(f"{name:<8} {amount:>10} {workers:>8} {elapsed:>8.2f} {baseline / elapsed:>7.2f}x {winners:>8}")
+
+
+if __name__ == '__main__':
+    main()
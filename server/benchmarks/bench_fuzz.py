@@ -0,0 +1,113 @@
+"""
+Fuzzes the batch decoders and measures their decode rate
+
+Takes the batches of every agency dataset in `.data` (v1 and v2, plain and
+compressed) and feeds the decoders the valid ones and mutated copies:
+truncated, with a few random bytes overwritten and plain random bytes. Frame
+headers get random bytes too. Every broken input must be rejected with a
+protocol.ProtocolError; anything else is counted as a crash and makes the
+run exit with status 1.
+
+Run from the server directory:
+    python -m benchmarks.bench_fuzz [seed]
+"""
+import random
+import sys
+import time
+
+from common.batch import BATCH_DECODERS
+from common.compression import BatchInflater, compress_batch
+from common import protocol
+from benchmarks.datasets import agency_datasets, client_batches
+
+
+""" Mutated copies of every batch """
+MUTATIONS_PER_BATCH = 4
+""" Random frame headers fed to DeserializeBatchSize """
+RANDOM_HEADERS = 200000
+
+
+def mutate(fuzz: random.Random, frame: bytes) -> bytes:
+    mutation = fuzz.randrange(3)
+    if mutation == 0:
+        return frame[:fuzz.randrange(len(frame))]
+    if mutation == 1:
+        broken = bytearray(frame)
+        for _ in range(fuzz.randint(1, 8)):
+            broken[fuzz.randrange(len(broken))] = fuzz.randrange(256)
+        return bytes(broken)
+    return fuzz.randbytes(fuzz.randint(1, len(frame)))
+
+
+def inflate_and_decode(agency: int, version: int):
+    decode = BATCH_DECODERS[version]
+
+    def run(frame: bytes):
+        inflater = BatchInflater(agency, version)
+        inflater.feed(frame)
+        return decode(inflater.finish())
+    return run
+
+
+def feed(decode, frames: list) -> tuple:
+    """
+    Decodes every frame. Returns (seconds, decoded, rejected, crashes)
+    """
+    decoded = rejected = 0
+    crashes = []
+    start = time.perf_counter()
+    for frame in frames:
+        try:
+            decode(frame)
+            decoded += 1
+        except protocol.ProtocolError:
+            rejected += 1
+        except Exception as e:
+            crashes.append(f"{type(e).__name__}: {e}")
+    return time.perf_counter() - start, decoded, rejected, crashes
+
+
+def main():
+    seed = int(sys.argv[1]) if len(sys.argv) > 1 else 14
+    fuzz = random.Random(seed)
+    datasets = agency_datasets()
+
+    crashes = []
+    print(f"seed: {seed}")
+    print(f"{'input':<22} {'frames':>8} {'MB':>7} {'decoded':>8} {'rejected':>9} {'crashes':>8} {'MB/s':>7}")
+
+    def report(name: str, decode, frames: list):
+        elapsed, decoded, rejected, frame_crashes = feed(decode, frames)
+        crashes.extend(frame_crashes)
+        size = sum(len(frame) for frame in frames) / 1e6
+        print(f"{name:<22} {len(frames):>8} {size:>7.1f} {decoded:>8} {rejected:>9} "
+              f"{len(frame_crashes):>8} {size / elapsed:>7.1f}")
+
+    for version in sorted(protocol.PROTOCOL_VERSIONS):
+        serialize_bet, _ = protocol.CODECS[version]
+        plain = []
+        compressed = {}
+        for agency, bets in datasets.items():
+            for batch in client_batches(bets, protocol.SerializeBet):
+                plain.append(b''.join(serialize_bet(bet) for bet in batch))
+                compressed.setdefault(agency, []).append(compress_batch(batch, version=version))
+
+        decode = BATCH_DECODERS[version]
+        report(f'v{version} valid', decode, plain)
+        report(f'v{version} fuzzed', decode, [mutate(fuzz, frame) for frame in plain for _ in range(MUTATIONS_PER_BATCH)])
+        for agency, frames in compressed.items():
+            fuzzed = [mutate(fuzz, frame) for frame in frames for _ in range(MUTATIONS_PER_BATCH)]
+            report(f'v{version} zlib fuzzed ({agency})', inflate_and_decode(agency, version), fuzzed)
+
+    headers = [fuzz.randbytes(10) for _ in range(RANDOM_HEADERS // 2)]
+    # Valid type and length, random value
+    headers += [b'\x01\x08' + fuzz.randbytes(8) for _ in range(RANDOM_HEADERS // 2)]
+    report('frame headers', protocol.DeserializeBatchSize, headers)
+
+    for crash in sorted(set(crashes))[:20]:
+        print(f"crash: {crash}")
+    sys.exit(1 if crashes else 0)
+
+
+if __name__ == '__main__':
+    main()
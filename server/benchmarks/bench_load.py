@@ -0,0 +1,298 @@
+"""
+End to end load benchmark of the server
+
+Runs a server in this process, on a free localhost port and over a
+temporary directory, and plays N agencies against it over the real wire
+protocol: the handshake, batches of up to 8 kB like the client, the end of
+bets and the winners. Agencies replay the datasets in `.data`, or
+synthetic bets with --bets. Every batch is serialized before the clock
+starts, so only the server (and the sockets) are measured.
+
+Prints a JSON object to stdout, to keep and compare across versions:
+ingest throughput, batch ack latency quantiles, draw latency and the peak
+RSS of the process (agencies included) and, with --ingest-workers, of the
+largest worker. Ingest pauses are only counted without workers.
+
+Run from the server directory:
+    python -m benchmarks.bench_load [--agencies N] [--bets N] [--engine threads|asyncio]
+        [--storage csv|binary|sharded] [--version 1|2] [--compression] [--window N] [--write-behind]
+        [--max-buffered-bytes N] [--ingest-workers N] [--profile PATH]
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+
+from common.utils import Bet
+from common.server import Server
+from common.async_server import AsyncServer
+from common.storage import STORAGE_BACKENDS, MergedBetStore, create_store
+from common.compression import COMPRESSION_ZLIB, compress_batch
+from common.metrics import Histogram
+from common.write_behind import WriteBehindStore
+from common.admission import IngestLimits, DEFAULT_MAX_BUFFERED_BYTES
+from common.workers import MultiProcessServer
+from common.profiling import Profiler
+from common import metrics
+from common import protocol
+from benchmarks.bench_storage import in_directory
+from benchmarks.datasets import agency_datasets, client_batches
+
+
+ENGINES = {
+    "threads": Server,
+    "asyncio": AsyncServer,
+}
+
+
+def synthetic_datasets(agencies: int, bets: int) -> dict:
+    """ bets random bets for each agency, by agency """
+    rng = random.Random(bets)
+    return {
+        agency: [
+            Bet(str(agency), f'Nombre{i}', f'Apellido{i}', str(rng.randint(10_000_000, 40_000_000)),
+                f'19{rng.randint(40, 99)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}', rng.randint(0, 9999))
+            for i in range(bets)
+        ]
+        for agency in range(1, agencies + 1)
+    }
+
+
+def handshake(agency: int, args) -> bytes:
+    """ A HANDSHAKE_OPTIONS asking for what args say """
+    options = [(protocol.OPTION_VERSION, args.version)]
+    if args.compression:
+        options.append((protocol.OPTION_COMPRESSION, COMPRESSION_ZLIB))
+    if args.window:
+        options.append((protocol.OPTION_WINDOW, args.window))
+    agency_id = str(agency).encode('utf-8')
+    return bytes([protocol.HANDSHAKE_OPTIONS, len(agency_id)]) + agency_id + protocol.SerializeOptions(options)
+
+
+def batch_frames(bets: list, args) -> list:
+    """ Every batch frame of an agency, without the sequence numbers of a pipelined one """
+    serialize_bet, _ = protocol.CODECS[args.version]
+    frames = []
+    for batch in client_batches(bets, protocol.SerializeBet):
+        if args.compression:
+            payload = compress_batch(batch, version=args.version)
+            indicator = protocol.BETS_BATCH_COMPRESSED
+        else:
+            payload = b''.join(serialize_bet(bet) for bet in batch)
+            indicator = protocol.BETS_BATCH
+        frames.append((indicator, payload))
+    return frames
+
+
+def receive_exactly(skt, size: int) -> bytes:
+    buff = b''
+    while len(buff) < size:
+        received = skt.recv(size - len(buff))
+        if not received:
+            raise ConnectionError("connection closed")
+        buff += received
+    return buff
+
+
+class Agency:
+    """
+    Plays an agency from a thread of its own. Ack latencies go to the shared
+    histogram, in nanoseconds
+    """
+    def __init__(self, port: int, agency: int, frames: list, args, latencies: Histogram, start: threading.Barrier):
+        self.port = port
+        self.agency = agency
+        self.frames = frames
+        self.args = args
+        self.latencies = latencies
+        self.start = start
+        self.failed = 0
+        self.winners = 0
+        self.bets_end_sent = None
+        self.winners_received = None
+        self.error = None
+
+    def run(self):
+        try:
+            with socket.create_connection(('localhost', self.port)) as skt:
+                skt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                skt.sendall(handshake(self.agency, self.args))
+                amount_of_options = receive_exactly(skt, 1)[0]
+                granted = dict(protocol.DeserializeOptions(receive_exactly(skt, 2 * amount_of_options)))
+                window = granted.get(protocol.OPTION_WINDOW)
+                self.start.wait()
+
+                if window:
+                    self._send_pipelined(skt, window)
+                else:
+                    self._send_in_lockstep(skt)
+
+                self.bets_end_sent = time.perf_counter_ns()
+                skt.sendall(protocol.SerializeUInteger8(protocol.BETS_END))
+                header = receive_exactly(skt, 11)
+                size, _ = protocol.DeserializeUInteger64(header[1:])
+                _, deserialize_bets = protocol.CODECS[granted.get(protocol.OPTION_VERSION, protocol.PROTOCOL_V1)]
+                self.winners = len(deserialize_bets(receive_exactly(skt, size)))
+                self.winners_received = time.perf_counter_ns()
+        except (OSError, protocol.ProtocolError) as e:
+            self.error = e
+
+    def _send_in_lockstep(self, skt):
+        for indicator, payload in self.frames:
+            sent = time.perf_counter_ns()
+            skt.sendall(protocol.SerializeUInteger8(indicator) + protocol.SerializeUInteger64(len(payload)) + payload)
+            ack = receive_exactly(skt, 1)
+            self.latencies.record(time.perf_counter_ns() - sent)
+            self.failed += ack != protocol.ACK_OK
+
+    def _send_pipelined(self, skt, window: int):
+        sent_at = {}
+        next_frame = 0
+        while next_frame < len(self.frames) or sent_at:
+            if next_frame < len(self.frames) and len(sent_at) < window:
+                indicator, payload = self.frames[next_frame]
+                sent_at[next_frame] = time.perf_counter_ns()
+                skt.sendall(protocol.SerializeUInteger8(indicator) + protocol.SerializeUInteger64(next_frame)
+                            + protocol.SerializeUInteger64(len(payload)) + payload)
+                next_frame += 1
+                continue
+            ack = receive_exactly(skt, 11)
+            sequence, _ = protocol.DeserializeUInteger64(ack[1:])
+            self.latencies.record(time.perf_counter_ns() - sent_at.pop(sequence))
+            self.failed += ack[0:1] != protocol.ACK_OK
+
+
+def run_load(datasets: dict, args) -> dict:
+    frames = {agency: batch_frames(bets, args) for agency, bets in datasets.items()}
+    wire_bytes = sum(11 + len(payload) for agency_frames in frames.values() for _, payload in agency_frames)
+
+    def open_store(worker=0):
+        store = create_store(args.storage, worker=worker)
+        if args.write_behind:
+            store = WriteBehindStore(store)
+        return store
+
+    limits = IngestLimits(max_batch_bytes=min(protocol.MAX_BATCH_FRAME_SIZE, args.max_buffered_bytes),
+                          max_buffered_bytes=args.max_buffered_bytes)
+    if args.ingest_workers > 1:
+        server = MultiProcessServer(0, len(datasets), len(datasets), open_store,
+                                    lambda round_id: MergedBetStore([create_store(args.storage, worker=worker, read_only=True)
+                                                                     for worker in range(args.ingest_workers)]),
+                                    args.ingest_workers, args.draw_workers, limits=limits)
+    else:
+        server = ENGINES[args.engine](0, len(datasets), len(datasets), open_store(), args.draw_workers, limits=limits)
+    port = server._server_socket.getsockname()[1]
+    server_thread = threading.Thread(target=server.run)
+    server_thread.start()
+
+    latencies = Histogram('ack_latency', 'Batch ack latency')
+    draws_before = metrics.DRAW_SECONDS.count
+    pauses_before = metrics.INGEST_PAUSE_SECONDS.count
+    draw_seconds_before = metrics.DRAW_SECONDS.sum
+    # Agencies are connected before the clock starts, and then start all at once
+    start = threading.Barrier(len(datasets) + 1)
+    agencies = [Agency(port, agency, frames[agency], args, latencies, start) for agency in datasets]
+    threads = [threading.Thread(target=agency.run) for agency in agencies]
+    for thread in threads:
+        thread.start()
+    profiler = Profiler(args.profile, seconds=float('inf')) if args.profile else None
+    start.wait()
+    if profiler is not None:
+        profile_path = profiler.start()
+    started = time.perf_counter_ns()
+    for thread in threads:
+        thread.join()
+    finished = time.perf_counter_ns()
+    if profiler is not None:
+        profiler.stop()
+
+    server.finalize()
+    server_thread.join()
+
+    errors = [f'agency {agency.agency}: {agency.error}' for agency in agencies if agency.error is not None]
+    if errors:
+        raise RuntimeError(', '.join(errors))
+
+    bets = sum(len(bets) for bets in datasets.values())
+    last_bets_end = max(agency.bets_end_sent for agency in agencies)
+    ingest_seconds = (last_bets_end - started) / 1e9
+    return {
+        'engine': args.engine,
+        'storage': args.storage,
+        'version': args.version,
+        'compression': args.compression,
+        'window': args.window,
+        'write_behind': args.write_behind,
+        'max_buffered_bytes': args.max_buffered_bytes,
+        'ingest_workers': args.ingest_workers,
+        'profile': profile_path if profiler is not None else None,
+        'agencies': len(datasets),
+        'bets': bets,
+        'batches': latencies.count,
+        'failed_batches': sum(agency.failed for agency in agencies),
+        'wire_bytes': wire_bytes,
+        'ingest_seconds': ingest_seconds,
+        'ingest_bets_per_second': bets / ingest_seconds,
+        'ingest_mb_per_second': wire_bytes / ingest_seconds / 1e6,
+        'ack_latency_p50_ms': latencies.quantile(0.5) / 1e6,
+        'ack_latency_p99_ms': latencies.quantile(0.99) / 1e6,
+        'ack_latency_max_ms': latencies.quantile(1) / 1e6,
+        # Kept by each ingest worker, not gathered here
+        'ingest_pauses': metrics.INGEST_PAUSE_SECONDS.count - pauses_before if args.ingest_workers == 1 else None,
+        # From the last end of bets to the last agency having its winners
+        'draw_latency_ms': (max(agency.winners_received for agency in agencies) - last_bets_end) / 1e6,
+        'draw_seconds': (metrics.DRAW_SECONDS.sum - draw_seconds_before) / 1e9,
+        'draws': metrics.DRAW_SECONDS.count - draws_before,
+        'winners': sum(agency.winners for agency in agencies),
+        'total_seconds': (finished - started) / 1e9,
+        # Linux reports it in kB
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        # The largest ingest worker, they were all waited for by finalize
+        'peak_worker_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if args.ingest_workers > 1 else None,
+    }
+
+
+def parse_args(argv: list):
+    parser = argparse.ArgumentParser(description='End to end load benchmark of the server')
+    parser.add_argument('--agencies', type=int, default=5, help='agencies betting at the same time')
+    parser.add_argument('--bets', type=int, default=0,
+                        help='synthetic bets per agency. 0 replays the datasets in .data')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='threads')
+    parser.add_argument('--storage', choices=sorted(STORAGE_BACKENDS), default='csv')
+    parser.add_argument('--draw-workers', type=int, default=1)
+    parser.add_argument('--version', type=int, choices=sorted(protocol.PROTOCOL_VERSIONS), default=protocol.PROTOCOL_V1)
+    parser.add_argument('--compression', action='store_true', help='send zlib compressed batches')
+    parser.add_argument('--window', type=int, default=0, help='batches in flight. 0 waits for every ack')
+    parser.add_argument('--write-behind', action='store_true', help='store from a writer thread with group commit')
+    parser.add_argument('--max-buffered-bytes', type=int, default=DEFAULT_MAX_BUFFERED_BYTES,
+                        help='bytes of batches read and not stored yet, see admission.IngestLimits')
+    parser.add_argument('--ingest-workers', type=int, default=1,
+                        help='processes ingesting on the same port (threads engine), see workers.MultiProcessServer')
+    parser.add_argument('--profile', metavar='PATH', type=os.path.abspath,
+                        help='profile the whole load, see profiling.Profiler. The agencies run in this process and show too')
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.bets:
+        datasets = synthetic_datasets(args.agencies, args.bets)
+    else:
+        # Agencies beyond the datasets replay them again, under their own id
+        replayed = list(agency_datasets().values())
+        datasets = {
+            agency: [Bet(str(agency), bet.first_name, bet.last_name, bet.document, bet.birthdate.isoformat(), bet.number)
+                     for bet in replayed[(agency - 1) % len(replayed)]]
+            for agency in range(1, args.agencies + 1)
+        }
+    results = in_directory(lambda: run_load(datasets, args))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
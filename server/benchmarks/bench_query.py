@@ -0,0 +1,106 @@
+"""
+Query benchmark
+
+Stores synthetic bets (10M by default, every document different) in a
+binary store, indexed for queries as the server does with QUERY_INDEX, and
+times the queries of an agency: its amount of bets, its bets with a
+document and with a number. The same queries over the store without the
+index, which scan it, are timed once for comparison.
+
+Run from the server directory:
+    python -m benchmarks.bench_query [amount of bets]
+"""
+import os
+import random
+import sys
+import time
+
+from common.utils import Bet
+from common.batch import decode_batch
+from common.storage import BinaryBetStore
+from common.query import QueryableBetStore, count_bets, bets_with_document, bets_with_number
+from common import protocol
+from benchmarks.bench_storage import BATCH_SIZE, in_directory
+
+
+DEFAULT_BETS = 10_000_000
+AGENCIES = 5
+LOOKUPS = 1000
+
+
+def document(index: int) -> str:
+    return str(10_000_000 + index)
+
+
+def synthetic_batches(amount: int):
+    """
+    Decoded batches of BATCH_SIZE bets from a single agency each, agencies
+    taking turns. Bet i has document(i)
+    """
+    rng = random.Random(amount)
+    for start in range(0, amount, BATCH_SIZE):
+        agency = (start // BATCH_SIZE) % AGENCIES + 1
+        yield decode_batch(b''.join(
+            protocol.SerializeBet(Bet(str(agency), 'Nombre', 'Apellido', document(i), '1990-05-17', rng.randint(0, 9999)))
+            for i in range(start, min(start + BATCH_SIZE, amount))
+        ))
+
+
+def percentile(timings: list, fraction: float) -> float:
+    return sorted(timings)[min(len(timings) - 1, int(len(timings) * fraction))]
+
+
+def time_lookups(query, arguments: list) -> list:
+    timings = []
+    for argument in arguments:
+        started = time.perf_counter()
+        query(argument)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def bench(amount: int) -> None:
+    store = QueryableBetStore(BinaryBetStore())
+    started = time.perf_counter()
+    for batch in synthetic_batches(amount):
+        store.writer(batch.agencies[0]).store(batch)
+    ingest = time.perf_counter() - started
+    print(f"stored {amount} bets in {ingest:.1f} s ({amount / ingest:,.0f} bets/s), "
+          f"index file {os.path.getsize('./bets.qidx') / 2 ** 20:.0f} MiB")
+
+    rng = random.Random(0)
+    documents = [rng.randrange(amount) for _ in range(LOOKUPS)]
+    queries = {
+        'count': lambda agency: count_bets(store, agency),
+        'document': lambda index: bets_with_document(store, (index // BATCH_SIZE) % AGENCIES + 1, document(index)),
+        'number': lambda number: bets_with_number(store, 1, number),
+    }
+    arguments = {
+        'count': [rng.randint(1, AGENCIES) for _ in range(LOOKUPS)],
+        'document': documents,
+        'number': [rng.randint(0, 9999) for _ in range(LOOKUPS)],
+    }
+
+    print(f"{'query':<10} {'mean us':>9} {'p99 us':>9} {'scan s':>9}")
+    scanned = store._store
+    scans = {
+        'count': lambda: count_bets(scanned, 1),
+        'document': lambda: bets_with_document(scanned, 1, document(0)),
+        'number': lambda: bets_with_number(scanned, 1, 0),
+    }
+    for name, query in queries.items():
+        timings = time_lookups(query, arguments[name])
+        started = time.perf_counter()
+        scans[name]()
+        scan = time.perf_counter() - started
+        print(f"{name:<10} {sum(timings) / len(timings) * 1e6:>9.1f} {percentile(timings, 0.99) * 1e6:>9.1f} {scan:>9.2f}")
+    store.close()
+
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BETS
+    in_directory(lambda: bench(amount))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Startup benchmark
+
+Starts main.py as a new process, as an orchestrator restarting the server
+would, and times how long until the port takes connections and until the
+server is ready to serve them (storage and indexes open). Repeated --runs
+times over the same storage, which can be filled with --bets synthetic
+bets first so loading it shows.
+
+Run from the server directory:
+    python -m benchmarks.bench_startup [--runs N] [--bets N] [--storage binary] [--winner-index]
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from common.storage import create_store
+from common.index import IndexedBetStore, INDEX_FILEPATH
+from benchmarks.bench_storage import synthetic_batches
+
+
+MAIN_PATH = os.path.join(os.path.dirname(__file__), '..', 'main.py')
+""" Longest a run may take to listen, in seconds """
+STARTUP_TIMEOUT = 60
+""" How often the port is probed, in seconds """
+PROBE_INTERVAL = 0.0005
+
+
+def free_port() -> int:
+    with socket.socket() as skt:
+        skt.bind(('', 0))
+        return skt.getsockname()[1]
+
+
+def fill_storage(args) -> None:
+    store = create_store(args.storage)
+    if args.winner_index:
+        store = IndexedBetStore(store, INDEX_FILEPATH)
+    for batch in synthetic_batches(args.bets):
+        store.writer(batch.agencies[0]).store(batch)
+    store.close()
+
+
+def start_once(args, port: int) -> dict:
+    """
+    Seconds from spawning the server until a connection is accepted by the
+    kernel, and until the server logs it is ready, along with what it
+    measured itself
+    """
+    env = dict(os.environ, SERVER_PORT=str(port), SERVER_LISTEN_BACKLOG='5', LOGGING_LEVEL='INFO',
+               AMOUNT_OF_CLIENTS='1', STORAGE_BACKEND=args.storage, WINNER_INDEX=str(args.winner_index).lower(),
+               PYTHONPATH=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, os.path.abspath(MAIN_PATH)], env=env,
+                              stderr=subprocess.PIPE, text=True)
+    listening = None
+    while listening is None and time.perf_counter() - started < STARTUP_TIMEOUT:
+        try:
+            with socket.create_connection(('localhost', port)):
+                listening = time.perf_counter() - started
+        except OSError:
+            time.sleep(PROBE_INTERVAL)
+
+    ready = None
+    reported = {}
+    for line in server.stderr:
+        match = re.search(r'action: (\w+) \| result: success \|.* (time_to_\w+_ms): ([\d.]+)', line)
+        if match:
+            reported[match.group(2)] = float(match.group(3))
+        if 'action: accept_connections' in line:
+            ready = time.perf_counter() - started
+            break
+    server.send_signal(signal.SIGTERM)
+    server.communicate(timeout=STARTUP_TIMEOUT)
+    return {'listening_ms': listening * 1000 if listening is not None else None,
+            'ready_ms': ready * 1000 if ready is not None else None, **reported}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--bets', type=int, default=0, help='synthetic bets stored before starting')
+    parser.add_argument('--storage', default='csv', choices=['csv', 'binary', 'sharded'])
+    parser.add_argument('--winner-index', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        previous = os.getcwd()
+        os.chdir(directory)
+        try:
+            if args.bets:
+                fill_storage(args)
+            runs = [start_once(args, free_port()) for _ in range(args.runs)]
+        finally:
+            os.chdir(previous)
+
+    result = {'runs': args.runs, 'bets': args.bets, 'storage': args.storage, 'winner_index': args.winner_index}
+    for key in runs[0]:
+        values = sorted(run[key] for run in runs if run.get(key) is not None)
+        if values:
+            result[f'{key}_p50'] = round(values[len(values) // 2], 1)
+            result[f'{key}_max'] = round(values[-1], 1)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
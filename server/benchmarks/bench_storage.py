@@ -0,0 +1,120 @@
+"""
+Draw and concurrent ingest benchmark over the storage backends
+
+Stores the same synthetic bets in every backend (in batches, like the
+server does) and times the draw, `store.winners()`, over them. Then times
+several agencies storing at the same time, each through its own writer.
+
+Run from the server directory:
+    python -m benchmarks.bench_storage [amount of bets]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from common.utils import Bet, LOTTERY_WINNER_NUMBER
+from common.batch import decode_batch
+from common.storage import STORAGE_BACKENDS, ShardedBetStore
+from common.index import IndexedBetStore
+from common import protocol
+
+
+DEFAULT_BETS = 1_000_000
+BATCH_SIZE = 100
+AGENCIES = [1, 2, 4, 8]
+
+BACKENDS = dict(STORAGE_BACKENDS, indexed=lambda: IndexedBetStore(ShardedBetStore()))
+
+
+def synthetic_batches(amount: int, agencies: int = 5):
+    """
+    Decoded batches of BATCH_SIZE bets from a single agency each, as the
+    server stores them. One bet per batch wins
+    """
+    rng = random.Random(amount)
+    payloads = []
+    for agency in range(1, agencies + 1):
+        template = [
+            protocol.SerializeBet(Bet(str(agency), f'Nombre{i}', f'Apellido{i}',
+                                      str(rng.randint(10_000_000, 40_000_000)), '1990-05-17', rng.randint(0, 9999)))
+            for i in range(BATCH_SIZE - 1)
+        ]
+        template.append(protocol.SerializeBet(Bet(str(agency), 'Ganador', 'Apellido', '30000000', '1990-05-17', LOTTERY_WINNER_NUMBER)))
+        payloads.append(b''.join(template))
+    for index in range(amount // BATCH_SIZE):
+        yield decode_batch(payloads[index % agencies])
+
+
+def storage_size() -> int:
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk('.') for file in files)
+
+
+def in_directory(fn):
+    with tempfile.TemporaryDirectory() as directory:
+        previous = os.getcwd()
+        os.chdir(directory)
+        try:
+            return fn()
+        finally:
+            os.chdir(previous)
+
+
+def concurrent_ingest(backend, agencies: int, batches: list) -> float:
+    """ Every agency stores all the batches through its own writer. Returns bets/s """
+    store = backend()
+
+    def ingest(agency):
+        writer = store.writer(agency)
+        for batch in batches:
+            writer.store(batch)
+        writer.close()
+
+    threads = [threading.Thread(target=ingest, args=(agency,)) for agency in range(1, agencies + 1)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    store.close()
+    return agencies * len(batches) * BATCH_SIZE / elapsed
+
+
+def main():
+    amount = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BETS
+    batches = list(synthetic_batches(amount))
+    print(f"{'backend':<8} {'bets':>10} {'store s':>9} {'draw s':>8} {'file MB':>8} {'winners':>8}")
+    for name, backend in BACKENDS.items():
+        with tempfile.TemporaryDirectory() as directory:
+            previous = os.getcwd()
+            os.chdir(directory)
+            try:
+                store = backend()
+                started = time.perf_counter()
+                for batch in batches:
+                    store.store(batch)
+                stored = time.perf_counter() - started
+
+                started = time.perf_counter()
+                winners = store.winners()
+                drawn = time.perf_counter() - started
+                store.close()
+
+                size = storage_size() / 1e6
+            finally:
+                os.chdir(previous)
+        print(f"{name:<8} {amount:>10} {stored:>9.2f} {drawn:>8.2f} {size:>8.1f} {len(winners):>8}")
+
+    per_agency = batches[:max(1, len(batches) // max(AGENCIES))]
+    print()
+    print(f"{'backend':<8} " + " ".join(f"{f'{agencies} ag bets/s':>16}" for agencies in AGENCIES))
+    for name, backend in BACKENDS.items():
+        rates = [in_directory(lambda: concurrent_ingest(backend, agencies, per_agency)) for agencies in AGENCIES]
+        print(f"{name:<8} " + " ".join(f"{rate:>16,.0f}" for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Bets of the agencies datasets in `.data`, for the benchmarks
+
+Reads `.data/agency-<n>.csv` if extracted, or straight from
+`.data/dataset.zip` otherwise.
+"""
+import csv
+import io
+import os
+import zipfile
+
+from common.utils import Bet
+
+
+DATASET_DIRPATH = os.path.join(os.path.dirname(__file__), '..', '..', '.data')
+DATASET_ZIP = 'dataset.zip'
+
+
+def agency_datasets() -> dict:
+    """
+    Bets of every agency in the datasets, by agency
+    """
+    files = {}
+    zip_path = os.path.join(DATASET_DIRPATH, DATASET_ZIP)
+    if os.path.exists(zip_path):
+        with zipfile.ZipFile(zip_path) as dataset:
+            for name in dataset.namelist():
+                files[name] = dataset.read(name).decode('utf-8')
+    for name in os.listdir(DATASET_DIRPATH):
+        if name.endswith('.csv'):
+            with open(os.path.join(DATASET_DIRPATH, name), encoding='utf-8') as file:
+                files[name] = file.read()
+
+    bets_by_agency = {}
+    for name, content in sorted(files.items()):
+        agency = int(name[len('agency-'):-len('.csv')])
+        bets_by_agency[agency] = [
+            Bet(str(agency), row[0], row[1], row[2], row[3], row[4])
+            for row in csv.reader(io.StringIO(content))
+        ]
+    return bets_by_agency
+
+
+def client_batches(bets: list, serialize, max_batch_size: int = 8000) -> list:
+    """
+    Splits the bets like the client does: as many as fit in max_batch_size
+    bytes once serialized
+    """
+    batches = []
+    batch = []
+    batch_size = 0
+    for bet in bets:
+        serialized = serialize(bet)
+        if batch and batch_size + len(serialized) > max_batch_size:
+            batches.append(batch)
+            batch = []
+            batch_size = 0
+        batch.append(bet)
+        batch_size += len(serialized)
+    if batch:
+        batches.append(batch)
+    return batches
@@ -0,0 +1,141 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from . import metrics
+from . import protocol
+
+
+""" Largest batch frame an agency may send, unless configured otherwise """
+DEFAULT_MAX_BATCH_BYTES = protocol.MAX_BATCH_FRAME_SIZE
+""" Bytes of batches received and not stored yet, across every agency """
+DEFAULT_MAX_BUFFERED_BYTES = 256 * 1024 * 1024
+""" Agencies whose batches are decoded at the same time """
+DEFAULT_MAX_DECODING = 4
+
+
+class IngestLimits:
+    """
+    How much an agency (and all of them together) may hold in memory
+
+    max_batch_bytes bounds a single frame, and what a compressed one
+    inflates to: a bigger one is a protocol error. max_buffered_bytes bounds
+    the batches read from the sockets that were not stored yet; once
+    reached, agencies are not read from until some of them are stored, so
+    their TCP windows close instead of the server growing. max_decoding
+    bounds the connections decoding a batch at once, as a decoded batch
+    takes several times its wire size.
+    """
+    __slots__ = ('max_batch_bytes', 'max_buffered_bytes', 'max_decoding')
+
+    def __init__(self, max_batch_bytes: int = DEFAULT_MAX_BATCH_BYTES,
+                 max_buffered_bytes: int = DEFAULT_MAX_BUFFERED_BYTES, max_decoding: int = DEFAULT_MAX_DECODING):
+        if not 0 < max_batch_bytes <= protocol.MAX_BATCH_FRAME_SIZE:
+            raise ValueError(f"max_batch_bytes must be between 1 and {protocol.MAX_BATCH_FRAME_SIZE}")
+        if max_buffered_bytes < max_batch_bytes:
+            raise ValueError("max_buffered_bytes must fit at least a batch of max_batch_bytes")
+        if max_decoding < 1:
+            raise ValueError("max_decoding must be at least 1")
+        self.max_batch_bytes = max_batch_bytes
+        self.max_buffered_bytes = max_buffered_bytes
+        self.max_decoding = max_decoding
+
+
+class IngestBudget:
+    """
+    Enforces IngestLimits across the connection threads of a `Server`
+
+    A connection reserves the size of a batch before reading it, and the
+    reservation is released once the batch was stored (and acked). Decoding
+    takes one of the max_decoding slots.
+    """
+    def __init__(self, limits: IngestLimits = None):
+        self.limits = limits if limits is not None else IngestLimits()
+        self._released = threading.Condition()
+        self._buffered = 0
+        self._closed = False
+        self._decoding = threading.BoundedSemaphore(self.limits.max_decoding)
+
+    @property
+    def buffered(self) -> int:
+        with self._released:
+            return self._buffered
+
+    def reserve(self, size: int, wait: bool = True) -> None:
+        """
+        Waits until size more bytes fit. Without wait they are taken anyway:
+        for the bytes a batch grows by once inflated, as waiting for them
+        while holding the compressed ones could starve every connection
+
+        Raises ConnectionAbortedError if the server closes meanwhile
+        """
+        with self._released:
+            if wait and not self._fits(size):
+                with metrics.INGEST_PAUSE_SECONDS.time():
+                    self._released.wait_for(lambda: self._closed or self._fits(size))
+            if self._closed:
+                raise ConnectionAbortedError("server is shutting down")
+            self._buffered += size
+        metrics.INGEST_BUFFERED_BYTES.inc(size)
+
+    def release(self, size: int) -> None:
+        with self._released:
+            self._buffered -= size
+            self._released.notify_all()
+        metrics.INGEST_BUFFERED_BYTES.dec(size)
+
+    @contextmanager
+    def decoding(self):
+        with self._decoding:
+            yield
+
+    def close(self) -> None:
+        """
+        Wakes up every connection waiting for a reservation
+        """
+        with self._released:
+            self._closed = True
+            self._released.notify_all()
+
+    def _fits(self, size: int) -> bool:
+        # A batch alone always fits, limits are checked so it is not bigger
+        return self._buffered == 0 or self._buffered + size <= self.limits.max_buffered_bytes
+
+
+class AsyncIngestBudget:
+    """
+    IngestBudget for the coroutines of an `AsyncServer`
+
+    Batches are decoded on the event loop, one at a time, so there are no
+    decoding slots. Must be created from the loop it is used on.
+    """
+    def __init__(self, limits: IngestLimits = None):
+        # Only the asyncio engine needs it, and it takes a while to import
+        import asyncio
+
+        self.limits = limits if limits is not None else IngestLimits()
+        # Set on every release, waiters check again whether they fit
+        self._released = asyncio.Event()
+        self._buffered = 0
+
+    @property
+    def buffered(self) -> int:
+        return self._buffered
+
+    async def reserve(self, size: int, wait: bool = True) -> None:
+        if wait and not self._fits(size):
+            started = time.perf_counter_ns()
+            while not self._fits(size):
+                self._released.clear()
+                await self._released.wait()
+            metrics.INGEST_PAUSE_SECONDS.record(time.perf_counter_ns() - started)
+        self._buffered += size
+        metrics.INGEST_BUFFERED_BYTES.inc(size)
+
+    def release(self, size: int) -> None:
+        self._buffered -= size
+        metrics.INGEST_BUFFERED_BYTES.dec(size)
+        self._released.set()
+
+    def _fits(self, size: int) -> bool:
+        return self._buffered == 0 or self._buffered + size <= self.limits.max_buffered_bytes
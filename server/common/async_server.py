@@ -0,0 +1,470 @@
+import asyncio
+import socket
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . utils import round_winner_number
+from . storage import CsvBetStore
+from . draw import draw
+from . batch import BATCH_DECODERS
+from . pipeline import DEFAULT_PIPELINE_WINDOW
+from . handshake import ConnectionOptions, negotiate, pipelined
+from . compression import BatchInflater, COMPRESSION_NONE, INFLATE_CHUNK_SIZE
+from . admission import AsyncIngestBudget, IngestLimits
+from . import metrics
+from . import profiling
+from . import protocol
+
+
+""" Most threads storing bets at the same time, see AsyncServer """
+MAX_STORE_THREADS = 32
+
+
+class AsyncServer:
+    """
+    Lottery server built on asyncio streams
+
+    Speaks the same protocol as `Server`, but every agency connection is
+    handled by a coroutine on a single event loop instead of a thread, so
+    thousands of agencies only cost a few KB each.
+    """
+    def __init__(self, port, listen_backlog, expected_clients: int, store=None, draw_workers: int = 1,
+                 pipeline_window: int = DEFAULT_PIPELINE_WINDOW, winner_number=round_winner_number,
+                 limits: IngestLimits = None, server_socket: socket.socket = None):
+        # Bind right away, like `Server` does, unless given a socket already
+        # listening. The loop adopts the socket on `run`
+        if server_socket is None:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind(('', port))
+            server_socket.listen(listen_backlog)
+        self._server_socket = server_socket
+
+        self._expected_clients = expected_clients
+
+        # Any of the storage.STORAGE_BACKENDS, or a storage.RoundedBetStore
+        self._store = store if store is not None else CsvBetStore()
+        # Round open for bets and how its winner number is chosen
+        self._round = getattr(self._store, 'round_id', 1)
+        self._winner_number = winner_number
+        # Processes drawing the winners, see draw.draw
+        self._draw_workers = draw_workers
+        # Most batches a pipelined agency may have in flight
+        self._pipeline_window = pipeline_window
+        # Memory the batches of every agency may take, see admission.IngestLimits
+        self._limits = limits if limits is not None else IngestLimits()
+        self._budget = None
+        # Storing bets is blocking file I/O, kept off the event loop. Writers
+        # lock what they share, so agencies store in parallel as far as the
+        # store allows (e.g. a sharded one, a segment each)
+        self._store_executor = ThreadPoolExecutor(max_workers=max(1, min(expected_clients, MAX_STORE_THREADS)))
+
+        self._writer_by_agency = {}
+        # Protocol version each agency negotiated, for its winners
+        self._version_by_agency = {}
+
+        # Rejected batches and connections dropped for breaking the protocol.
+        # Only touched from the event loop
+        self._failed_batches = 0
+        self._protocol_errors = 0
+
+        self._client_finished = 0
+        self._all_clients_finished = None
+        # Notified when a round is drawn
+        self._round_drawn = None
+
+        self._loop = None
+        self._main_task = None
+        self._server = None
+
+        self._killed = False
+
+    def finalize(self):
+        """
+        Graceful shutdown. Safe to call from a signal handler or any thread
+        """
+        self._killed = True
+        if self._loop is None:
+            self._server_socket.close()
+            return
+        self._loop.call_soon_threadsafe(self._shutdown)
+
+    def _shutdown(self):
+        if self._server is not None:
+            self._server.close()
+        for writer in self._writer_by_agency.values():
+            writer.close()
+        if self._main_task is not None:
+            self._main_task.cancel()
+
+    def run(self):
+        """
+        Server loop
+
+        Accepts agencies until all the expected ones finished sending their
+        bets, then runs the lottery and opens the next round
+        """
+        try:
+            asyncio.run(self._serve())
+        except asyncio.CancelledError:
+            # finalize() cancels the serving task
+            pass
+        finally:
+            self._loop = None
+            self._server_socket.close()
+            self._store_executor.shutdown()
+            self._store.close()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._main_task = asyncio.current_task()
+        # The signal may have arrived before the loop was running
+        if self._killed:
+            return
+
+        self._all_clients_finished = asyncio.Event()
+        self._round_drawn = asyncio.Condition()
+        self._budget = AsyncIngestBudget(self._limits)
+        self._server = await asyncio.start_server(
+            self._handle_client_connection, sock=self._server_socket
+        )
+        logging.info('action: accept_connections | result: in_progress')
+
+        while not self._killed:
+            try:
+                await self._handle_lottery()
+            except Exception as e:
+                # Like in Server.run, a round that cannot be drawn must not
+                # take the server down
+                logging.error(f'action: sorteo | result: fail | round: {self._round} | error: {e}')
+                await self._abort_round()
+
+    def failures(self) -> dict:
+        """
+        Batches rejected and agency connections dropped for breaking the
+        protocol, since the server started
+        """
+        return {'batches': self._failed_batches, 'connections': self._protocol_errors}
+
+    async def _receive_handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Returns the agency id and the ConnectionOptions agreed with it
+        """
+        client_id_header = await reader.readexactly(2)
+        handshake = protocol.DeserializeUInteger8(client_id_header[0:1])
+        # Unsigned, unlike DeserializeUInteger8
+        length_id = client_id_header[1]
+
+        try:
+            client_id = int(protocol.DeserializeString(await reader.readexactly(length_id)))
+        except ValueError as e:
+            raise protocol.ProtocolError(f"agency id is not an integer: {e}")
+        if handshake == protocol.HANDSHAKE_PIPELINED:
+            options, answer = pipelined((await reader.readexactly(1))[0], self._pipeline_window)
+        elif handshake == protocol.HANDSHAKE_OPTIONS:
+            amount_of_options = (await reader.readexactly(1))[0]
+            requested = protocol.DeserializeOptions(await reader.readexactly(2 * amount_of_options))
+            options, answer = negotiate(requested, self._pipeline_window, getattr(self._store, 'resumable', False))
+            if options.resume:
+                next_sequence = await self._loop.run_in_executor(self._store_executor, self._store.next_sequence, client_id)
+                answer += protocol.SerializeUInteger64(next_sequence)
+        else:
+            return client_id, ConnectionOptions()
+
+        writer.write(answer)
+        logging.info(f'action: handshake | result: success | client_id: {client_id} | '
+                     f'window: {options.window} | compression: {options.compression} | '
+                     f'version: {options.version} | resume: {options.resume}')
+        return client_id, options
+
+    async def _handle_client_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Reads the bets of an agency for as many rounds as it bets on
+
+        Each batch is acknowledged with a single byte once it was stored,
+        or by sequence number if the agency pipelines its batches.
+        The connection is kept open to send the winners of every round,
+        until the agency leaves
+        """
+        addr = writer.get_extra_info('peername')
+        logging.info(f'action: accept_connections | result: success | ip: {addr[0]}')
+        client_id = None
+        try:
+            client_id, options = await self._receive_handshake(reader, writer)
+            self._writer_by_agency[client_id] = writer
+            self._version_by_agency[client_id] = options.version
+
+            while not self._killed:
+                try:
+                    initial_type = await reader.readexactly(1)
+                except asyncio.IncompleteReadError:
+                    # Nothing else arriving before a round starts means the agency left
+                    logging.info(f'action: desconexion | result: success | client_id: {client_id}')
+                    break
+                initial_indicator = protocol.DeserializeUInteger8(initial_type)
+                await self._bet_on_round(reader, writer, client_id, options, initial_indicator)
+        except protocol.ProtocolError as e:
+            # Out of sync with the agency, only its connection is dropped
+            self._protocol_errors += 1
+            metrics.PROTOCOL_ERRORS.inc()
+            logging.error(f"action: protocol_error | result: fail | client_id: {client_id} | error: {e}")
+        except (asyncio.IncompleteReadError, OSError) as e:
+            logging.error(f"action: receive_message | result: fail | error: {e}")
+        finally:
+            # The agency may have connected again meanwhile
+            if client_id is not None and self._writer_by_agency.get(client_id) is writer:
+                del self._writer_by_agency[client_id]
+                self._version_by_agency.pop(client_id, None)
+            writer.close()
+
+    async def _bet_on_round(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client_id: int,
+                            options: ConnectionOptions, initial_indicator: int):
+        """
+        Receives the bets of the agency for the open round, then waits until
+        the round is drawn
+        """
+        round_id = self._round
+        bets_writer = self._store.writer(client_id)
+        decode = BATCH_DECODERS[options.version]
+        free_slots = asyncio.Semaphore(options.window) if options.window is not None else None
+        # Batches in flight are handed to the store threads in the order they were read
+        store_order = asyncio.Lock()
+        in_flight = []
+        try:
+            while True:
+                if initial_indicator is None:
+                    initial_type = await reader.readexactly(1)
+                    initial_indicator = protocol.DeserializeUInteger8(initial_type)
+                indicator, initial_indicator = initial_indicator, None
+                if indicator == protocol.BETS_END:
+                    logging.info(f'action: apuesta_finalizadas | result: success | status: finished ')
+                    break
+                if indicator == protocol.ROUND:
+                    # Answered after the acks of the batches before it, like queries
+                    await asyncio.gather(*in_flight)
+                    requested_round, _ = protocol.DeserializeUInteger64(await reader.readexactly(10))
+                    ack = protocol.ACK_OK if requested_round == round_id else protocol.ACK_FAIL
+                    writer.write(protocol.SerializeRoundAck(ack, round_id))
+                    await writer.drain()
+                    continue
+                if indicator == protocol.QUERY:
+                    # Answered after the acks of the batches before it
+                    await asyncio.gather(*in_flight)
+                    await self._answer_query(reader, writer, client_id, options)
+                    continue
+                if indicator not in protocol.BATCH_INDICATORS:
+                    raise protocol.ProtocolError(f"unknown message indicator {indicator}")
+
+                if free_slots is not None:
+                    sequence, _ = protocol.DeserializeUInteger64(await reader.readexactly(10))
+
+                initial_size = await reader.readexactly(10)
+                size = protocol.DeserializeBatchSize(initial_size, self._limits.max_batch_bytes)
+                # Indicator, sequence number if pipelined, length and the batch
+                metrics.BYTES_RECEIVED.inc(1 + (20 if free_slots is not None else 10) + size, client_id)
+
+                # Not read until it fits in memory, the agency waits in its TCP window
+                with profiling.phase('admission'):
+                    await self._budget.reserve(size)
+                reserved = size
+                try:
+                    if indicator == protocol.BETS_BATCH_COMPRESSED:
+                        with profiling.phase('inflate'):
+                            bets_batch_bytes = await self._inflate_batch(reader, size, client_id, options)
+                        if bets_batch_bytes is not None and len(bets_batch_bytes) > size:
+                            await self._budget.reserve(len(bets_batch_bytes) - size, wait=False)
+                            reserved = len(bets_batch_bytes)
+                    else:
+                        with profiling.phase('read_batch'):
+                            bets_batch_bytes = await reader.readexactly(size)
+                    if free_slots is not None:
+                        # Stored in order (see store_order), the next batch is
+                        # read meanwhile
+                        await free_slots.acquire()
+                        in_flight = [task for task in in_flight if not task.done()]
+                        in_flight.append(asyncio.ensure_future(
+                            self._store_and_ack(bets_writer, writer, decode, bets_batch_bytes, sequence, free_slots, client_id,
+                                                options.resume, reserved, store_order)
+                        ))
+                        reserved = 0
+                        continue
+                    try:
+                        if bets_batch_bytes is None:
+                            raise protocol.MalformedBatchError("unreadable batch")
+                        with metrics.BATCH_DECODE_SECONDS.time(), profiling.phase('decode'):
+                            bets = decode(bets_batch_bytes)
+                        await self._store_bets(bets_writer, bets)
+                        metrics.BETS_RECEIVED.inc(len(bets), client_id)
+                        logging.info(f'action: apuesta_recibida | result: success | cantidad: {len(bets)}')
+                        writer.write(protocol.ACK_OK)
+                    except Exception as e:
+                        self._failed_batches += 1
+                        metrics.FAILED_BATCHES.inc()
+                        logging.info(f'action: apuesta_recibida | result: fail | error: {e}')
+                        writer.write(protocol.ACK_FAIL)
+                finally:
+                    if reserved:
+                        self._budget.release(reserved)
+                await writer.drain()
+        finally:
+            await asyncio.gather(*in_flight)
+
+        self._client_finished += 1
+        if self._client_finished == self._expected_clients:
+            self._all_clients_finished.set()
+
+        # Whatever the agency sends next is for the next round
+        async with self._round_drawn:
+            await self._round_drawn.wait_for(lambda: self._round != round_id or self._killed)
+
+    async def _answer_query(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client_id: int,
+                            options: ConnectionOptions):
+        """
+        Reads a QUERY after its indicator and answers it, from the bets of
+        the agency only. Looked up by the store worker, after the batches
+        it was handed
+        """
+        # Imported by the first query, most servers never get one
+        from . query import answer_query
+
+        query = protocol.DeserializeUInteger8(await reader.readexactly(1))
+        argument = None
+        if query == protocol.QUERY_DOCUMENT:
+            # Type and length of the string
+            length = (await reader.readexactly(2))[1]
+            argument = protocol.DeserializeString(await reader.readexactly(length))
+        elif query == protocol.QUERY_NUMBER:
+            argument, _ = protocol.DeserializeUInteger64(await reader.readexactly(10))
+        answer = await self._loop.run_in_executor(self._store_executor, answer_query, self._store, client_id,
+                                                  query, argument)
+        logging.info(f'action: consulta | result: success | client_id: {client_id} | query: {query}')
+        writer.write(protocol.SerializeQueryAnswer(answer, options.version))
+        await writer.drain()
+
+    async def _inflate_batch(self, reader: asyncio.StreamReader, size: int, client_id: int,
+                             options: ConnectionOptions):
+        """
+        Reads a compressed batch in chunks, inflating each as it arrives.
+        Returns the plain batch, or None if it could not be inflated. Without
+        compression negotiated it is only read, to stay in sync
+        """
+        inflater = None
+        if options.compression != COMPRESSION_NONE:
+            inflater = BatchInflater(client_id, options.version, self._limits.max_batch_bytes)
+        remaining = size
+        while remaining > 0:
+            chunk_size = min(remaining, INFLATE_CHUNK_SIZE)
+            chunk = await reader.readexactly(chunk_size)
+            if inflater is not None:
+                inflater.feed(chunk)
+            remaining -= chunk_size
+        if inflater is None:
+            logging.error(f'action: apuesta_recibida | result: fail | client_id: {client_id} | error: compression was not negotiated')
+            return None
+        try:
+            return inflater.finish()
+        except protocol.MalformedBatchError as e:
+            logging.error(f'action: apuesta_recibida | result: fail | client_id: {client_id} | error: {e}')
+            return None
+
+    async def _store_and_ack(self, bets_writer, writer: asyncio.StreamWriter, decode, bets_batch_bytes: bytes,
+                             sequence: int, free_slots: asyncio.Semaphore, client_id: int, resume: bool = False,
+                             reserved: int = 0, store_order: asyncio.Lock = None):
+        try:
+            if bets_batch_bytes is None:
+                raise protocol.MalformedBatchError("unreadable batch")
+            with metrics.BATCH_DECODE_SECONDS.time(), profiling.phase('decode'):
+                bets = decode(bets_batch_bytes)
+            await self._store_bets(bets_writer, bets, sequence if resume else None, store_order)
+            metrics.BETS_RECEIVED.inc(len(bets), client_id)
+            logging.info(f'action: apuesta_recibida | result: success | cantidad: {len(bets)} | batch: {sequence}')
+            ack = protocol.ACK_OK
+        except Exception as e:
+            self._failed_batches += 1
+            metrics.FAILED_BATCHES.inc()
+            logging.info(f'action: apuesta_recibida | result: fail | batch: {sequence} | error: {e}')
+            ack = protocol.ACK_FAIL
+        finally:
+            free_slots.release()
+            self._budget.release(reserved)
+        writer.write(protocol.SerializeSequencedAck(ack, sequence))
+        await writer.drain()
+
+    async def _store_bets(self, bets_writer, bets, sequence: int = None, store_order: asyncio.Lock = None):
+        """
+        Stores bets off the event loop. Writers with a `submit` (see
+        write_behind.WriteBehindWriter) are only handed the batch by the
+        store thread, so batches of every agency share a group commit.
+
+        store_order is held while the batch is handed over: the batches of
+        a connection reach it in the order they were read, and waiters get
+        it in that order too
+        """
+        if store_order is None:
+            stored = await self._hand_over(bets_writer, bets, sequence)
+        else:
+            async with store_order:
+                stored = await self._hand_over(bets_writer, bets, sequence)
+        if hasattr(bets_writer, 'submit'):
+            return await asyncio.wrap_future(stored)
+        return stored
+
+    def _hand_over(self, bets_writer, bets, sequence: int):
+        hand_over = bets_writer.submit if hasattr(bets_writer, 'submit') else bets_writer.store
+        return self._loop.run_in_executor(self._store_executor, hand_over, bets, sequence)
+
+    def _draw(self, winner_number: int) -> dict:
+        winners_by_agency = {}
+        with metrics.DRAW_SECONDS.time(), profiling.phase('draw'):
+            winners = draw(self._store, self._draw_workers, winner_number)
+        for winner in winners:
+            winners_by_agency.setdefault(winner.agency, []).append(winner)
+        return winners_by_agency
+
+    async def _handle_lottery(self):
+        with profiling.phase('wait_agencies'):
+            await self._all_clients_finished.wait()
+
+        winners_by_agency = await self._loop.run_in_executor(
+            self._store_executor, self._draw, self._winner_number(self._round)
+        )
+        logging.info(f'action: sorteo | result: success | round: {self._round} | '
+                     f'cant_ganadores: {sum(len(winners) for winners in winners_by_agency.values())}')
+
+        # Every agency gets its winners at the same time, a slow one does not
+        # hold up the rest
+        writers = list(self._writer_by_agency.items())
+        for agency, writer in writers:
+            version = self._version_by_agency.get(agency, protocol.PROTOCOL_V1)
+            writer.writelines(protocol.WinnersFrames(winners_by_agency.get(agency, []), version))
+        with profiling.phase('send_winners'):
+            await asyncio.gather(*(self._drain_winners(writer) for _, writer in writers))
+
+        # Agencies stay connected for the next round
+        await self._start_round()
+
+    async def _abort_round(self):
+        """
+        Drops the agencies of a round that could not be drawn and opens the
+        next one. Left connected, they would wait for their winners forever
+        """
+        writers = list(self._writer_by_agency.values())
+        # Opened first, an agency that comes back right away can bet on it
+        await self._start_round()
+        for writer in writers:
+            writer.close()
+
+    async def _start_round(self):
+        if hasattr(self._store, 'start_round'):
+            await self._loop.run_in_executor(self._store_executor, self._store.start_round, self._round + 1)
+        async with self._round_drawn:
+            self._round += 1
+            self._client_finished = 0
+            self._all_clients_finished.clear()
+            self._round_drawn.notify_all()
+
+    async def _drain_winners(self, writer: asyncio.StreamWriter):
+        try:
+            await writer.drain()
+        except OSError as e:
+            logging.error(f"action: send_winners | result: fail | error: {e}")
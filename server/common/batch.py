@@ -0,0 +1,306 @@
+import datetime
+from array import array
+
+from . utils import Bet, StringColumn, _birthdate_isoformat
+from . import protocol
+
+
+class BetBatch:
+    """
+    Columnar view of a bets batch, as decoded by `decode_batch` or
+    `decode_batch_v2`
+
+    Agencies and numbers are integer arrays, every other field is a
+    `StringColumn` over the payload. Birthdates are a `StringColumn` in v1
+    and an array of ordinals in v2, which has them packed. `Bet` objects are
+    only built when a row is accessed. `offsets` holds where each serialized
+    bet starts, in the protocol `version` of `data`.
+    """
+    def __init__(self, data: bytes, version: int = protocol.PROTOCOL_V1):
+        self.data = data
+        self.version = version
+        self.offsets = array('I')
+        self.agencies = array('q')
+        self.numbers = array('q')
+        self.first_names = StringColumn(data)
+        self.last_names = StringColumn(data)
+        self.documents = StringColumn(data)
+        if version == protocol.PROTOCOL_V2:
+            self.birthdates = array('l')
+        else:
+            self.birthdates = StringColumn(data)
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def __getitem__(self, index: int) -> Bet:
+        if self.version == protocol.PROTOCOL_V2:
+            # Already parsed, no need to go through the isoformat
+            return Bet.from_values(
+                self.agencies[index],
+                self.first_names[index],
+                self.last_names[index],
+                self.documents[index],
+                _birthdate(self.birthdates[index]),
+                self.numbers[index],
+            )
+        return Bet(
+            self.agencies[index],
+            self.first_names[index],
+            self.last_names[index],
+            self.documents[index],
+            self.birthdates[index],
+            self.numbers[index],
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def rows(self):
+        """
+        Yields every bet as a tuple, in the bets storage column order
+        """
+        for index in range(len(self)):
+            yield (self.agencies[index], self.first_names[index], self.last_names[index],
+                   self.documents[index], self._birthdate(index), self.numbers[index])
+
+    def _birthdate(self, index: int) -> str:
+        if self.version == protocol.PROTOCOL_V2:
+            return _birthdate_isoformat(self.birthdates[index])
+        return self.birthdates[index]
+
+
+def decode_batch(bets_batch_bytes: bytes) -> BetBatch:
+    """
+    Decodes a whole bets batch in a single pass
+
+    The payload is copied once (frames from a `FrameReader` do not outlive the
+    next read), every field after that is just a pair of offsets. Strings
+    are checked to be UTF-8 and birthdates to be dates, so every stored bet
+    can be read back. Raises protocol.MalformedBatchError for a batch that
+    is not a run of whole valid bets.
+    """
+    data = bytes(bets_batch_bytes)
+    view = memoryview(data)
+    batch = BetBatch(data)
+
+    # Bound methods, looked up once for the whole batch
+    append_offset = batch.offsets.append
+    append_agency = batch.agencies.append
+    append_number = batch.numbers.append
+    string_columns = [
+        (batch.first_names.starts.append, batch.first_names.ends.append),
+        (batch.last_names.starts.append, batch.last_names.ends.append),
+        (batch.documents.starts.append, batch.documents.ends.append),
+    ]
+    strings = (batch.first_names, batch.last_names, batch.documents)
+    known_birthdates = _ordinal_by_raw_birthdate
+    append_birthdate_start = batch.birthdates.starts.append
+    append_birthdate_end = batch.birthdates.ends.append
+    from_bytes = int.from_bytes
+
+    # Every bet of a batch usually comes from the same agency
+    last_agency_raw = None
+    last_agency = 0
+
+    batch_len = len(data)
+    offset = 0
+    try:
+        while offset < batch_len:
+            append_offset(offset)
+            bet_end = offset + 2 + data[offset + 1]
+
+            agency_len = data[offset + 3]
+            offset += 4
+            agency_raw = data[offset:offset + agency_len]
+            if agency_raw != last_agency_raw:
+                last_agency = int(agency_raw)
+                last_agency_raw = agency_raw
+            append_agency(last_agency)
+            offset += agency_len
+
+            strings_start = offset
+            headers = 0
+            for append_start, append_end in string_columns:
+                headers |= data[offset] | data[offset + 1]
+                field_end = offset + 2 + data[offset + 1]
+                append_start(offset + 2)
+                append_end(field_end)
+                offset = field_end
+            if headers < 0x80:
+                # Raises UnicodeDecodeError, a ValueError, see _check_strings
+                str(view[strings_start:offset], 'utf-8')
+            else:
+                _check_strings(strings)
+
+            field_end = offset + 2 + data[offset + 1]
+            birthdate = data[offset + 2:field_end]
+            if birthdate not in known_birthdates:
+                _birthdate_ordinal(birthdate)
+            append_birthdate_start(offset + 2)
+            append_birthdate_end(field_end)
+            offset = field_end
+
+            if data[offset] != protocol.UINTEGER64 or data[offset + 1] != 8:
+                raise ValueError(f"bet number is not an uint64: type {data[offset]}, length {data[offset + 1]}")
+            if offset + 10 != bet_end or bet_end > batch_len:
+                raise ValueError(f"bet fields end at {offset + 10}, the bet at {bet_end}, the batch at {batch_len}")
+            append_number(from_bytes(data[offset + 2:offset + 10], 'big', signed=True))
+
+            offset = bet_end
+    except (IndexError, OverflowError, ValueError) as e:
+        raise protocol.MalformedBatchError(f"broken v1 bet: {e}") from e
+
+    return batch
+
+
+def _check_strings(columns) -> None:
+    """
+    Raises UnicodeDecodeError (a ValueError) unless the strings just appended
+    to the columns are UTF-8, one by one
+
+    The strings of a bet lie back to back, split by their type and length
+    bytes. The decoders check them all at once when those bytes are ASCII
+    (their or below 0x80), as then no sequence can run from a string into
+    the next, and only come here otherwise
+    """
+    for column in columns:
+        column.raw(-1).decode('utf-8')
+
+
+# Birthdates repeat a lot, their ordinals (by the v1 field or the packed v2
+# one) and dates are cached
+_ordinal_by_raw_birthdate = {}
+_ordinal_by_packed_birthdate = {}
+_date_by_ordinal = {}
+
+def _birthdate_ordinal(raw: bytes) -> int:
+    ordinal = _ordinal_by_raw_birthdate.get(raw)
+    if ordinal is None:
+        ordinal = datetime.date.fromisoformat(raw.decode('utf-8')).toordinal()
+        _ordinal_by_raw_birthdate[raw] = ordinal
+    return ordinal
+
+def _birthdate(ordinal: int) -> datetime.date:
+    birthdate = _date_by_ordinal.get(ordinal)
+    if birthdate is None:
+        birthdate = _date_by_ordinal[ordinal] = datetime.date.fromordinal(ordinal)
+    return birthdate
+
+def _packed_birthdate_ordinal(packed: bytes) -> int:
+    ordinal = _ordinal_by_packed_birthdate.get(packed)
+    if ordinal is None:
+        year = (packed[0] << 8) | packed[1]
+        ordinal = datetime.date(year, packed[2], packed[3]).toordinal()
+        _ordinal_by_packed_birthdate[packed] = ordinal
+    return ordinal
+
+
+# Bets are stored as v1 ones (see storage._encode_bets), whose length takes a
+# single byte. A v2 bet up to this long always fits: its v1 fields take at
+# most 41 bytes more (types and string lengths, up to 20 digits of agency and
+# 10 characters of birthdate, against at least 9 bytes of v2 varints and
+# packed birthdate)
+_V2_LENGTH_FITTING_V1 = 255 - 41
+
+def _check_v1_length(batch: BetBatch) -> None:
+    """
+    Raises ValueError unless the bet just appended to the v2 batch fits in a
+    v1 one (see protocol.SerializeBet)
+    """
+    length = 30 + len(str(batch.agencies[-1]))
+    for column in (batch.first_names, batch.last_names, batch.documents):
+        length += column.ends[-1] - column.starts[-1]
+    if length > 255:
+        raise ValueError(f"bet takes {length} bytes as v1, at most 255 can be stored")
+
+
+def decode_batch_v2(bets_batch_bytes: bytes) -> BetBatch:
+    """
+    `decode_batch` for a batch of protocol v2 bets (see protocol.SerializeBetV2)
+
+    Varints are read inline, with fast paths for the single byte ones (every
+    agency and string length) and the two bytes ones (most numbers). Strings
+    and birthdates are checked like in `decode_batch`. Bets that would not
+    fit in a v1 one, which is how they are stored, are rejected too.
+    """
+    data = bytes(bets_batch_bytes)
+    view = memoryview(data)
+    batch = BetBatch(data, protocol.PROTOCOL_V2)
+
+    append_offset = batch.offsets.append
+    append_agency = batch.agencies.append
+    append_number = batch.numbers.append
+    append_birthdate = batch.birthdates.append
+    string_columns = [
+        (batch.first_names.starts.append, batch.first_names.ends.append),
+        (batch.last_names.starts.append, batch.last_names.ends.append),
+        (batch.documents.starts.append, batch.documents.ends.append),
+    ]
+    strings = (batch.first_names, batch.last_names, batch.documents)
+    varint_at = protocol.DeserializeVarintAt
+
+    try:
+        batch_len = len(data)
+        offset = 0
+        while offset < batch_len:
+            append_offset(offset)
+            bet_len = (data[offset] << 8) | data[offset + 1]
+            bet_end = offset + 2 + bet_len
+            offset += 2
+
+            if data[offset] < 0x80:
+                append_agency(data[offset])
+                offset += 1
+            else:
+                agency, offset = varint_at(data, offset)
+                append_agency(agency)
+
+            strings_start = offset
+            lengths = 0
+            for append_start, append_end in string_columns:
+                field_len = data[offset]
+                lengths |= field_len
+                if field_len < 0x80:
+                    offset += 1
+                else:
+                    field_len, offset = varint_at(data, offset)
+                append_start(offset)
+                offset += field_len
+                append_end(offset)
+            if lengths < 0x80:
+                # Raises UnicodeDecodeError, a ValueError, see _check_strings
+                str(view[strings_start:offset], 'utf-8')
+            else:
+                _check_strings(strings)
+
+            append_birthdate(_packed_birthdate_ordinal(data[offset:offset + 4]))
+            offset += 4
+
+            byte = data[offset]
+            if byte < 0x80:
+                append_number(byte)
+                offset += 1
+            elif data[offset + 1] < 0x80:
+                append_number((byte & 0x7f) | (data[offset + 1] << 7))
+                offset += 2
+            else:
+                number, offset = varint_at(data, offset)
+                append_number(number)
+
+            if offset != bet_end:
+                raise ValueError(f"bet fields end at {offset}, the bet at {bet_end}")
+            if bet_len > _V2_LENGTH_FITTING_V1:
+                _check_v1_length(batch)
+    except (IndexError, OverflowError, ValueError) as e:
+        raise protocol.MalformedBatchError(f"broken v2 bet: {e}") from e
+
+    return batch
+
+
+""" Batch decoders by protocol version """
+BATCH_DECODERS = {
+    protocol.PROTOCOL_V1: decode_batch,
+    protocol.PROTOCOL_V2: decode_batch_v2,
+}
@@ -0,0 +1,126 @@
+import zlib
+
+from . import protocol
+
+
+""" Compression methods of a protocol.BETS_BATCH_COMPRESSED """
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_METHODS = {COMPRESSION_NONE, COMPRESSION_ZLIB}
+
+""" Compressed bytes inflated at a time """
+INFLATE_CHUNK_SIZE = 64 * 1024
+""" Largest batch a compressed frame may inflate to """
+MAX_INFLATED_BATCH_SIZE = 64 * 1024 * 1024
+
+
+class BatchInflater:
+    """
+    Inflates a compressed batch frame as its chunks arrive
+
+    Every bet gets its agency field back, so the result is a plain bets
+    batch (what `decode_batch` and the stores expect). A broken frame is
+    still fed whole, so the connection stays in sync; `finish` raises
+    protocol.MalformedBatchError for it. Bets are in the given protocol version, as they were
+    hoisted by `compress_batch`. It may not inflate beyond max_size bytes,
+    and never holds much more than that: a chunk is only inflated up to what
+    is left of it.
+    """
+    def __init__(self, agency: int, version: int = protocol.PROTOCOL_V1, max_size: int = MAX_INFLATED_BATCH_SIZE):
+        self._max_size = max_size
+        if version == protocol.PROTOCOL_V2:
+            self._agency_field = protocol.SerializeVarint(agency)
+            self._restore_agencies = self._restore_agencies_v2
+        else:
+            self._agency_field = protocol.SerializeString(str(agency))
+        self._decompressor = zlib.decompressobj()
+        # Inflated bytes of a bet that did not fully arrive yet
+        self._pending = bytearray()
+        self._batch = bytearray()
+        self._error = None
+
+    def feed(self, chunk) -> None:
+        if self._error is not None:
+            return
+        try:
+            while chunk:
+                # At least a byte, 0 would be no limit. One over max_size is enough to fail
+                room = max(1, self._max_size - len(self._batch) - len(self._pending))
+                self._pending += self._decompressor.decompress(chunk, room)
+                if len(self._batch) + len(self._pending) > self._max_size:
+                    raise ValueError(f"inflates to more than {self._max_size} bytes")
+                self._restore_agencies()
+                chunk = self._decompressor.unconsumed_tail
+        except (zlib.error, ValueError) as e:
+            self._error = e
+
+    def finish(self) -> bytes:
+        if self._error is None:
+            try:
+                self._pending += self._decompressor.flush()
+                self._restore_agencies()
+            except (zlib.error, ValueError) as e:
+                self._error = e
+        if self._error is None and (self._pending or not self._decompressor.eof):
+            self._error = ValueError("compressed batch ended in the middle of a bet")
+        if self._error is not None:
+            raise protocol.MalformedBatchError(f"broken compressed batch: {self._error}")
+        return bytes(self._batch)
+
+    def _restore_agencies(self) -> None:
+        pending = self._pending
+        batch = self._batch
+        agency_field = self._agency_field
+        agency_len = len(agency_field)
+
+        offset = 0
+        pending_len = len(pending)
+        while offset + 2 <= pending_len:
+            bet_end = offset + 2 + pending[offset + 1]
+            if bet_end > pending_len:
+                break
+            bet_len = pending[offset + 1] + agency_len
+            if bet_len > 255:
+                raise ValueError(f"bet of {bet_len} bytes with its agency")
+            batch.append(pending[offset])
+            batch.append(bet_len)
+            batch += agency_field
+            batch += pending[offset + 2:bet_end]
+            offset = bet_end
+        del pending[:offset]
+
+        if len(batch) > self._max_size:
+            raise ValueError(f"inflates to more than {self._max_size} bytes")
+
+    def _restore_agencies_v2(self) -> None:
+        pending = self._pending
+        batch = self._batch
+        agency_field = self._agency_field
+        agency_len = len(agency_field)
+
+        offset = 0
+        pending_len = len(pending)
+        while offset + 2 <= pending_len:
+            hoisted_len = (pending[offset] << 8) | pending[offset + 1]
+            bet_end = offset + 2 + hoisted_len
+            if bet_end > pending_len:
+                break
+            bet_len = hoisted_len + agency_len
+            if bet_len > 0xffff:
+                raise ValueError(f"bet of {bet_len} bytes with its agency")
+            batch += bet_len.to_bytes(2, byteorder='big')
+            batch += agency_field
+            batch += pending[offset + 2:bet_end]
+            offset = bet_end
+        del pending[:offset]
+
+        if len(batch) > self._max_size:
+            raise ValueError(f"inflates to more than {self._max_size} bytes")
+
+
+def compress_batch(bets, level: int = 6, version: int = protocol.PROTOCOL_V1) -> bytes:
+    """
+    Payload of a protocol.BETS_BATCH_COMPRESSED with the given bets, all
+    from the same agency
+    """
+    return zlib.compress(b''.join(protocol.SerializeHoistedBet(bet, version) for bet in bets), level)
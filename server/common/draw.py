@@ -0,0 +1,33 @@
+from itertools import repeat
+
+from . utils import BetTable, LOTTERY_WINNER_NUMBER
+from . storage import winners_in_partition
+
+
+def draw(store, workers: int = 1, winner_number: int = LOTTERY_WINNER_NUMBER) -> BetTable:
+    """
+    Winners of the lottery among the stored bets
+
+    With more than one worker the store is split in partitions (byte ranges
+    or shards) that are drawn in a process pool, merging the winners back in
+    store order. Stores without partitions, like the indexed one, already
+    draw with a lookup and are drawn in this process.
+    """
+    if workers <= 1 or not hasattr(store, 'partitions'):
+        return store.winners(winner_number)
+
+    partitions = store.partitions(workers)
+    winners = BetTable()
+    if not partitions:
+        return winners
+
+    # Only a parallel draw needs them, and they take a while to import
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # The server has threads running, forking it as is is not safe
+    context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+    with ProcessPoolExecutor(max_workers=min(workers, len(partitions)), mp_context=context) as executor:
+        for partition_winners in executor.map(winners_in_partition, partitions, repeat(winner_number)):
+            winners.extend(partition_winners)
+    return winners
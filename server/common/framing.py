@@ -0,0 +1,60 @@
+import socket
+
+""" Initial size of the receive buffer. The client sends batches of at most 8 kB """
+INITIAL_BUFFER_SIZE = 8 * 1024
+
+""" Most buffers a single sendmsg call takes (Linux UIO_MAXIOV) """
+MAX_SEND_BUFFERS = 1024
+
+
+class FrameReader:
+    """
+    Reads exact-size frames from a socket into a single reusable buffer
+
+    `read` returns a memoryview over the internal buffer, which is only valid
+    until the next call to `read`: decode it (or copy it) before reading again.
+    """
+    def __init__(self, skt: socket.socket, initial_size: int = INITIAL_BUFFER_SIZE):
+        self._skt = skt
+        self._buffer = bytearray(initial_size)
+        self._view = memoryview(self._buffer)
+
+    def read(self, size: int) -> memoryview:
+        if size > len(self._buffer):
+            # Views handed out before still point to the old buffer, so a new
+            # one is allocated instead of resizing in place
+            self._buffer = bytearray(max(size, 2 * len(self._buffer)))
+            self._view = memoryview(self._buffer)
+
+        frame = self._view[:size]
+        received_total = 0
+        while received_total < size:
+            received = self._skt.recv_into(frame[received_total:], size - received_total)
+            if received == 0:
+                raise ConnectionError(f"connection closed with {size - received_total} bytes left to read")
+            received_total += received
+
+        return frame
+
+
+def send_frames(skt: socket.socket, frames) -> None:
+    """
+    Sends every frame, in order, without joining them first
+
+    Uses vectored sends (sendmsg) where available and resumes after short
+    writes, so the whole message is always delivered or an OSError raised.
+    """
+    views = [memoryview(frame) for frame in frames if len(frame)]
+    if not hasattr(skt, 'sendmsg'):
+        skt.sendall(b''.join(views))
+        return
+
+    first = 0
+    while first < len(views):
+        sent = skt.sendmsg(views[first:first + MAX_SEND_BUFFERS])
+        # Skip the frames sent whole, the partially sent one is cut
+        while sent > 0 and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent > 0:
+            views[first] = views[first][sent:]
@@ -0,0 +1,62 @@
+from . compression import COMPRESSION_METHODS, COMPRESSION_NONE
+from . import protocol
+
+
+class ConnectionOptions:
+    """
+    What an agency and the server agreed on at the handshake
+
+    window is None for agencies that wait for every ack before sending the
+    next batch, see protocol.HANDSHAKE_PIPELINED. version is the encoding of
+    every bet the agency sends and receives, see protocol.PROTOCOL_VERSIONS.
+    resume is whether the sequence numbers of its batches are stored, see
+    protocol.OPTION_RESUME.
+    """
+    __slots__ = ('window', 'compression', 'version', 'resume')
+
+    def __init__(self, window: int = None, compression: int = COMPRESSION_NONE, version: int = protocol.PROTOCOL_V1,
+                 resume: bool = False):
+        self.window = window
+        self.compression = compression
+        self.version = version
+        self.resume = resume
+
+
+def negotiate(requested: list, max_window: int, resumable: bool = False) -> tuple:
+    """
+    Grants the (option, value) pairs of a protocol.HANDSHAKE_OPTIONS.
+    resumable is whether the storage keeps batch sequence numbers
+
+    Returns the agreed ConnectionOptions and the answer for the agency
+    """
+    options = ConnectionOptions()
+    granted = []
+    for option, value in requested:
+        if option == protocol.OPTION_WINDOW:
+            options.window = max(1, min(value, max_window))
+            value = options.window
+        elif option == protocol.OPTION_COMPRESSION:
+            if value not in COMPRESSION_METHODS:
+                value = COMPRESSION_NONE
+            options.compression = value
+        elif option == protocol.OPTION_VERSION:
+            # The newest version both ends know
+            options.version = max(protocol.PROTOCOL_V1, min(value, max(protocol.PROTOCOL_VERSIONS)))
+            value = options.version
+        elif option == protocol.OPTION_RESUME:
+            options.resume = resumable and value == 1
+        else:
+            value = 0
+        granted.append((option, value))
+    # Only sequenced batches can be resumed, and the window may come later
+    options.resume = options.resume and options.window is not None
+    granted = [(option, int(options.resume) if option == protocol.OPTION_RESUME else value) for option, value in granted]
+    return options, protocol.SerializeOptions(granted)
+
+
+def pipelined(requested_window: int, max_window: int) -> tuple:
+    """
+    Same as negotiate, for a protocol.HANDSHAKE_PIPELINED
+    """
+    options = ConnectionOptions(window=max(1, min(requested_window, max_window)))
+    return options, protocol.SerializeUInteger8(options.window)
@@ -0,0 +1,285 @@
+import mmap
+import os
+import struct
+import threading
+from array import array
+from contextlib import contextmanager
+
+from . utils import BetTable, LOTTERY_WINNER_NUMBER
+from . storage import to_little_endian, from_little_endian
+
+
+""" Winner index location. """
+INDEX_FILEPATH = "./bets.idx"
+
+
+class AppendOnlyIndex:
+    """
+    Base of the indexes persisted as an append-only file: FILE_MAGIC, then
+    one block per indexed batch with BLOCK_HEADER (agency, amount of bets)
+    and ENTRY_SIZE bytes per bet, little-endian columns
+
+    Opening only walks the block headers, for the amount of bets indexed
+    (and whatever _count_block keeps), and drops a block cut short by a
+    crash so new ones are not appended after it. The entries are read into
+    memory on the first lookup, see _load, so a restarted server is not
+    held up by an index it may not need for a while.
+    """
+    FILE_MAGIC = None
+    BLOCK_HEADER = struct.Struct('<II')
+    ENTRY_SIZE = None
+
+    def __init__(self, path: str):
+        self.path = path
+        self.size = 0
+        self._lock = threading.Lock()
+        # Whether the entries are in memory, adds only go to the file until then
+        self._loaded = False
+        end = self._count_blocks()
+        self._file = open(path, 'ab')
+        if end == 0:
+            self._file.write(self.FILE_MAGIC)
+            self._file.flush()
+        elif self._file.tell() > end:
+            self._file.truncate(end)
+
+    def sync(self) -> None:
+        with self._lock:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _count_blocks(self) -> int:
+        """
+        Counts the indexed bets from the block headers. Returns where the
+        last complete block ends, 0 for a new file
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return 0
+        end = len(self.FILE_MAGIC)
+        with self._mapped() as mapped:
+            for agency, count, _, block_end in self._blocks(mapped):
+                self.size += count
+                self._count_block(agency, count)
+                end = block_end
+        return end
+
+    def _load(self) -> None:
+        """
+        Reads the entries into memory, unless they already are. Called
+        holding the lock
+        """
+        if self._loaded:
+            return
+        self._reset()
+        self._file.flush()
+        with self._mapped() as mapped:
+            for agency, count, entries_start, block_end in self._blocks(mapped):
+                self._load_block(agency, count, mapped[entries_start:block_end])
+        self._loaded = True
+
+    def _write_block(self, agency: int, *columns: array) -> None:
+        """
+        Appends a block with the given columns of its entries. Called
+        holding the lock
+        """
+        count = len(columns[0])
+        self._file.write(self.BLOCK_HEADER.pack(agency, count))
+        for column in columns:
+            self._file.write(to_little_endian(column))
+        self.size += count
+        self._count_block(agency, count)
+
+    def _truncate(self) -> None:
+        """
+        Empties the file and the entries, for a rebuild. Called holding the
+        lock
+        """
+        self._file.close()
+        self._file = open(self.path, 'wb')
+        self._file.write(self.FILE_MAGIC)
+        self.size = 0
+        self._reset()
+        self._loaded = True
+
+    @contextmanager
+    def _mapped(self):
+        with open(self.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(self.FILE_MAGIC)] != self.FILE_MAGIC:
+                raise ValueError(f"{self.path} is not a {type(self).__name__} file")
+            yield mapped
+
+    def _blocks(self, mapped):
+        """
+        Yields (agency, amount of bets, entries start, block end) of every
+        complete block
+        """
+        position = len(self.FILE_MAGIC)
+        while position + self.BLOCK_HEADER.size <= len(mapped):
+            agency, count = self.BLOCK_HEADER.unpack_from(mapped, position)
+            block_end = position + self.BLOCK_HEADER.size + self.ENTRY_SIZE * count
+            if block_end > len(mapped):
+                # Partially written block, the store is the source of truth
+                return
+            yield agency, count, position + self.BLOCK_HEADER.size, block_end
+            position = block_end
+
+    def _count_block(self, agency: int, count: int) -> None:
+        """ Kept from the headers alone, e.g. the bets of every agency """
+
+    def _reset(self) -> None:
+        """ Empties the entries in memory """
+        raise NotImplementedError
+
+    def _load_block(self, agency: int, count: int, entries: bytes) -> None:
+        """ Adds the entries of a block read from the file to memory """
+        raise NotImplementedError
+
+
+class BetIndex(AppendOnlyIndex):
+    """
+    Positions of the stored bets, by bet number and agency
+
+    Every block holds the numbers as int64 and the positions as uint64, see
+    AppendOnlyIndex.
+    """
+    FILE_MAGIC = b'BETIDX\x00\x01'
+    ENTRY_SIZE = 16
+
+    def __init__(self, path: str = INDEX_FILEPATH):
+        # number -> agency -> positions, once loaded
+        self._positions = {}
+        super().__init__(path)
+
+    def add(self, agency: int, numbers, positions) -> None:
+        numbers = array('q', numbers)
+        positions = array('Q', positions)
+        with self._lock:
+            if self._loaded:
+                self._add(agency, numbers, positions)
+            self._write_block(agency, numbers, positions)
+            self._file.flush()
+
+    def positions(self, number: int) -> dict:
+        """
+        Positions of the bets with the given number, by agency
+        """
+        with self._lock:
+            self._load()
+            return {agency: array('Q', positions) for agency, positions in self._positions.get(number, {}).items()}
+
+    def rebuild(self, entries) -> None:
+        """
+        Replaces the index with the (agency, numbers, positions) entries, as
+        yielded by the stores index_entries
+        """
+        with self._lock:
+            self._truncate()
+            for agency, numbers, positions in entries:
+                numbers = array('q', numbers)
+                positions = array('Q', positions)
+                self._add(agency, numbers, positions)
+                self._write_block(agency, numbers, positions)
+            self._file.flush()
+
+    def _reset(self) -> None:
+        self._positions = {}
+
+    def _load_block(self, agency: int, count: int, entries: bytes) -> None:
+        numbers = from_little_endian('q', entries[:8 * count])
+        positions = from_little_endian('Q', entries[8 * count:])
+        self._add(agency, numbers, positions)
+
+    def _add(self, agency: int, numbers, positions) -> None:
+        for number, position in zip(numbers, positions):
+            by_agency = self._positions.get(number)
+            if by_agency is None:
+                by_agency = self._positions[number] = {}
+            agency_positions = by_agency.get(agency)
+            if agency_positions is None:
+                agency_positions = by_agency[agency] = array('Q')
+            agency_positions.append(position)
+
+
+class IndexingWriter:
+    """
+    Stores bets through a store writer and indexes where they were stored
+    """
+    def __init__(self, writer, index: BetIndex, agency: int):
+        self._writer = writer
+        self._index = index
+        self._agency = agency
+
+    def store(self, bets, sequence: int = None):
+        positions = self._writer.store(bets, sequence)
+        numbers = bets.numbers if hasattr(bets, 'numbers') else [bet.number for bet in bets]
+        self._index.add(self._agency, numbers, positions)
+        return positions
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class IndexedBetStore:
+    """
+    Wraps a binary or sharded store, indexing every batch as it is stored
+
+    The draw becomes a lookup of the winner number in the index, so the
+    winners are ready as soon as the last agency finishes. On startup the
+    persisted index is reloaded, or rebuilt from the store if they do not
+    match (e.g. the server died between storing a batch and indexing it).
+    """
+    # The wrapped store keeps the sequence numbers
+    resumable = True
+
+    def __init__(self, store, path: str = INDEX_FILEPATH):
+        if not hasattr(store, 'bets_at'):
+            raise ValueError("the winner index needs a binary or sharded storage")
+        self._store = store
+        self._index = BetIndex(path)
+        if self._index.size != store.count():
+            self._index.rebuild(store.index_entries())
+
+    def writer(self, agency: int) -> IndexingWriter:
+        return IndexingWriter(self._store.writer(agency), self._index, agency)
+
+    def store(self, bets, sequence: int = None) -> None:
+        # A decoded batch from a single agency is stored as is
+        if hasattr(bets, 'agencies') and len(set(bets.agencies)) == 1:
+            self.writer(bets.agencies[0]).store(bets, sequence)
+            return
+        bets_by_agency = {}
+        for bet in bets:
+            bets_by_agency.setdefault(bet.agency, []).append(bet)
+        for agency, agency_bets in bets_by_agency.items():
+            self.writer(agency).store(agency_bets, sequence if len(bets_by_agency) == 1 else None)
+
+    def next_sequence(self, agency: int) -> int:
+        return self._store.next_sequence(agency)
+
+    def load(self) -> BetTable:
+        return self._store.load()
+
+    def bets_at(self, agency: int, positions) -> list:
+        return self._store.bets_at(agency, positions)
+
+    def index_entries(self):
+        return self._store.index_entries()
+
+    def count(self) -> int:
+        return self._index.size
+
+    def winners(self, winner_number: int = LOTTERY_WINNER_NUMBER) -> BetTable:
+        winners = BetTable()
+        for agency, positions in sorted(self._index.positions(winner_number).items()):
+            winners.extend(self._store.bets_at(agency, positions))
+        return winners
+
+    def sync(self) -> None:
+        self._store.sync()
+        self._index.sync()
+
+    def close(self) -> None:
+        self._index.close()
+        self._store.close()
@@ -0,0 +1,41 @@
+import os
+import socket
+
+
+""" First descriptor passed by socket activation, see sd_listen_fds(3) """
+LISTEN_FDS_START = 3
+
+
+def activated_socket():
+    """
+    Listening socket inherited through socket activation, as systemd (or
+    systemd-socket-activate) passes it: LISTEN_PID is this process and
+    LISTEN_FDS at least 1. None if there is none
+
+    The variables are cleared so processes started later do not take the
+    socket for theirs
+    """
+    if os.environ.get('LISTEN_PID') != str(os.getpid()) or int(os.environ.get('LISTEN_FDS', '0')) < 1:
+        return None
+    for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+        os.environ.pop(name, None)
+    skt = socket.socket(fileno=LISTEN_FDS_START)
+    if skt.type != socket.SOCK_STREAM:
+        raise ValueError(f"socket activation passed a socket of type {skt.type}, a stream one is needed")
+    # The server accepts with blocking calls, whatever the manager set
+    skt.setblocking(True)
+    return skt
+
+
+def listening_socket(port: int, listen_backlog: int) -> socket.socket:
+    """
+    The activated socket if there is one, otherwise a new one listening on
+    the port
+    """
+    skt = activated_socket()
+    if skt is None:
+        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        skt.bind(('', port))
+        skt.listen(listen_backlog)
+    return skt
@@ -0,0 +1,211 @@
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by the value of a single label
+    """
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+        # label value -> count, None when unlabeled
+        self._values = {}
+
+    def inc(self, amount: int = 1, label_value=None) -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def value(self, label_value=None) -> int:
+        with self._lock:
+            return self._values.get(label_value, 0)
+
+    def expose(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: str(item[0]))
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        if not values and self.label is None:
+            values = [(None, 0)]
+        for label_value, count in values:
+            labels = '' if label_value is None else f'{{{self.label}="{label_value}"}}'
+            lines.append(f"{self.name}{labels} {count}")
+        return lines
+
+
+class Gauge:
+    """
+    Value that goes up and down, e.g. bytes held in memory
+    """
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: int = 1) -> None:
+        self.inc(-amount)
+
+    def value(self) -> int:
+        with self._lock:
+            return self._value
+
+    def expose(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.value()}"]
+
+
+class Histogram:
+    """
+    HDR-style histogram of non-negative integers (nanoseconds, bytes...)
+
+    Values below 2**sub_bucket_bits get a bucket each. Above that, every
+    power of two is split in 2**(sub_bucket_bits - 1) linear sub buckets, so
+    any value is kept within 1 / 2**(sub_bucket_bits - 1) of its magnitude
+    (3% for the default 6 bits) with a fixed amount of counters, whatever
+    the range. `scale` turns recorded values into exposed ones, e.g. 1e-9
+    to record nanoseconds and expose seconds.
+    """
+    def __init__(self, name: str, help: str, scale: float = 1.0, sub_bucket_bits: int = 6):
+        self.name = name
+        self.help = help
+        self.scale = scale
+        self._exact = 1 << sub_bucket_bits
+        self._half = 1 << (sub_bucket_bits - 1)
+        self._sub_bucket_bits = sub_bucket_bits
+        self._lock = threading.Lock()
+        # Up to 2**64 times the exact range
+        self._counts = array('Q', bytes(8 * (self._exact + 64 * self._half)))
+        self.count = 0
+        self.sum = 0
+
+    def record(self, value: int) -> None:
+        index = self._index(value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Records how long the block took, in nanoseconds
+        """
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter_ns() - start)
+
+    def quantile(self, quantile: float) -> float:
+        """
+        Upper bound of the bucket holding the given quantile, scaled. 0 for
+        an empty histogram
+        """
+        with self._lock:
+            target = quantile * self.count
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if count and seen >= target:
+                    return self._upper_bound(index) * self.scale
+        return 0.0
+
+    def expose(self) -> list:
+        """
+        A Prometheus histogram with a bucket per non-empty sub bucket
+        """
+        with self._lock:
+            buckets = [(index, count) for index, count in enumerate(self._counts) if count]
+            total, total_sum = self.count, self.sum
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for index, count in buckets:
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{self._upper_bound(index) * self.scale:.9g}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{self.name}_sum {total_sum * self.scale:.9g}")
+        lines.append(f"{self.name}_count {total}")
+        return lines
+
+    def _index(self, value: int) -> int:
+        if value < self._exact:
+            return max(value, 0)
+        shift = value.bit_length() - self._sub_bucket_bits
+        index = self._exact + ((shift - 1) << (self._sub_bucket_bits - 1)) + (value >> shift) - self._half
+        return min(index, len(self._counts) - 1)
+
+    def _upper_bound(self, index: int) -> int:
+        if index < self._exact:
+            return index
+        shift, sub_bucket = divmod(index - self._exact, self._half)
+        return ((sub_bucket + self._half + 1) << (shift + 1)) - 1
+
+
+class Registry:
+    """
+    Every metric of the process, in the order they were registered
+    """
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help: str, label: str = None) -> Counter:
+        counter = Counter(name, help, label)
+        self._metrics.append(counter)
+        return counter
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        gauge = Gauge(name, help)
+        self._metrics.append(gauge)
+        return gauge
+
+    def histogram(self, name: str, help: str, scale: float = 1.0) -> Histogram:
+        histogram = Histogram(name, help, scale)
+        self._metrics.append(histogram)
+        return histogram
+
+    def expose(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self._metrics:
+            lines += metric.expose()
+        return '\n'.join(lines) + '\n'
+
+
+""" Default registry, where the server metrics below live """
+REGISTRY = Registry()
+
+BETS_RECEIVED = REGISTRY.counter(
+    'lottery_bets_received_total', 'Bets stored, by agency', label='agency')
+BYTES_RECEIVED = REGISTRY.counter(
+    'lottery_bytes_received_total', 'Bytes of batch frames received, by agency', label='agency')
+FAILED_BATCHES = REGISTRY.counter(
+    'lottery_failed_batches_total', 'Batches acked as failed')
+PROTOCOL_ERRORS = REGISTRY.counter(
+    'lottery_protocol_errors_total', 'Agency connections dropped for breaking the protocol')
+BATCH_DECODE_SECONDS = REGISTRY.histogram(
+    'lottery_batch_decode_seconds', 'Time decoding a bets batch', scale=1e-9)
+STORE_LOCK_WAIT_SECONDS = REGISTRY.histogram(
+    'lottery_store_lock_wait_seconds', 'Time waiting for the storage lock to store a batch', scale=1e-9)
+STORE_SECONDS = REGISTRY.histogram(
+    'lottery_store_seconds', 'Time storing a batch, holding the storage lock', scale=1e-9)
+STORE_COMMIT_SECONDS = REGISTRY.histogram(
+    'lottery_store_commit_seconds', 'Time syncing a group of batches to the disk', scale=1e-9)
+STORE_COMMIT_BATCHES = REGISTRY.histogram(
+    'lottery_store_commit_batches', 'Batches made durable by a single sync')
+INGEST_BUFFERED_BYTES = REGISTRY.gauge(
+    'lottery_ingest_buffered_bytes', 'Bytes of batches received and not stored yet')
+INGEST_PAUSE_SECONDS = REGISTRY.histogram(
+    'lottery_ingest_pause_seconds', 'Time an agency was not read from, waiting for buffered batches to be stored', scale=1e-9)
+QUERY_SECONDS = REGISTRY.histogram(
+    'lottery_query_seconds', 'Time answering a query of an agency', scale=1e-9)
+DRAW_SECONDS = REGISTRY.histogram(
+    'lottery_draw_seconds', 'Time drawing the winners of a round', scale=1e-9)
@@ -0,0 +1,75 @@
+import os
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . metrics import REGISTRY, Registry
+
+
+""" Content type of the Prometheus text exposition format """
+EXPOSITION_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+""" Prefix of a METRICS_ADDRESS that is a UNIX socket path """
+UNIX_ADDRESS_PREFIX = "unix:"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        body = self.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', EXPOSITION_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+class MetricsServer:
+    """
+    Serves a registry over HTTP from a thread of its own
+
+    address is 'host:port' (port 0 picks a free one) or 'unix:<path>' for a
+    UNIX socket. Any GET gets the metrics, e.g.
+    `curl localhost:9100/metrics` or `curl --unix-socket <path> localhost/metrics`
+    """
+    def __init__(self, address: str, registry: Registry = REGISTRY):
+        handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+        self._path = None
+        if address.startswith(UNIX_ADDRESS_PREFIX):
+            self._path = address[len(UNIX_ADDRESS_PREFIX):]
+            # Left behind by a previous run
+            if os.path.exists(self._path):
+                os.remove(self._path)
+            self._server = _UnixHTTPServer(self._path, handler)
+        else:
+            host, port = address.rsplit(':', 1)
+            self._server = ThreadingHTTPServer((host, int(port)), handler)
+            self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
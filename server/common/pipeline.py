@@ -0,0 +1,140 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from contextlib import nullcontext
+
+from . batch import decode_batch
+from . import metrics
+from . import profiling
+from . import protocol
+
+
+""" Most batches an agency may have in flight, unless configured otherwise """
+DEFAULT_PIPELINE_WINDOW = 16
+
+
+class BatchPipeline:
+    """
+    Decodes, stores and acks the batches of a pipelined agency
+
+    The socket reading thread only submits frames, a thread of its own stores
+    them in order and another one sends each ack, with the batch sequence
+    number, once its batch is stored. The queue holds at most `window`
+    batches, which is what the agency may have in flight, so a reader that
+    gets ahead of the storage just blocks.
+
+    Writers with a `submit` (see write_behind.WriteBehindWriter) get every
+    batch as soon as it is decoded, so the batches in flight share a group
+    commit instead of waiting for one each. If `resume`, sequence numbers
+    are stored along with the batches, see protocol.OPTION_RESUME. With a
+    `budget` (admission.IngestBudget) batches are decoded in one of its
+    slots, and what was reserved for each is released once it is stored.
+    """
+    def __init__(self, bets_writer, send_ack, window: int, decode=decode_batch, agency: int = None,
+                 resume: bool = False, budget=None):
+        self._bets_writer = bets_writer
+        self._resume = resume
+        self._budget = budget
+        # Label of the bets in metrics.BETS_RECEIVED
+        self._agency = agency
+        # One of batch.BATCH_DECODERS, for the protocol version of the agency
+        self._decode = decode
+        # Called with (ack, sequence), see protocol.SerializeSequencedAck
+        self._send_ack = send_ack
+        self._batches = queue.Queue(maxsize=window)
+        # (sequence, amount of bets, future of the store, bytes reserved), in order
+        self._acks = queue.Queue()
+        # Batches acked as failed, final once close() returns
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+        self._ack_thread = threading.Thread(target=self._ack)
+        self._ack_thread.start()
+
+    def submit(self, sequence: int, bets_batch_bytes, reserved: int = 0) -> None:
+        """
+        bets_batch_bytes is None for a batch that could not be read, which
+        is acked as failed in its turn. reserved bytes of the budget are
+        released once it is stored
+        """
+        # Frames from a FrameReader do not outlive the next read
+        if bets_batch_bytes is not None:
+            bets_batch_bytes = bytes(bets_batch_bytes)
+        self._batches.put((sequence, bets_batch_bytes, reserved))
+
+    def drain(self) -> None:
+        """
+        Waits until every batch submitted so far was stored and acked, the
+        ack thread sends nothing else until more are submitted
+        """
+        drained = threading.Event()
+        self._batches.put(drained)
+        drained.wait()
+
+    def close(self) -> None:
+        """
+        Waits until every submitted batch was stored and acked
+        """
+        self._batches.put(None)
+        self._thread.join()
+        self._ack_thread.join()
+
+    def _run(self):
+        while True:
+            item = self._batches.get()
+            if item is None:
+                self._acks.put(None)
+                return
+            if isinstance(item, threading.Event):
+                # A drain, done once the batches before it are acked
+                self._acks.put(item)
+                continue
+            sequence, bets_batch_bytes, reserved = item
+            amount = 0
+            try:
+                if bets_batch_bytes is None:
+                    raise protocol.MalformedBatchError("unreadable batch")
+                decoding = self._budget.decoding() if self._budget is not None else nullcontext()
+                with decoding, metrics.BATCH_DECODE_SECONDS.time(), profiling.phase('decode'):
+                    bets = self._decode(bets_batch_bytes)
+                amount = len(bets)
+                stored = self._store(bets, sequence if self._resume else None)
+            except Exception as e:
+                stored = Future()
+                stored.set_exception(e)
+            self._acks.put((sequence, amount, stored, reserved))
+
+    def _store(self, bets, sequence: int = None) -> Future:
+        if hasattr(self._bets_writer, 'submit'):
+            return self._bets_writer.submit(bets, sequence)
+        stored = Future()
+        stored.set_result(self._bets_writer.store(bets, sequence))
+        return stored
+
+    def _ack(self):
+        while True:
+            item = self._acks.get()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            sequence, amount, stored, reserved = item
+            try:
+                stored.result()
+                metrics.BETS_RECEIVED.inc(amount, self._agency)
+                logging.info(f'action: apuesta_recibida | result: success | cantidad: {amount} | batch: {sequence}')
+                ack = protocol.ACK_OK
+            except Exception as e:
+                self.failed += 1
+                metrics.FAILED_BATCHES.inc()
+                logging.info(f'action: apuesta_recibida | result: fail | batch: {sequence} | error: {e}')
+                ack = protocol.ACK_FAIL
+            if reserved:
+                self._budget.release(reserved)
+            try:
+                self._send_ack(ack, sequence)
+            except OSError as e:
+                # The agency is gone, keep draining so close() returns
+                logging.error(f"action: send_ack | result: fail | batch: {sequence} | error: {e}")
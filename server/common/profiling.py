@@ -0,0 +1,201 @@
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+from . metrics import Histogram
+
+
+""" Profiles location, see profile_path """
+PROFILE_FILEPATH = "./profile.txt"
+""" How long a profiling window lasts unless it is ended earlier, in seconds """
+DEFAULT_WINDOW_SECONDS = 30
+""" Time between two samples of the stacks of every thread, in seconds """
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# Window being profiled, None while profiling is off. phase and record only
+# look it up, so that is all they cost until a window starts
+_window = None
+_UNTIMED = nullcontext()
+
+
+def phase(name: str):
+    """
+    Context manager timing the block as the given phase while a window is
+    profiled (see Profiler), and doing nothing otherwise
+    """
+    window = _window
+    if window is None:
+        return _UNTIMED
+    return window.phase(name).time()
+
+
+def record(name: str, nanoseconds: int) -> None:
+    """
+    Records a duration measured elsewhere as the given phase, while a window
+    is profiled
+    """
+    window = _window
+    if window is not None:
+        window.phase(name).record(nanoseconds)
+
+
+def profile_path(path: str, pid: int, started: float) -> str:
+    """
+    Where the profile of a window started at the given time (seconds since
+    the epoch) by the given process is written, e.g.
+    profile-4242-20240521T130455.120.txt
+    """
+    root, extension = os.path.splitext(path)
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.localtime(started))
+    return f"{root}-{pid}-{stamp}.{int(started % 1 * 1000):03d}{extension}"
+
+
+class _Window:
+    """
+    What is gathered while profiling: a histogram of nanoseconds per phase
+    and how many samples caught every stack
+    """
+    def __init__(self, path: str, seconds: float, interval: float):
+        self.path = path
+        self.seconds = seconds
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.samples = 0
+        self._lock = threading.Lock()
+        # phase name -> Histogram
+        self._phases = {}
+        # code objects of a stack, outermost first -> samples. Only the
+        # sampler thread touches it
+        self._stacks = {}
+
+    def phase(self, name: str) -> Histogram:
+        histogram = self._phases.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._phases.get(name)
+                if histogram is None:
+                    histogram = self._phases[name] = Histogram(name, name, scale=1e-9)
+        return histogram
+
+    def sample(self, sampler: int) -> None:
+        """
+        Takes the stack of every thread but the sampler one
+        """
+        for thread, frame in sys._current_frames().items():
+            if thread == sampler:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            self._stacks[stack] = self._stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def dump(self, elapsed: float) -> None:
+        """
+        Writes the phases, then the stacks folded as flamegraph.pl and
+        speedscope read them, one per line: its frames (file:function,
+        outermost first) joined by ';' and the samples that caught it.
+        Everything but the stacks starts with '#'
+        """
+        with self._lock:
+            phases = sorted(self._phases.items())
+        stacks = {}
+        for stack, samples in self._stacks.items():
+            folded = ';'.join(f"{os.path.basename(code.co_filename)}:{code.co_name}" for code in stack)
+            stacks[folded] = stacks.get(folded, 0) + samples
+
+        with open(self.path, 'w') as profile:
+            profile.write(f"# pid: {os.getpid()} | seconds: {elapsed:.3f} | samples: {self.samples} | "
+                          f"interval_ms: {self.interval * 1000:g}\n")
+            profile.write("# phase count total_ms mean_us p50_us p99_us\n")
+            for name, histogram in phases:
+                count, total = histogram.count, histogram.sum
+                if not count:
+                    # Still running when the window ended
+                    continue
+                profile.write(f"# {name} {count} {total / 1e6:.3f} {total / count / 1e3:.1f} "
+                              f"{histogram.quantile(0.5) * 1e6:.1f} {histogram.quantile(0.99) * 1e6:.1f}\n")
+            for folded, samples in sorted(stacks.items(), key=lambda item: -item[1]):
+                profile.write(f"{folded} {samples}\n")
+
+
+class Profiler:
+    """
+    Profiles the process for a window of time: the stack of every thread is
+    sampled every interval, and the phases the server times (see phase) are
+    gathered in histograms. When the window ends both are written to a file,
+    see profile_path and _Window.dump
+
+    Samples are wall clock, so threads waiting on a socket or a lock are
+    caught there too. Off, it only costs phase and record a global lookup.
+    One window at a time per process
+    """
+    def __init__(self, path: str = PROFILE_FILEPATH, seconds: float = DEFAULT_WINDOW_SECONDS,
+                 interval: float = DEFAULT_SAMPLE_INTERVAL):
+        self._path = path
+        self._seconds = seconds
+        self._interval = interval
+        self._window = None
+        self._sampler = None
+
+    def toggle(self) -> None:
+        """
+        Starts a window, or ends the running one early. Safe to call from a
+        signal handler
+        """
+        window = self._window
+        if window is None:
+            self.start()
+        else:
+            window.stopped.set()
+
+    def start(self, seconds: float = None) -> str:
+        """
+        Starts a window, unless one is running. Returns where it will be
+        written
+        """
+        global _window
+        if self._window is not None:
+            return self._window.path
+        started = time.time()
+        window = _Window(profile_path(self._path, os.getpid(), started), seconds or self._seconds, self._interval)
+        self._window = window
+        self._sampler = threading.Thread(target=self._run, args=(window,), name='profiler', daemon=True)
+        self._sampler.start()
+        _window = window
+        return window.path
+
+    def stop(self) -> str:
+        """
+        Ends the running window and waits until it is written. Returns where,
+        None if there was none
+        """
+        window, sampler = self._window, self._sampler
+        if window is None:
+            return None
+        window.stopped.set()
+        sampler.join()
+        return window.path
+
+    def _run(self, window: _Window):
+        global _window
+        logging.info(f'action: profile | result: in_progress | seconds: {window.seconds} | path: {window.path}')
+        sampler = threading.get_ident()
+        started = time.monotonic()
+        deadline = started + window.seconds
+        while not window.stopped.wait(window.interval):
+            window.sample(sampler)
+            if time.monotonic() >= deadline:
+                break
+        _window = None
+        try:
+            window.dump(time.monotonic() - started)
+            logging.info(f'action: profile | result: success | samples: {window.samples} | path: {window.path}')
+        except OSError as e:
+            logging.error(f'action: profile | result: fail | path: {window.path} | error: {e}')
+        self._window = None
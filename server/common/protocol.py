@@ -1,10 +1,107 @@
-import os
+from codecs import utf_8_decode as _utf8_decode
+
+from . utils import Bet
+
+
+class ProtocolError(ValueError):
+    """
+    Bytes from an agency that do not follow the protocol
+
+    Raised for broken frame headers, after which the connection is out of
+    sync and gets dropped. Only that agency is affected.
+    """
+
+class MalformedBatchError(ProtocolError):
+    """
+    A bets batch that was fully read but cannot be decoded. The connection
+    is still in sync, only the batch is rejected
+    """
+
+# Value types, first byte of every serialized value
+STRING = 0
+UINTEGER64 = 1
+
+# Message indicators, first byte of every message sent by an agency
+BET = 0
+BETS_BATCH = 1
+BETS_END = 2
+# Optional, before the batches of a round: ROUND and the uint64 round id the
+# agency is betting on. Answered by SerializeRoundAck
+ROUND = 3
+# Same as BETS_BATCH, but the bets are compressed with the method agreed at
+# the handshake, and left out their agency field (it is the agency's id)
+BETS_BATCH_COMPRESSED = 4
+# Optional, between the batches of a round: QUERY, 1 byte with one of QUERIES
+# and its argument, if any. Answered by SerializeQueryAnswer once every batch
+# sent before it was acked, so the answer counts them all. An agency only
+# gets its own bets
+QUERY = 5
+# Amount of bets of the agency stored for the round. No argument
+QUERY_COUNT = 0
+# Bets of the agency with a document, given as a serialized string
+QUERY_DOCUMENT = 1
+# Bets of the agency with a number, given as an uint64
+QUERY_NUMBER = 2
+QUERIES = {QUERY_COUNT, QUERY_DOCUMENT, QUERY_NUMBER}
+# Indicators followed by a batch frame
+BATCH_INDICATORS = {BETS_BATCH, BETS_BATCH_COMPRESSED}
+
+# Largest batch frame accepted. A bigger length is a broken header, not a
+# batch worth allocating for (the client sends 8 kB ones)
+MAX_BATCH_FRAME_SIZE = 64 * 1024 * 1024
+
+# Winners message indicator, sent by the server after the lottery
+WINNERS = 0
+# Query answer indicator, sent by the server after a QUERY
+QUERY_ANSWER = 1
+
+# Single byte answers to a bets batch
+ACK_OK = bytes([0])
+ACK_FAIL = bytes([1])
+
+# First byte of the handshake of an agency that pipelines its batches. A plain
+# handshake is just the serialized agency id, this one is sent as:
+# 1 byte HANDSHAKE_PIPELINED
+# 1 byte for the id length and the id
+# 1 byte with how many batches the agency wants in flight
+# The server answers with 1 byte: the window it grants, at least 1.
+# From then on every batch goes as BETS_BATCH, an uint64 sequence number, the
+# uint64 length and the bets, and is acked by SerializeSequencedAck
+HANDSHAKE_PIPELINED = 3
+
+# Handshake of an agency that negotiates options:
+# 1 byte HANDSHAKE_OPTIONS
+# 1 byte for the id length and the id
+# 1 byte with the amount of options, then every option as 1 byte for the
+# option and 1 byte for the value asked for
+# The server answers with the same options and the values it grants, see
+# handshake.negotiate. Options it does not know are granted 0
+HANDSHAKE_OPTIONS = 4
+# Batches in flight, like HANDSHAKE_PIPELINED. Not asking for it keeps one
+# byte acks without sequence numbers
+OPTION_WINDOW = 0
+# One of compression.COMPRESSION_METHODS, 0 for none
+OPTION_COMPRESSION = 1
+# One of PROTOCOL_VERSIONS, for the bets of the batches and of the winners
+OPTION_VERSION = 2
+# 1 to resume an upload. Only granted along with OPTION_WINDOW, and if the
+# storage keeps batch sequence numbers. Right after the options answer the
+# server then sends an uint64 with the sequence number to resume from: the
+# batches before it are durable. Sequence numbers of such an agency are the
+# position of each batch among its bets of the round, from 0
+OPTION_RESUME = 3
+
+# Bets encodings. v1 is SerializeBet, v2 is SerializeBetV2
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_VERSIONS = {PROTOCOL_V1, PROTOCOL_V2}
 
 # Received like so:
 # 1 byte for length
 # N bytes for data
+# Accepts any bytes-like object, memoryviews included
 def DeserializeString(bytes_string: bytes) -> str:
-    inner_string = bytes_string.decode()
+    inner_string = str(bytes_string, 'utf-8')
 
     return inner_string
 
@@ -20,17 +117,18 @@ def SerializeString(string: str) -> bytes:
     return package
 
 def DeserializeUInteger64(bytes_integer: bytes) -> tuple[int, bytes]:
+    if len(bytes_integer) < 10:
+        raise ProtocolError(f"uint64 of {len(bytes_integer)} bytes, 10 expected")
+
     integer_indicator = bytes_integer[0:1]
     integer_indicator_i = int.from_bytes(integer_indicator, byteorder='big', signed=True)
-    if integer_indicator_i != 1:
-        print(f"Tried to deserialize as uint64, non uint64 type {integer_indicator_i}")
-        os.abort()
+    if integer_indicator_i != UINTEGER64:
+        raise ProtocolError(f"tried to deserialize as uint64, non uint64 type {integer_indicator_i}")
 
     integer_len = bytes_integer[1:2]
     integer_len_i = int.from_bytes(integer_len, byteorder='big', signed=True)
     if integer_len_i != 8:
-        print(f"Tried to deserialize as uint64 that's longer than 8 bytes: {integer_len_i}")
-        os.abort()
+        raise ProtocolError(f"tried to deserialize as uint64 that's not 8 bytes long: {integer_len_i}")
 
     inner_int = int.from_bytes(bytes_integer[2: 2 + integer_len_i], byteorder='big', signed=True)
 
@@ -51,7 +149,239 @@ def SerializeUInteger64(integer: int) -> bytes:
 
     return package
 
+# Length of a batch frame, checked against max_size (the server may be
+# configured below MAX_BATCH_FRAME_SIZE, see admission.IngestLimits)
+def DeserializeBatchSize(bytes_integer: bytes, max_size: int = MAX_BATCH_FRAME_SIZE) -> int:
+    size, _ = DeserializeUInteger64(bytes_integer)
+    if size < 0 or size > max_size:
+        raise ProtocolError(f"batch frame of {size} bytes, at most {max_size} accepted")
+    return size
+
 def DeserializeUInteger8(bytes_integer: bytes) -> int:
     inner_int = int.from_bytes(bytes_integer, byteorder='big', signed=True)
 
     return inner_int
+
+def SerializeUInteger8(integer: int) -> bytes:
+    return integer.to_bytes(1, byteorder='big')
+
+# Options of a HANDSHAKE_OPTIONS, or its answer:
+# 1 byte with the amount of options
+# 1 byte for the option and 1 byte for its value, for every option
+def SerializeOptions(options: list) -> bytes:
+    return bytes([len(options)]) + b''.join(bytes([option, value]) for option, value in options)
+
+# The option and value pairs, without the amount of options
+def DeserializeOptions(bytes_options: bytes) -> list:
+    return [(bytes_options[i], bytes_options[i + 1]) for i in range(0, len(bytes_options), 2)]
+
+# A bet as sent in a BETS_BATCH_COMPRESSED, before compression: like
+# SerializeBet (or SerializeBetV2), but without the agency field
+def SerializeHoistedBet(bet: Bet, version: int = PROTOCOL_V1) -> bytes:
+    if version == PROTOCOL_V2:
+        serialized = SerializeBetV2(bet)
+        agency_len = len(SerializeVarint(bet.agency))
+        bet_len = int.from_bytes(serialized[0:2], byteorder='big') - agency_len
+        return bet_len.to_bytes(2, byteorder='big') + serialized[2 + agency_len:]
+    serialized = SerializeBet(bet)
+    agency_len = len(SerializeString(str(bet.agency)))
+    return bytes([serialized[0], serialized[1] - agency_len]) + serialized[2 + agency_len:]
+
+# Answer to a pipelined batch:
+# 1 byte with ACK_OK or ACK_FAIL
+# An uint64 with the sequence number of the batch
+def SerializeSequencedAck(ack: bytes, sequence: int) -> bytes:
+    return ack + SerializeUInteger64(sequence)
+
+# Answer to a ROUND message:
+# 1 byte, ACK_OK if it is the round open for bets, ACK_FAIL otherwise
+# An uint64 with the id of the round open for bets
+def SerializeRoundAck(ack: bytes, round_id: int) -> bytes:
+    return ack + SerializeUInteger64(round_id)
+
+# A Bet is serialized as the following:
+# 1 byte indicating that it's a bet
+# 1 byte for its length
+# All the fields, serialized with the functions above
+def SerializeBet(bet: Bet) -> bytes:
+    bet_id = SerializeString(str(bet.agency))
+    bet_name = SerializeString(str(bet.first_name))
+    bet_surname = SerializeString(str(bet.last_name))
+    bet_document = SerializeString(str(bet.document))
+    bet_birthday = SerializeString(str(bet.birthdate))
+    bet_amount = SerializeUInteger64(bet.number)
+
+    bet_data = bet_id + bet_name + bet_surname + bet_document + bet_birthday + bet_amount
+
+    header = SerializeUInteger8(BET) + SerializeUInteger8(len(bet_data))
+
+    package = header + bet_data
+
+    return package
+
+def DeserializeBet(serialized_bet: bytes) -> Bet:
+    bet, _ = DeserializeBetAt(memoryview(serialized_bet), 0)
+
+    return bet
+
+# Decodes the bet starting at offset, returning it with the offset of the
+# next one. Fields are decoded straight from the view: no slice of the
+# remaining bytes is ever copied
+def DeserializeBetAt(view: memoryview, offset: int) -> tuple[Bet, int]:
+    bet_end = offset + 2 + view[offset + 1]
+    offset += 2
+
+    fields = []
+    # agency, first name, last name, document and birthdate
+    for _ in range(5):
+        field_len = view[offset + 1]
+        fields.append(_utf8_decode(view[offset + 2:offset + 2 + field_len])[0])
+        offset += field_len + 2
+
+    if view[offset] != UINTEGER64 or view[offset + 1] != 8:
+        raise MalformedBatchError(f"bet number is not an uint64: type {view[offset]}, length {view[offset + 1]}")
+    if offset + 10 != bet_end or bet_end > len(view):
+        raise MalformedBatchError(f"bet fields end at {offset + 10}, the bet at {bet_end}, the batch at {len(view)}")
+    amount = int.from_bytes(view[offset + 2:offset + 10], byteorder='big', signed=True)
+
+    return Bet(*fields, amount), bet_end
+
+# Bet
+# Size
+# Datos
+def DeserializeBets(bet_batches: bytes) -> list[Bet]:
+    view = memoryview(bet_batches)
+    bets = []
+    batch_len = len(view)
+    current_byte = 0
+
+    try:
+        while current_byte < batch_len:
+            current_bet, current_byte = DeserializeBetAt(view, current_byte)
+            bets.append(current_bet)
+    except (IndexError, ValueError) as e:
+        raise MalformedBatchError(f"broken bet at byte {current_byte}: {e}") from e
+
+    return bets
+
+# Unsigned LEB128: 7 bits per byte, lowest first. Every byte but the last
+# has its high bit set
+def SerializeVarint(integer: int) -> bytes:
+    if integer < 0:
+        raise ValueError(f"varints are unsigned: {integer}")
+    varint = bytearray()
+    while integer >= 0x80:
+        varint.append((integer & 0x7f) | 0x80)
+        integer >>= 7
+    varint.append(integer)
+    return bytes(varint)
+
+# Returns the varint at offset and the offset after it
+def DeserializeVarintAt(view, offset: int) -> tuple[int, int]:
+    integer = 0
+    shift = 0
+    while True:
+        byte = view[offset]
+        offset += 1
+        integer |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return integer, offset
+        shift += 7
+        if shift > 63:
+            raise ProtocolError("varint longer than 64 bits")
+
+# A Bet is serialized in protocol v2 as the following:
+# 2 bytes for the length of the rest of the bet, big-endian
+# The agency, as a varint
+# First name, last name and document: each as a varint with its length and
+# its UTF-8 bytes
+# The birthdate in 4 bytes: 2 for the year, 1 for the month and 1 for the day
+# The number, as a varint
+def SerializeBetV2(bet: Bet) -> bytes:
+    fields = [SerializeVarint(bet.agency)]
+    for string in (bet.first_name, bet.last_name, bet.document):
+        str_bytes = str(string).encode('utf-8')
+        fields.append(SerializeVarint(len(str_bytes)))
+        fields.append(str_bytes)
+    birthdate = bet.birthdate
+    fields.append(bytes([birthdate.year >> 8, birthdate.year & 0xff, birthdate.month, birthdate.day]))
+    fields.append(SerializeVarint(bet.number))
+
+    bet_data = b''.join(fields)
+    return len(bet_data).to_bytes(2, byteorder='big') + bet_data
+
+def DeserializeBetV2At(view, offset: int) -> tuple[Bet, int]:
+    bet_end = offset + 2 + ((view[offset] << 8) | view[offset + 1])
+    agency, offset = DeserializeVarintAt(view, offset + 2)
+
+    fields = []
+    for _ in range(3):
+        field_len, offset = DeserializeVarintAt(view, offset)
+        fields.append(_utf8_decode(view[offset:offset + field_len])[0])
+        offset += field_len
+
+    year = (view[offset] << 8) | view[offset + 1]
+    birthdate = f'{year:04}-{view[offset + 2]:02}-{view[offset + 3]:02}'
+    number, offset = DeserializeVarintAt(view, offset + 4)
+    if offset != bet_end:
+        raise MalformedBatchError(f"bet fields end at {offset}, the bet at {bet_end}")
+
+    return Bet(agency, fields[0], fields[1], fields[2], birthdate, number), bet_end
+
+def DeserializeBetsV2(bet_batches: bytes) -> list[Bet]:
+    view = memoryview(bet_batches)
+    bets = []
+    batch_len = len(view)
+    current_byte = 0
+
+    try:
+        while current_byte < batch_len:
+            current_bet, current_byte = DeserializeBetV2At(view, current_byte)
+            bets.append(current_bet)
+    except (IndexError, ValueError) as e:
+        raise MalformedBatchError(f"broken bet at byte {current_byte}: {e}") from e
+
+    return bets
+
+# Bets codecs by protocol version: (serialize a bet, deserialize a batch)
+CODECS = {
+    PROTOCOL_V1: (SerializeBet, DeserializeBets),
+    PROTOCOL_V2: (SerializeBetV2, DeserializeBetsV2),
+}
+
+# Answer to a QUERY:
+# 1 byte indicating the query answer message
+# An uint64 with the length of the rest
+# For QUERY_COUNT an uint64 with the amount of bets, otherwise the bets found,
+# serialized in the protocol version of the agency
+def SerializeQueryAnswer(answer, version: int = PROTOCOL_V1) -> bytes:
+    if isinstance(answer, int):
+        data = SerializeUInteger64(answer)
+    else:
+        serialize_bet, _ = CODECS[version]
+        data = b''.join(serialize_bet(bet) for bet in answer)
+
+    return SerializeUInteger8(QUERY_ANSWER) + SerializeUInteger64(len(data)) + data
+
+# Winners are sent to each agency as:
+# 1 byte indicating the winners message
+# An uint64 with the length of the serialized bets
+# The serialized bets, in the protocol version of the agency
+def SerializeWinners(winners: list[Bet], version: int = PROTOCOL_V1) -> bytes:
+    return b''.join(WinnersFrames(winners, version))
+
+# Same message as SerializeWinners, as a list of buffers: the header and then
+# every serialized bet. The total length is known before anything is joined,
+# so the parts can go straight to a vectored send
+def WinnersFrames(winners: list[Bet], version: int = PROTOCOL_V1) -> list:
+    serialize_bet, _ = CODECS[version]
+    frames = [b'']
+    data_length = 0
+    for winner in winners:
+        serialized_bet = serialize_bet(winner)
+        data_length += len(serialized_bet)
+        frames.append(serialized_bet)
+
+    frames[0] = SerializeUInteger8(WINNERS) + SerializeUInteger64(data_length)
+
+    return frames
@@ -0,0 +1,281 @@
+import hashlib
+from array import array
+
+from . utils import BetTable
+from . storage import from_little_endian
+from . index import AppendOnlyIndex
+from . import metrics
+from . import protocol
+
+
+""" Query index location. """
+QUERY_INDEX_FILEPATH = "./bets.qidx"
+""" Buckets of the documents index, a power of two """
+DOCUMENT_BUCKETS = 1 << 16
+
+
+def document_key(agency: int, document: bytes) -> int:
+    """
+    64 bit key of a document of an agency, utf-8 encoded. Keys may collide,
+    lookups check the bets they lead to
+    """
+    digest = hashlib.blake2b(b'%d:%s' % (agency, document), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+class QueryIndex(AppendOnlyIndex):
+    """
+    Positions of the stored bets, by agency and document, and by agency and
+    number, along with the amount of bets of every agency
+
+    Documents are kept as document_key, in DOCUMENT_BUCKETS buckets of
+    (keys, positions) arrays, so a lookup only scans its bucket: about 150
+    entries with 10M bets, 24 bytes per bet in memory all indexes together.
+
+    Every block holds the numbers and the document keys as int64 and the
+    positions as uint64, see index.AppendOnlyIndex. Amounts of bets come
+    from the block headers, so they are known as soon as it is opened.
+    """
+    FILE_MAGIC = b'BETQRY\x00\x01'
+    ENTRY_SIZE = 24
+
+    def __init__(self, path: str = QUERY_INDEX_FILEPATH):
+        # agency -> amount of bets
+        self._counts = {}
+        # agency -> number -> positions, once loaded
+        self._numbers = {}
+        # key bucket -> (keys, positions), created on the first key
+        self._documents = None
+        super().__init__(path)
+
+    def add(self, agency: int, numbers, documents, positions) -> None:
+        """
+        documents are the utf-8 encoded ones, along with numbers and positions
+        """
+        numbers = array('q', numbers)
+        keys = array('q', (document_key(agency, document) for document in documents))
+        positions = array('Q', positions)
+        with self._lock:
+            if self._loaded:
+                self._add(agency, numbers, keys, positions)
+            self._write_block(agency, numbers, keys, positions)
+            self._file.flush()
+
+    def count(self, agency: int) -> int:
+        with self._lock:
+            return self._counts.get(agency, 0)
+
+    def number_positions(self, agency: int, number: int) -> array:
+        """
+        Positions of the bets of the agency with the given number
+        """
+        with self._lock:
+            self._load()
+            return array('Q', self._numbers.get(agency, {}).get(number, ()))
+
+    def document_positions(self, agency: int, document: bytes) -> array:
+        """
+        Positions of the bets of the agency whose document key matches, the
+        ones of a colliding document included
+        """
+        key = document_key(agency, document)
+        with self._lock:
+            self._load()
+            bucket = self._documents[key & (DOCUMENT_BUCKETS - 1)]
+            if bucket is None:
+                return array('Q')
+            keys, positions = bucket
+            return array('Q', (positions[i] for i, bucket_key in enumerate(keys) if bucket_key == key))
+
+    def rebuild(self, entries) -> None:
+        """
+        Replaces the index with the (agency, numbers, documents, positions)
+        entries, as yielded by query_entries
+        """
+        with self._lock:
+            self._truncate()
+            self._counts = {}
+            for agency, numbers, documents, positions in entries:
+                numbers = array('q', numbers)
+                keys = array('q', (document_key(agency, document) for document in documents))
+                positions = array('Q', positions)
+                self._add(agency, numbers, keys, positions)
+                self._write_block(agency, numbers, keys, positions)
+            self._file.flush()
+
+    def _count_block(self, agency: int, count: int) -> None:
+        self._counts[agency] = self._counts.get(agency, 0) + count
+
+    def _reset(self) -> None:
+        self._numbers = {}
+        self._documents = [None] * DOCUMENT_BUCKETS
+
+    def _load_block(self, agency: int, count: int, entries: bytes) -> None:
+        numbers = from_little_endian('q', entries[:8 * count])
+        keys = from_little_endian('q', entries[8 * count:16 * count])
+        positions = from_little_endian('Q', entries[16 * count:])
+        self._add(agency, numbers, keys, positions)
+
+    def _add(self, agency: int, numbers, keys, positions) -> None:
+        by_number = self._numbers.get(agency)
+        if by_number is None:
+            by_number = self._numbers[agency] = {}
+        buckets = self._documents
+        for number, key, position in zip(numbers, keys, positions):
+            number_positions = by_number.get(number)
+            if number_positions is None:
+                number_positions = by_number[number] = array('Q')
+            number_positions.append(position)
+
+            bucket = buckets[key & (DOCUMENT_BUCKETS - 1)]
+            if bucket is None:
+                bucket = buckets[key & (DOCUMENT_BUCKETS - 1)] = (array('q'), array('Q'))
+            bucket[0].append(key)
+            bucket[1].append(position)
+
+
+def query_entries(store):
+    """
+    Yields (agency, numbers, documents, positions) for every batch of a
+    binary or sharded store, as needed to rebuild a QueryIndex. Every bet is
+    decoded, only meant for the rare rebuild
+    """
+    for agency, numbers, positions in store.index_entries():
+        documents = [bet.document.encode('utf-8') for bet in store.bets_at(agency, positions)]
+        yield agency, numbers, documents, positions
+
+
+def _documents(bets) -> list:
+    if hasattr(bets, 'documents'):
+        return [bets.documents.raw(i) for i in range(len(bets))]
+    return [bet.document.encode('utf-8') for bet in bets]
+
+
+class QueryIndexingWriter:
+    """
+    Stores bets through a store writer and indexes them for queries
+    """
+    def __init__(self, writer, index: QueryIndex, agency: int):
+        self._writer = writer
+        self._index = index
+        self._agency = agency
+
+    def store(self, bets, sequence: int = None):
+        positions = self._writer.store(bets, sequence)
+        numbers = bets.numbers if hasattr(bets, 'numbers') else [bet.number for bet in bets]
+        self._index.add(self._agency, numbers, _documents(bets), positions)
+        return positions
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class QueryableBetStore:
+    """
+    Wraps a binary or sharded store (or an index.IndexedBetStore over one),
+    indexing every batch as it is stored, see QueryIndex
+
+    An agency then gets its amount of bets, or its bets with a document or a
+    number, without a scan of the store. Like the winner index, the
+    persisted index is reloaded on startup, or rebuilt from the store if
+    they do not match. Everything else goes to the wrapped store.
+    """
+    def __init__(self, store, path: str = QUERY_INDEX_FILEPATH):
+        if not hasattr(store, 'bets_at'):
+            raise ValueError("queries need a binary or sharded storage")
+        self._store = store
+        self._index = QueryIndex(path)
+        if self._index.size != store.count():
+            self._index.rebuild(query_entries(store))
+
+    def writer(self, agency: int) -> QueryIndexingWriter:
+        return QueryIndexingWriter(self._store.writer(agency), self._index, agency)
+
+    def store(self, bets, sequence: int = None) -> None:
+        # A decoded batch from a single agency is stored as is
+        if hasattr(bets, 'agencies') and len(set(bets.agencies)) == 1:
+            self.writer(bets.agencies[0]).store(bets, sequence)
+            return
+        bets_by_agency = {}
+        for bet in bets:
+            bets_by_agency.setdefault(bet.agency, []).append(bet)
+        for agency, agency_bets in bets_by_agency.items():
+            self.writer(agency).store(agency_bets, sequence if len(bets_by_agency) == 1 else None)
+
+    def count_bets(self, agency: int) -> int:
+        return self._index.count(agency)
+
+    def bets_with_document(self, agency: int, document: str) -> list:
+        positions = self._index.document_positions(agency, document.encode('utf-8'))
+        if not positions:
+            return []
+        return [bet for bet in self._store.bets_at(agency, positions) if bet.document == document]
+
+    def bets_with_number(self, agency: int, number: int) -> list:
+        positions = self._index.number_positions(agency, number)
+        if not positions:
+            return []
+        return self._store.bets_at(agency, positions)
+
+    def sync(self) -> None:
+        self._store.sync()
+        self._index.sync()
+
+    def close(self) -> None:
+        self._index.close()
+        self._store.close()
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+
+# Queries on any store: answered by a QueryableBetStore from its index, or
+# by a scan of the bets for any other one
+
+def count_bets(store, agency: int) -> int:
+    """
+    Amount of stored bets of the agency
+    """
+    with metrics.QUERY_SECONDS.time():
+        if hasattr(store, 'count_bets'):
+            return store.count_bets(agency)
+        return store.load().agencies.count(agency)
+
+
+def bets_with_document(store, agency: int, document: str) -> list:
+    """
+    Stored bets of the agency with the given document
+    """
+    with metrics.QUERY_SECONDS.time():
+        if hasattr(store, 'bets_with_document'):
+            return store.bets_with_document(agency, document)
+        return _scan(store.load(), agency, lambda table, i: table.documents[i] == document)
+
+
+def bets_with_number(store, agency: int, number: int) -> list:
+    """
+    Stored bets of the agency with the given number
+    """
+    with metrics.QUERY_SECONDS.time():
+        if hasattr(store, 'bets_with_number'):
+            return store.bets_with_number(agency, number)
+        return _scan(store.load(), agency, lambda table, i: table.numbers[i] == number)
+
+
+def _scan(table: BetTable, agency: int, matches) -> list:
+    return [table[i] for i in range(len(table)) if table.agencies[i] == agency and matches(table, i)]
+
+
+def answer_query(store, agency: int, query: int, argument=None):
+    """
+    Answer to a protocol.QUERY of the agency: the amount of bets for a
+    QUERY_COUNT, the bets found for the others. argument is the document or
+    the number looked up
+    """
+    if query == protocol.QUERY_COUNT:
+        return count_bets(store, agency)
+    if query == protocol.QUERY_DOCUMENT:
+        return bets_with_document(store, agency, argument)
+    if query == protocol.QUERY_NUMBER:
+        return bets_with_number(store, agency, argument)
+    raise protocol.ProtocolError(f"unknown query {query}")
@@ -3,48 +3,127 @@ import logging
 import threading
 import os
 
-from . utils import Bet, store_bets, load_bets, has_won
+from . utils import Bet, round_winner_number
+from . storage import CsvBetStore
+from . draw import draw
+from . framing import FrameReader, send_frames
+from . batch import BATCH_DECODERS
+from . pipeline import BatchPipeline, DEFAULT_PIPELINE_WINDOW
+from . handshake import ConnectionOptions, negotiate, pipelined
+from . compression import BatchInflater, COMPRESSION_NONE, INFLATE_CHUNK_SIZE
+from . admission import IngestBudget, IngestLimits
+from . import metrics
+from . import profiling
 from . import protocol
 
 
 class Server:
-    def __init__(self, port, listen_backlog, expected_clients: int):
-        # Initialize server socket
-        self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._server_socket.bind(('', port))
-        self._server_socket.listen(listen_backlog)
+    def __init__(self, port, listen_backlog, expected_clients: int, store=None, draw_workers: int = 1,
+                 pipeline_window: int = DEFAULT_PIPELINE_WINDOW, winner_number=round_winner_number,
+                 limits: IngestLimits = None, server_socket: socket.socket = None):
+        # Initialize server socket, unless given one already listening
+        # (see main and workers.MultiProcessServer)
+        if server_socket is None:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server_socket.bind(('', port))
+            server_socket.listen(listen_backlog)
+        self._server_socket = server_socket
 
         self._expected_clients = expected_clients
 
+        # Connected agencies, guarded by _client_finished_lock
         self._current_client = 0
 
-        self._store_bets_lock = threading.Lock()
+        # Any of the storage.STORAGE_BACKENDS, or a storage.RoundedBetStore to
+        # keep every round apart. Locking is up to the writers it hands out
+        self._store = store if store is not None else CsvBetStore()
+        # Whether agencies may resume their uploads, see protocol.OPTION_RESUME
+        self._resumable = getattr(self._store, 'resumable', False)
+        # Round open for bets and how its winner number is chosen
+        self._round = getattr(self._store, 'round_id', 1)
+        self._winner_number = winner_number
+        # Processes drawing the winners, see draw.draw
+        self._draw_workers = draw_workers
+        # Most batches a pipelined agency may have in flight
+        self._pipeline_window = pipeline_window
+        # Memory the batches of every agency may take, see admission.IngestLimits
+        self._budget = IngestBudget(limits)
 
         self._client_by_agente_lock = threading.Lock()
         self._client_by_agente = {}
+        # Protocol version each agency negotiated, for its winners
+        self._version_by_agente = {}
 
         self._client_threads = []
 
+        # Rejected batches and connections dropped for breaking the protocol
+        self._failures_lock = threading.Lock()
+        self._failed_batches = 0
+        self._protocol_errors = 0
+
+        # Guards the round state: connected and finished agencies, round id
         self._client_finished_lock = threading.Condition()
         self._client_finished = 0
 
         self._killed = False
 
     def finalize(self):
+        self._killed = True
+        # Closing alone does not wake up a thread blocked on accept
+        try:
+            self._server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._server_socket.close()
-        for id, client in self._client_by_agente.items():
+        self._budget.close()
+        with self._client_by_agente_lock:
+            clients = list(self._client_by_agente.values())
+        for client in clients:
             client.close()
-        self._killed = True
+        with self._client_finished_lock:
+            self._client_finished_lock.notify_all()
 
     def _receive_clients(self):
-        while self._current_client < self._expected_clients:
-            client_socket = self.__accept_new_connection()
+        """
+        Accepts agencies while less than the expected ones are connected
+
+        Agencies keep their connection across rounds, a new one is only
+        accepted once another leaves
+        """
+        while not self._killed:
+            with self._client_finished_lock:
+                while self._current_client >= self._expected_clients and not self._killed:
+                    self._client_finished_lock.wait()
+                if self._killed:
+                    return
+
+            try:
+                client_socket = self.__accept_new_connection()
+            except OSError:
+                # finalize closed the server socket
+                return
             client_thread = threading.Thread(target=self.__handle_client_connection, args=(client_socket,))
-            self._client_threads.append(client_thread)
-            self._current_client += 1
+            with self._client_finished_lock:
+                self._client_threads = [thread for thread in self._client_threads if thread.is_alive()]
+                self._client_threads.append(client_thread)
+                self._current_client += 1
             client_thread.start()
 
+    def failures(self) -> dict:
+        """
+        Batches rejected and agency connections dropped for breaking the
+        protocol, since the server started
+        """
+        with self._failures_lock:
+            return {'batches': self._failed_batches, 'connections': self._protocol_errors}
+
+    def _count_failures(self, batches: int = 0, connections: int = 0):
+        with self._failures_lock:
+            self._failed_batches += batches
+            self._protocol_errors += connections
+        metrics.PROTOCOL_ERRORS.inc(connections)
+
     def _lottery_is_callable(self) -> bool:
         return self._client_finished == self._expected_clients
 
@@ -52,52 +131,73 @@ class Server:
     def _handle_lottery(self):
         # Taken from: https://docs.python.org/3/library/threading.html#condition-objects
 
-        self._client_finished_lock.acquire()
-        while not self._lottery_is_callable():
-            # Wait releases the lock
-            self._client_finished_lock.wait()
-            # Once awakened, it re-acquires the lock
-        self._client_finished_lock.release()
-
-        bets = load_bets()
-        winners = []
-        for bet in bets:
-            if has_won(bet):
-                winners.append(bet)
-
-        winners_packages = self._serialize_winners(winners)
-        self._send_winners(winners_packages)
+        with profiling.phase('wait_agencies'):
+            self._client_finished_lock.acquire()
+            while not self._lottery_is_callable() and not self._killed:
+                # Wait releases the lock
+                self._client_finished_lock.wait()
+                # Once awakened, it re-acquires the lock
+            self._client_finished_lock.release()
+        if self._killed:
+            return
+
+        winner_number = self._winner_number(self._round)
+        with metrics.DRAW_SECONDS.time(), profiling.phase('draw'):
+            winners = draw(self._store, self._draw_workers, winner_number)
+        logging.info(f'action: sorteo | result: success | round: {self._round} | cant_ganadores: {len(winners)}')
+
+        with profiling.phase('serialize_winners'):
+            winners_packages = self._serialize_winners(winners)
+        with profiling.phase('send_winners'):
+            self._send_winners(winners_packages)
+
+        with profiling.phase('start_round'):
+            self._start_round(self._round + 1)
+
+    def _abort_round(self, round_id: int, agencies: list = None):
+        """
+        Drops the agencies of a round that could not be drawn (every one
+        connected, unless given) and opens the next one. Left connected, they
+        would wait for their winners forever
+        """
+        with self._client_by_agente_lock:
+            if agencies is None:
+                clients = list(self._client_by_agente.values())
+            else:
+                clients = [self._client_by_agente[agency] for agency in agencies if agency in self._client_by_agente]
+        # Opened first, an agency that comes back right away can bet on it
+        self._start_round(round_id + 1)
+        for client in clients:
+            # Their threads close them, once they see the next round
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
-        self._current_client = 0
+    def _start_round(self, round_id: int):
+        """
+        Opens the next round and wakes up the agencies waiting for it
+        """
+        if hasattr(self._store, 'start_round'):
+            self._store.start_round(round_id)
+        with self._client_finished_lock:
+            self._round = round_id
+            self._client_finished = 0
+            self._client_threads = [thread for thread in self._client_threads if thread.is_alive()]
+            self._client_finished_lock.notify_all()
 
     def _serialize_winners(self, winners: list) -> dict:
-        winners_serialized_by_agency = {}
+        winners_by_agency = {}
         for winner in winners:
-            if winners_serialized_by_agency.get(winner.agency) == None:
-                winners_serialized_by_agency[winner.agency] = []
-            winners_serialized_by_agency[winner.agency].append(self.__serialize_bet(winner))
-        # TODO: Serialize bets
-
-        packages_by_agency = {}
-        for agency, _ in winners_serialized_by_agency.items():
-            packages_by_agency[agency] = []
+            winners_by_agency.setdefault(winner.agency, []).append(winner)
 
-        header_i = 0
-        header = header_i.to_bytes(1, byteorder='big')
+        with self._client_by_agente_lock:
+            agencies = list(self._client_by_agente.keys())
+            versions = {agency: self._version_by_agente.get(agency, protocol.PROTOCOL_V1) for agency in agencies}
 
-        # for agency, winners in winners_serialized_by_agency.items():
-        for agency in self._client_by_agente.keys():
-            total_size = 0
-            data_part = b''
-            if winners_serialized_by_agency.get(agency) != None:
-                winners = winners_serialized_by_agency[agency]
-                for winner in winners:
-                    total_size += len(winner)
-                    data_part += winner
-
-            full_package = header + protocol.SerializeUInteger64(total_size) + data_part
-
-            packages_by_agency[agency] = full_package
+        packages_by_agency = {}
+        for agency in agencies:
+            packages_by_agency[agency] = protocol.WinnersFrames(winners_by_agency.get(agency, []), versions[agency])
 
         return packages_by_agency
 
@@ -110,40 +210,38 @@ class Server:
         finishes, servers starts to accept new connections again
         """
 
-        # TODO: Modify this program to handle signal to graceful shutdown
-        # the server
+        # Agencies are accepted from their own thread, they may come and go
+        # between rounds
+        acceptor = threading.Thread(target=self._receive_clients)
+        acceptor.start()
+
         # Despite only looping while this is alive, a signal could come at any time.
         # With that in mind, we must catch any potential OSError in here as well
         while not self._killed:
             try:
-                self._receive_clients()
                 self._handle_lottery()
-                for client in self._client_threads:
-                    client.join()
             except OSError as e:
                 # If we catch an error, then most probably we received a signal that closed our sockets
                 break
-
-    # Size: Amount of bytes to read
-    def __receive_bytes(self, size, skt: socket.socket) -> bytes:
-        buff: bytes  = b''
-        remaining_size = size
-        while remaining_size > 0:
-            # Received bytes
-            received = skt.recv(size)
-            buff = buff + received
-            remaining_size -= len(received)
-
-        return buff
+            except Exception as e:
+                # A round that cannot be drawn (e.g. a stored bet that cannot
+                # be read back) must not take the server down
+                logging.error(f'action: sorteo | result: fail | round: {self._round} | error: {e}')
+                self._abort_round(self._round)
+
+        acceptor.join()
+        with self._client_finished_lock:
+            clients = list(self._client_threads)
+        for client in clients:
+            client.join()
+        self._store.close()
 
     # Size: Amount of bytes to read
     def __send_bytes(self, data, client_index):
-        size = len(data)
-        remaining_size = size
-        while remaining_size > 0:
-            # Received bytes
-            sent_data = self._client_by_agente[client_index].send(data)
-            remaining_size -= sent_data
+        client_socket = self.__get_client_socket(client_index)
+        if client_socket is None:
+            raise ConnectionError(f"agency {client_index} is not connected")
+        send_frames(client_socket, [data])
 
     def __add_client_socket(self, client_id:int, skt: socket.socket):
         self._client_by_agente_lock.acquire(blocking=True, timeout=-1)
@@ -152,82 +250,292 @@ class Server:
 
         self._client_by_agente_lock.release()
 
-    def __get_client_socket(self, client_id:int) -> socket.socket:
-        self._client_by_agente_lock.acquire(blocking=True, timeout=-1)
-
-        client_skt = self._client_by_agente[client_id]
+    def __remove_client_socket(self, client_id: int, skt: socket.socket):
+        with self._client_by_agente_lock:
+            # The agency may have connected again meanwhile
+            if self._client_by_agente.get(client_id) is skt:
+                del self._client_by_agente[client_id]
+                self._version_by_agente.pop(client_id, None)
+        skt.close()
 
-        self._client_by_agente_lock.release()
+        with self._client_finished_lock:
+            self._current_client -= 1
+            self._client_finished_lock.notify_all()
 
-        return client_skt
+    def __get_client_socket(self, client_id:int) -> socket.socket:
+        """
+        None if the agency is not connected (anymore)
+        """
+        with self._client_by_agente_lock:
+            return self._client_by_agente.get(client_id)
 
 
     def __handle_client_connection(self, client_socket: socket.socket):
         """
         Read message from a specific client socket and closes the socket
 
-        If a problem arises in the communication with the client, the
-        client socket will also be closed
+        The agency may bet on as many rounds as it wants on the same
+        connection, the socket is closed once it leaves. If a problem arises
+        in the communication with the client, the client socket will also be
+        closed
         """
-        client_id_byte = self.__receive_bytes(2, client_socket)
-        length_id = protocol.DeserializeUInteger8(client_id_byte[1:2])
+        # Every frame is received into the same buffer. The views it returns
+        # are only valid until the next read
+        reader = FrameReader(client_socket)
+        client_id = None
+        try:
+            client_id_byte = reader.read(2)
+            handshake = protocol.DeserializeUInteger8(client_id_byte[0:1])
+            # Unsigned, unlike DeserializeUInteger8
+            length_id = client_id_byte[1]
 
-        client_id = self.__receive_bytes(length_id, client_socket)
-        client_id = int(protocol.DeserializeString(client_id))
-
-        self.__add_client_socket(client_id, client_socket)
-
-        while True:
             try:
-                # TODO: Modify the receive to avoid short-reads
-
-                # We start of reading two bytes to check how much we should read
-                # Primer byte indicador de apuestas
-                # Siguiente es un integer empaquetado:
-                # # 1 byte indicador
-                initial_type = self.__receive_bytes(1, client_socket)
-                initial_indicator = protocol.DeserializeUInteger8(initial_type)
-                if initial_indicator == 2:
-                    logging.info(f'action: apuesta_finalizadas | result: success | status: finished ')
+                client_id = int(protocol.DeserializeString(reader.read(length_id)))
+            except ValueError as e:
+                raise protocol.ProtocolError(f"agency id is not an integer: {e}")
+
+            self.__add_client_socket(client_id, client_socket)
+
+            options = ConnectionOptions()
+            with profiling.phase('handshake'):
+                if handshake == protocol.HANDSHAKE_PIPELINED:
+                    # Unsigned, unlike DeserializeUInteger8
+                    options, answer = pipelined(reader.read(1)[0], self._pipeline_window)
+                    self.__send_bytes(answer, client_id)
+                elif handshake == protocol.HANDSHAKE_OPTIONS:
+                    amount_of_options = reader.read(1)[0]
+                    requested = protocol.DeserializeOptions(reader.read(2 * amount_of_options))
+                    options, answer = negotiate(requested, self._pipeline_window, self._resumable)
+                    if options.resume:
+                        answer += protocol.SerializeUInteger64(self._store.next_sequence(client_id))
+                    self.__send_bytes(answer, client_id)
+            if handshake in (protocol.HANDSHAKE_PIPELINED, protocol.HANDSHAKE_OPTIONS):
+                logging.info(f'action: handshake | result: success | client_id: {client_id} | '
+                             f'window: {options.window} | compression: {options.compression} | '
+                             f'version: {options.version} | resume: {options.resume}')
+            with self._client_by_agente_lock:
+                self._version_by_agente[client_id] = options.version
+
+            while not self._killed:
+                # Nothing else arriving before a round starts means the agency left
+                try:
+                    initial_indicator = protocol.DeserializeUInteger8(reader.read(1))
+                except ConnectionError:
+                    logging.info(f'action: desconexion | result: success | client_id: {client_id}')
                     break
+                self.__bet_on_round(reader, client_id, options, initial_indicator)
+        except protocol.ProtocolError as e:
+            # Out of sync with the agency, only its connection is dropped
+            self._count_failures(connections=1)
+            logging.error(f"action: protocol_error | result: fail | client_id: {client_id} | error: {e}")
+        except OSError as e:
+            # The agency is gone (or finalize closed its socket), there is
+            # nothing left to read from it
+            logging.error(f"action: receive_message | result: fail | error: {e}")
+        finally:
+            if client_id is not None:
+                self.__remove_client_socket(client_id, client_socket)
+            else:
+                client_socket.close()
+                with self._client_finished_lock:
+                    self._current_client -= 1
+                    self._client_finished_lock.notify_all()
+
+    def __bet_on_round(self, reader: FrameReader, client_id: int, options: ConnectionOptions, initial_indicator: int):
+        """
+        Receives the bets of the agency for the open round, then waits until
+        the round is drawn
+        """
+        with self._client_finished_lock:
+            round_id = self._round
+        bets_writer = self._store.writer(client_id)
+
+        pipeline = None
+        if options.window is not None:
+            pipeline = BatchPipeline(
+                bets_writer,
+                lambda ack, sequence: self.__send_bytes(protocol.SerializeSequencedAck(ack, sequence), client_id),
+                options.window,
+                BATCH_DECODERS[options.version],
+                client_id,
+                options.resume,
+                self._budget,
+            )
+        try:
+            self.__receive_batches(reader, client_id, bets_writer, pipeline, options, round_id, initial_indicator)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+                self._count_failures(batches=pipeline.failed)
+
+        self._finish_agency(client_id, round_id)
+
+        with profiling.phase('wait_draw'):
+            self._client_finished_lock.acquire()
+            # Whatever the agency sends next is for the next round
+            while self._round == round_id and not self._killed:
+                self._client_finished_lock.wait()
+
+            self._client_finished_lock.release()
+
+    def _finish_agency(self, client_id: int, round_id: int):
+        """
+        Counts the agency as done with the round, its batches were all acked
+        """
+        with self._client_finished_lock:
+            self._client_finished += 1
+            # In theory, only one thread is waiting
+            self._client_finished_lock.notify_all()
 
-                # # 1 byte tipo
-                # # 1 byte longitud
-                # # 8 bytes datos
-                # 1 + 1 + 1 + 8 = 11
-                initial_size = self.__receive_bytes(10, client_socket)
+    def __receive_batches(self, reader: FrameReader, client_id: int, bets_writer, pipeline,
+                          options: ConnectionOptions, round_id: int, initial_indicator: int):
+        """
+        Reads batches until the agency sends the end indicator
 
-                size, rest_of_bytes = protocol.DeserializeUInteger64(initial_size)
-                if len(rest_of_bytes) != 0:
-                    print(f"Warning, remaining bytes: {len(rest_of_bytes)}")
+        Without a pipeline every batch is stored and acked before reading the
+        next one. With one, batches carry a sequence number and are handed
+        over to it, which stores and acks them. initial_indicator is the
+        first message indicator, already read
 
+        Broken frame headers raise protocol.ProtocolError and socket errors
+        OSError, both leave the connection. A batch that cannot be decoded
+        or stored is only acked as failed
+        """
+        while True:
+            # We start of reading two bytes to check how much we should read
+            # Primer byte indicador de apuestas
+            # Siguiente es un integer empaquetado:
+            # # 1 byte indicador
+            if initial_indicator is None:
+                initial_type = reader.read(1)
+                initial_indicator = protocol.DeserializeUInteger8(initial_type)
+            indicator, initial_indicator = initial_indicator, None
+            if indicator == protocol.BETS_END:
+                logging.info(f'action: apuesta_finalizadas | result: success | status: finished ')
+                break
+            if indicator == protocol.ROUND:
+                if pipeline is not None:
+                    # Otherwise the ack thread could be sending acks meanwhile
+                    pipeline.drain()
+                requested_round, _ = protocol.DeserializeUInteger64(reader.read(10))
+                ack = protocol.ACK_OK if requested_round == round_id else protocol.ACK_FAIL
+                self.__send_bytes(protocol.SerializeRoundAck(ack, round_id), client_id)
+                continue
+            if indicator == protocol.QUERY:
+                if pipeline is not None:
+                    # Answered after the acks of the batches before it
+                    pipeline.drain()
+                with profiling.phase('query'):
+                    self.__answer_query(reader, client_id, options)
+                continue
+            if indicator not in protocol.BATCH_INDICATORS:
+                raise protocol.ProtocolError(f"unknown message indicator {indicator}")
+
+            # # 1 byte tipo
+            # # 1 byte longitud
+            # # 8 bytes datos
+            # 1 + 1 + 1 + 8 = 11
+            initial_size = reader.read(10)
+
+            if pipeline is not None:
+                sequence, _ = protocol.DeserializeUInteger64(initial_size)
+                initial_size = reader.read(10)
+
+            size = protocol.DeserializeBatchSize(initial_size, self._budget.limits.max_batch_bytes)
+            # Indicator, sequence number if pipelined, length and the batch
+            metrics.BYTES_RECEIVED.inc(1 + (20 if pipeline is not None else 10) + size, client_id)
+
+            # Not read until it fits in memory, the agency waits in its TCP window
+            with profiling.phase('admission'):
+                self._budget.reserve(size)
+            reserved = size
+            try:
                 # Now, we read all that data
-                bets_batch_bytes = self.__receive_bytes(size, client_socket)
-                try:
-                    bets = self.__deserialize_batches(bets_batch_bytes)
-                    self._store_bets_lock.acquire()
-                    store_bets(bets)
-                    self._store_bets_lock.release()
-                    logging.info(f'action: apuesta_recibida | result: success | cantidad: {len(bets)}')
-                    ok = bytes(1)
-                    self.__send_bytes(ok, client_id)
-                except:
-                    logging.info(f'action: apuesta_recibida | result: fail')
-                    ok = bytes(2)
-                    self.__send_bytes(ok, client_id)
-
-            except OSError as e:
-                logging.error("action: receive_message | result: fail | error: {e}")
-
-        self._client_finished_lock.acquire()
-        self._client_finished += 1
-
-        # In theory, only one thread is waiting
-        self._client_finished_lock.notifyAll()
-
-        self._client_finished_lock.release()
-
-
+                if indicator == protocol.BETS_BATCH_COMPRESSED:
+                    with profiling.phase('inflate'):
+                        bets_batch_bytes = self.__inflate_batch(reader, size, client_id, options)
+                    if bets_batch_bytes is not None and len(bets_batch_bytes) > size:
+                        self._budget.reserve(len(bets_batch_bytes) - size, wait=False)
+                        reserved = len(bets_batch_bytes)
+                else:
+                    with profiling.phase('read_batch'):
+                        bets_batch_bytes = reader.read(size)
+                if pipeline is not None:
+                    # Released by the pipeline once the batch is stored
+                    pipeline.submit(sequence, bets_batch_bytes, reserved)
+                    reserved = 0
+                    continue
+                ack = self.__store_batch(bets_writer, bets_batch_bytes, client_id, options)
+            finally:
+                if reserved:
+                    self._budget.release(reserved)
+            with profiling.phase('ack'):
+                self.__send_bytes(ack, client_id)
+
+    def __answer_query(self, reader: FrameReader, client_id: int, options: ConnectionOptions):
+        """
+        Reads a QUERY after its indicator and answers it, from the bets of
+        the agency only
+        """
+        # Imported by the first query, most servers never get one
+        from . query import answer_query
+
+        query = protocol.DeserializeUInteger8(reader.read(1))
+        argument = None
+        if query == protocol.QUERY_DOCUMENT:
+            # Type and length of the string
+            length = reader.read(2)[1]
+            argument = protocol.DeserializeString(reader.read(length))
+        elif query == protocol.QUERY_NUMBER:
+            argument, _ = protocol.DeserializeUInteger64(reader.read(10))
+        answer = answer_query(self._store, client_id, query, argument)
+        logging.info(f'action: consulta | result: success | client_id: {client_id} | query: {query}')
+        self.__send_bytes(protocol.SerializeQueryAnswer(answer, options.version), client_id)
+
+    def __store_batch(self, bets_writer, bets_batch_bytes, client_id: int, options: ConnectionOptions) -> bytes:
+        """
+        Decodes and stores a batch. Returns its ack
+        """
+        try:
+            if bets_batch_bytes is None:
+                raise protocol.MalformedBatchError("unreadable batch")
+            with self._budget.decoding(), metrics.BATCH_DECODE_SECONDS.time(), profiling.phase('decode'):
+                bets = BATCH_DECODERS[options.version](bets_batch_bytes)
+            bets_writer.store(bets)
+            metrics.BETS_RECEIVED.inc(len(bets), client_id)
+            logging.info(f'action: apuesta_recibida | result: success | cantidad: {len(bets)}')
+            return protocol.ACK_OK
+        except Exception as e:
+            self._count_failures(batches=1)
+            metrics.FAILED_BATCHES.inc()
+            logging.info(f'action: apuesta_recibida | result: fail | error: {e}')
+            return protocol.ACK_FAIL
+
+
+    def __inflate_batch(self, reader: FrameReader, size: int, client_id: int, options: ConnectionOptions):
+        """
+        Reads a compressed batch in chunks, inflating each as it arrives.
+        Returns the plain batch, or None if it could not be inflated. Without
+        compression negotiated it is only read, to stay in sync
+        """
+        inflater = None
+        if options.compression != COMPRESSION_NONE:
+            inflater = BatchInflater(client_id, options.version, self._budget.limits.max_batch_bytes)
+        remaining = size
+        while remaining > 0:
+            chunk_size = min(remaining, INFLATE_CHUNK_SIZE)
+            chunk = reader.read(chunk_size)
+            if inflater is not None:
+                inflater.feed(chunk)
+            remaining -= chunk_size
+        if inflater is None:
+            logging.error(f'action: apuesta_recibida | result: fail | client_id: {client_id} | error: compression was not negotiated')
+            return None
+        try:
+            return inflater.finish()
+        except protocol.MalformedBatchError as e:
+            logging.error(f'action: apuesta_recibida | result: fail | client_id: {client_id} | error: {e}')
+            return None
 
     def __accept_new_connection(self) -> socket.socket:
         """
@@ -244,90 +552,30 @@ class Server:
 
         return client_skt
 
-    # Bet
-    # Size
-    # Datos
-    def __deserialize_batches(self, bet_batches: bytes) -> list[Bet]:
-        bets = []
-        batch_len = len(bet_batches)
-        current_byte = 0
-
-        while current_byte < batch_len:
-            bet_indicator = bet_batches[current_byte:current_byte + 1]
-
-            size_b = bet_batches[current_byte + 1:current_byte + 2]
-            size_i = int.from_bytes(size_b, byteorder='big', signed=True) # 1
-
-            current_bet = self.__deserialize_bet(bet_batches[current_byte:current_byte + size_i + 2])
-            bets.append(current_bet)
-            current_byte += size_i + 2
-
-        return bets
-
-    def __deserialize_bet(self, serialized_bet: bytes) -> Bet :
-        rest = serialized_bet
-
-        bet_indicator = rest[0:1]
-        bet_size_b = rest[1:2]
-        bet_size = int.from_bytes(bet_size_b, byteorder='big', signed=True) # 1
-        rest = rest[2:]
-
-        string_type = rest[0:1] # 0
-        name_len = rest[1:2]    # 1
-        name_len_i = int.from_bytes(name_len, byteorder='big', signed=True) # 1
-        agency = protocol.DeserializeString(rest[2: 2 + name_len_i])
-        rest = rest[name_len_i + 2:]
-
-        string_type = rest[0:1]
-        name_len = rest[1:2]
-        name_len_i = int.from_bytes(name_len, byteorder='big', signed=True)
-        first_name = protocol.DeserializeString(rest[2: 2 + name_len_i ])
-        rest = rest[name_len_i + 2:]
-
-        string_type = rest[0:1]
-        name_len = rest[1:2]
-        name_len_i = int.from_bytes(name_len, byteorder='big', signed=True)
-        last_name = protocol.DeserializeString(rest[2: 2 + name_len_i ])
-        rest = rest[name_len_i + 2:]
-
-        string_type = rest[0:1]
-        name_len = rest[1:2]
-        name_len_i = int.from_bytes(name_len, byteorder='big', signed=True)
-        document = protocol.DeserializeString(rest[2: 2 + name_len_i ])
-        rest = rest[name_len_i + 2:]
-
-        string_type = rest[0:1]
-        name_len = rest[1:2]
-        name_len_i = int.from_bytes(name_len, byteorder='big', signed=True)
-        birthday = protocol.DeserializeString(rest[2: 2 + name_len_i ])
-        rest = rest[name_len_i + 2:]
-
-        amount, rest = protocol.DeserializeUInteger64(rest)
-
-        return Bet(agency, first_name, last_name, document, birthday, amount)
-
-
-    def __serialize_bet(self, bet: Bet) -> bytes:
-        bet_id = protocol.SerializeString(str(bet.agency))
-        bet_name = protocol.SerializeString(str(bet.first_name))
-        bet_surname = protocol.SerializeString(str(bet.last_name))
-        bet_document = protocol.SerializeString(str(bet.document))
-        bet_birthday = protocol.SerializeString(str(bet.birthdate))
-        bet_amount = protocol.SerializeUInteger64(bet.number)
-
-        bet_data = bet_id + bet_name + bet_surname + bet_document + bet_birthday + bet_amount
-
-        bet_identifier_i = 0
-        bet_identifier = bet_identifier_i.to_bytes(1, byteorder='big')
-        length_i = len(bet_data)
-        length = length_i.to_bytes(1, byteorder='big')
-        header = bet_identifier + length
-
-        package = header + bet_data
-
-        return package
-
     def _send_winners(self, winners: dict):
-        for agency, package in winners.items():
-            # self.__send_bytes(package, agency - 1)
-            self._client_by_agente[agency].send(package)
+        """
+        Sends every agency its winners, each from its own thread
+
+        A slow agency (or one with a long winners list) does not hold up the
+        rest, the lottery ends once every agency got its whole message.
+        """
+        senders = [
+            threading.Thread(target=self.__send_agency_winners, args=(agency, frames))
+            for agency, frames in winners.items()
+        ]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+
+    def __send_agency_winners(self, agency: int, frames: list):
+        client_socket = self.__get_client_socket(agency)
+        if client_socket is None:
+            # Left after its winners were serialized
+            logging.error(f"action: send_winners | result: fail | agency: {agency} | error: disconnected")
+            return
+        try:
+            send_frames(client_socket, frames)
+            logging.info(f'action: send_winners | result: success | agency: {agency}')
+        except OSError as e:
+            logging.error(f"action: send_winners | result: fail | agency: {agency} | error: {e}")
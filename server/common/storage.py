@@ -0,0 +1,757 @@
+import csv
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from . utils import BetTable, winners_mask, write_bets, load_bets_table, STORAGE_FILEPATH, LOTTERY_WINNER_NUMBER
+from . batch import decode_batch
+from . import metrics
+from . import profiling
+from . import protocol
+
+
+""" Binary bets storage location. """
+BINARY_STORAGE_FILEPATH = "./bets.bin"
+""" Sharded bets storage location, one segment file per agency. """
+SHARDED_STORAGE_DIRPATH = "./bets"
+
+
+class LockedWriter:
+    """
+    What `writer` returns: stores bets of an agency into a store while
+    holding its lock
+
+    How long it waited for the lock and how long it held it are recorded in
+    metrics.STORE_LOCK_WAIT_SECONDS and metrics.STORE_SECONDS, and as the
+    store_lock_wait and store profiling phases.
+    """
+    def __init__(self, store, lock: threading.Lock, agency: int):
+        self._store = store
+        self._lock = lock
+        self._agency = agency
+
+    def store(self, bets, sequence: int = None):
+        waiting = time.perf_counter_ns()
+        with self._lock:
+            locked = time.perf_counter_ns()
+            stored = self._store.store(bets, sequence, self._agency)
+            unlocked = time.perf_counter_ns()
+        metrics.STORE_LOCK_WAIT_SECONDS.record(locked - waiting)
+        metrics.STORE_SECONDS.record(unlocked - locked)
+        profiling.record('store_lock_wait', locked - waiting)
+        profiling.record('store', unlocked - locked)
+        return stored
+
+    def close(self) -> None:
+        pass
+
+
+class CsvBetStore:
+    """
+    The original storage: one text row per bet in utils.STORAGE_FILEPATH
+
+    The file is opened for appending on the first store and kept open until
+    close. Every store is flushed, so readers see it, but only `sync` makes
+    it durable. Rows have no sequence numbers, so uploads can not be resumed,
+    but a row torn by a crash is dropped on open, unless opened read_only
+    (e.g. while another process appends to it).
+    """
+    # Bytes read at a time looking for the last whole row
+    RECOVERY_CHUNK_SIZE = 4096
+
+    def __init__(self, path: str = STORAGE_FILEPATH, read_only: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        if not read_only and os.path.exists(path):
+            self._recover()
+
+    def writer(self, agency: int) -> LockedWriter:
+        """
+        Every agency shares the same file and the same lock
+        """
+        return LockedWriter(self, self._lock, agency)
+
+    def store(self, bets, sequence: int = None, agency: int = None) -> None:
+        if self._file is None:
+            self._file = open(self.path, 'a+')
+        write_bets(self._file, bets)
+        self._file.flush()
+
+    def sync(self) -> None:
+        """
+        Flushes every stored bet to the disk
+        """
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def load(self) -> BetTable:
+        if not os.path.exists(self.path):
+            return BetTable()
+        return load_bets_table(self.path)
+
+    def winners(self, winner_number: int = LOTTERY_WINNER_NUMBER) -> BetTable:
+        bets = self.load()
+        return bets.select(winners_mask(bets, winner_number))
+
+    def partitions(self, amount: int) -> list:
+        """
+        Splits the file in amount byte ranges, to be drawn by winners_in_partition.
+        Each row belongs to the range where it starts
+        """
+        if not os.path.exists(self.path):
+            return []
+        size = os.path.getsize(self.path)
+        boundaries = [size * part // amount for part in range(amount + 1)]
+        return [("csv", self.path, start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _recover(self) -> None:
+        """
+        Truncates the file after its last newline
+        """
+        with open(self.path, 'r+b') as file:
+            size = file.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - self.RECOVERY_CHUNK_SIZE)
+                file.seek(start)
+                newline = file.read(end - start).rfind(b'\n')
+                if newline != -1:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                logging.warning(f'action: recover_storage | result: success | path: {self.path} | '
+                                f'dropped_bytes: {size - end}')
+                file.truncate(end)
+
+
+class BinaryBetStore:
+    """
+    Append-only log of bets batches
+
+    The file starts with FILE_MAGIC, followed by one record per stored batch:
+    - RECORD_HEADER: amount of bets, payload length, agency and sequence
+      number of the batch (-1 if it has none, see protocol.OPTION_RESUME),
+      and the CRC-32 of the rest of the record, this header included
+    - The bets numbers, as little-endian int64
+    - The offset of each bet inside the payload, as little-endian uint32
+    - The payload: the bets as serialized on the wire (protocol.SerializeBet)
+
+    Batches decoded from the wire are stored as received, without re-encoding.
+    The numbers column lets the draw scan the whole log at memcpy speed and
+    only decode the winners.
+
+    A single file handle is kept open for appending. `store` is not
+    thread-safe, writers returned by `writer` are. Opening the log for
+    appending drops a record torn by a crash, if any, so every record in
+    the log was stored whole. Opened read_only it is neither recovered nor
+    created, a missing log reads as empty.
+
+    Logs of the previous version (LEGACY_FILE_MAGIC, records without
+    agency, sequence nor checksum) can still be read, not appended to.
+    """
+    FILE_MAGIC = b'BETLOG\x00\x02'
+    RECORD_HEADER = struct.Struct('<IIIqI')
+    LEGACY_FILE_MAGIC = b'BETLOG\x00\x01'
+    LEGACY_RECORD_HEADER = struct.Struct('<II')
+    # Sequence numbers are kept, see next_sequence
+    resumable = True
+
+    def __init__(self, path: str = BINARY_STORAGE_FILEPATH, read_only: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        # agency -> sequence number after the last one stored
+        self._next_sequences = {}
+        if read_only:
+            return
+        if os.path.exists(path):
+            self._recover()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(self.FILE_MAGIC)
+            self._file.flush()
+
+    def writer(self, agency: int) -> LockedWriter:
+        """
+        Every agency shares the same file and the same lock
+        """
+        return LockedWriter(self, self._lock, agency)
+
+    def store(self, bets, sequence: int = None, agency: int = None) -> array:
+        """
+        Returns the position of every stored bet in the file, see bets_at.
+        sequence is the sequence number of the batch, if its agency resumes.
+        It is kept for the agency of the writer it came through: the batch
+        may be empty, or claim any agency. Stored without one, the batch
+        tells the agency
+        """
+        payload, numbers, offsets = _encode_bets(bets)
+        if agency is None and len(numbers) > 0:
+            agency = bets.agencies[0] if hasattr(bets, 'agencies') else bets[0].agency
+        if sequence is not None and agency is not None:
+            self._next_sequences[agency] = max(self._next_sequences.get(agency, 0), sequence + 1)
+        else:
+            agency = 0
+            sequence = -1
+        numbers = to_little_endian(numbers)
+        offsets = to_little_endian(offsets)
+        header = self.RECORD_HEADER.pack(len(numbers), len(payload), agency, sequence, 0)[:-4]
+        checksum = zlib.crc32(payload, zlib.crc32(offsets, zlib.crc32(numbers, zlib.crc32(header))))
+
+        record_start = self._file.tell()
+        self._file.write(header + checksum.to_bytes(4, byteorder='little'))
+        self._file.write(numbers)
+        self._file.write(offsets)
+        self._file.write(payload)
+        self._file.flush()
+
+        payload_start = record_start + self.RECORD_HEADER.size + 12 * len(numbers)
+        return array('Q', [payload_start + offset for offset in offsets])
+
+    def next_sequence(self, agency: int) -> int:
+        """
+        Sequence number the agency resumes its upload from: the one after
+        the last batch of it that was stored, 0 if none was
+        """
+        return self._next_sequences.get(agency, 0)
+
+    def sync(self) -> None:
+        """
+        Flushes every stored record to the disk
+        """
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def bets_at(self, agency: int, positions) -> list:
+        """
+        Decodes the bets stored at the given positions. The agency is ignored,
+        every agency shares the file
+        """
+        bets = []
+        with self._mapped() as mapped:
+            view = memoryview(mapped)
+            try:
+                for position in positions:
+                    bet, _ = protocol.DeserializeBetAt(view, position)
+                    bets.append(bet)
+            finally:
+                view.release()
+        return bets
+
+    def count(self) -> int:
+        """
+        Amount of stored bets, read from the records headers only
+        """
+        with self._mapped() as mapped:
+            return sum(count for count, _, _, _ in self._records(mapped))
+
+    def index_entries(self):
+        """
+        Yields (agency, numbers, positions) for every stored batch and agency
+        in it, as needed to rebuild an index.BetIndex
+        """
+        with self._mapped() as mapped:
+            for count, numbers_start, payload_start, _ in self._records(mapped):
+                numbers = from_little_endian('q', mapped[numbers_start:numbers_start + 8 * count])
+                offsets = from_little_endian('I', mapped[numbers_start + 8 * count:payload_start])
+
+                entries_by_agency = {}
+                for number, offset in zip(numbers, offsets):
+                    position = payload_start + offset
+                    # The agency is the first field of the bet, after the bet and field headers
+                    agency_len = mapped[position + 3]
+                    agency = int(mapped[position + 4:position + 4 + agency_len])
+                    agency_numbers, agency_positions = entries_by_agency.setdefault(agency, (array('q'), array('Q')))
+                    agency_numbers.append(number)
+                    agency_positions.append(position)
+
+                for agency, (agency_numbers, agency_positions) in entries_by_agency.items():
+                    yield agency, agency_numbers, agency_positions
+
+    def load(self) -> BetTable:
+        table = BetTable()
+        with self._mapped() as mapped:
+            for _, _, payload_start, payload_end in self._records(mapped):
+                table.extend(decode_batch(mapped[payload_start:payload_end]))
+        return table
+
+    def winners(self, winner_number: int = LOTTERY_WINNER_NUMBER, start: int = None, end: int = None) -> BetTable:
+        """
+        Only the numbers columns are scanned, winners are decoded from their offset.
+        start and end limit the scan to the records in that byte range, see partitions
+        """
+        winners = BetTable()
+        winner_number = to_little_endian(array('q', [winner_number])).tobytes()
+        with self._mapped() as mapped:
+            view = memoryview(mapped)
+            try:
+                for count, numbers_start, payload_start, _ in self._records(mapped, start, end):
+                    numbers_end = numbers_start + 8 * count
+                    # mmap.find searches in C without copying the column
+                    position = mapped.find(winner_number, numbers_start, numbers_end)
+                    while position != -1:
+                        if (position - numbers_start) % 8 == 0:
+                            index = (position - numbers_start) // 8
+                            offset, = struct.unpack_from('<I', mapped, numbers_end + 4 * index)
+                            bet, _ = protocol.DeserializeBetAt(view, payload_start + offset)
+                            winners.append(bet)
+                        position = mapped.find(winner_number, position + 1, numbers_end)
+            finally:
+                view.release()
+        return winners
+
+    @contextmanager
+    def _mapped(self):
+        if self._file is None and not os.path.exists(self.path):
+            # Read only, and nothing was stored yet
+            yield b''
+            return
+        with open(self.path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size <= len(self.FILE_MAGIC):
+                yield b''
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if mapped[:len(self.FILE_MAGIC)] not in (self.FILE_MAGIC, self.LEGACY_FILE_MAGIC):
+                    raise ValueError(f"{self.path} is not a bets log")
+                yield mapped
+
+    def _recover(self) -> None:
+        """
+        Truncates the log after its last whole record with a valid checksum,
+        and finds the next sequence number of every agency in it
+        """
+        with open(self.path, 'r+b') as file:
+            size = os.fstat(file.fileno()).st_size
+            magic = file.read(len(self.FILE_MAGIC))
+            if magic == self.LEGACY_FILE_MAGIC:
+                raise ValueError(f"{self.path} was written by an older version, it can only be read")
+            if magic != self.FILE_MAGIC and not (size < len(self.FILE_MAGIC) and self.FILE_MAGIC.startswith(magic)):
+                raise ValueError(f"{self.path} is not a bets log")
+
+            # A torn magic is dropped too, and written again on open
+            valid_end = 0
+            if size > len(self.FILE_MAGIC):
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    valid_end = self._scan_records(mapped)
+            elif size == len(self.FILE_MAGIC):
+                valid_end = size
+            if valid_end < size:
+                logging.warning(f'action: recover_storage | result: success | path: {self.path} | '
+                                f'dropped_bytes: {size - valid_end}')
+                file.truncate(valid_end)
+
+    def _scan_records(self, mapped) -> int:
+        """
+        Checks every record, recording their sequence numbers. Returns
+        where the valid ones end
+        """
+        view = memoryview(mapped)
+        header_size = self.RECORD_HEADER.size
+        position = len(self.FILE_MAGIC)
+        try:
+            while position + header_size <= len(mapped):
+                count, payload_len, agency, sequence, checksum = self.RECORD_HEADER.unpack_from(mapped, position)
+                record_end = position + header_size + 12 * count + payload_len
+                if record_end > len(mapped):
+                    break
+                computed = zlib.crc32(view[position + header_size:record_end],
+                                      zlib.crc32(view[position:position + header_size - 4]))
+                if computed != checksum:
+                    break
+                if sequence >= 0:
+                    self._next_sequences[agency] = max(self._next_sequences.get(agency, 0), sequence + 1)
+                position = record_end
+        finally:
+            view.release()
+        return position
+
+    def partitions(self, amount: int) -> list:
+        """
+        Splits the log in up to amount byte ranges of whole records, of
+        similar size, to be drawn by winners_in_partition
+        """
+        with self._mapped() as mapped:
+            size = len(mapped)
+            boundaries = [len(self.FILE_MAGIC)]
+            target = size / amount
+            for _, _, _, record_end in self._records(mapped):
+                if record_end - boundaries[-1] >= target:
+                    boundaries.append(record_end)
+            if boundaries[-1] < size:
+                boundaries.append(size)
+        return [("binary", self.path, start, end) for start, end in zip(boundaries, boundaries[1:])]
+
+    def _records(self, mapped, start: int = None, end: int = None):
+        """
+        Yields (amount of bets, numbers start, payload start, payload end) for
+        every stored batch. The offsets column follows the numbers one
+        """
+        header = self.RECORD_HEADER
+        if mapped[:len(self.FILE_MAGIC)] == self.LEGACY_FILE_MAGIC:
+            header = self.LEGACY_RECORD_HEADER
+        position = len(self.FILE_MAGIC) if start is None else start
+        end = len(mapped) if end is None else end
+        while position < end:
+            count, payload_len = header.unpack_from(mapped, position)[:2]
+            numbers_start = position + header.size
+            payload_start = numbers_start + 12 * count
+            position = payload_start + payload_len
+            yield count, numbers_start, payload_start, position
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+class ShardedBetStore:
+    """
+    One BinaryBetStore segment per agency, in SHARDED_STORAGE_DIRPATH
+
+    Each agency writes to its own file under its own lock, so connections
+    from different agencies never contend. Loading merges every segment,
+    ordered by agency, reading up to `readers` of them at the same time.
+    """
+    SEGMENT_PREFIX = "agency-"
+    SEGMENT_SUFFIX = ".bin"
+    # Sequence numbers are kept, see next_sequence
+    resumable = True
+
+    def __init__(self, path: str = SHARDED_STORAGE_DIRPATH, readers: int = 1, read_only: bool = False):
+        self.path = path
+        self._readers = readers
+        # Segments are opened read only, and none is created
+        self._read_only = read_only
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+
+        # Guards the dict only, never held while writing
+        self._segments_lock = threading.Lock()
+        self._segments = {}
+        # Whether the directory changed since the last sync
+        self._created_segments = False
+        for file_name in (os.listdir(path) if os.path.isdir(path) else ()):
+            if file_name.startswith(self.SEGMENT_PREFIX) and file_name.endswith(self.SEGMENT_SUFFIX):
+                agency = int(file_name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)])
+                self._segment(agency)
+
+    def writer(self, agency: int) -> LockedWriter:
+        """
+        Opens (once) the agency segment. Meant to be called once per connection
+        """
+        segment, lock = self._segment(agency)
+        return LockedWriter(segment, lock, agency)
+
+    def store(self, bets, sequence: int = None) -> None:
+        """
+        sequence is only kept for batches of a single agency
+        """
+        # A decoded batch from a single agency is stored as is
+        if hasattr(bets, 'agencies') and len(set(bets.agencies)) == 1:
+            self.writer(bets.agencies[0]).store(bets, sequence)
+            return
+        bets_by_agency = {}
+        for bet in bets:
+            bets_by_agency.setdefault(bet.agency, []).append(bet)
+        for agency, agency_bets in bets_by_agency.items():
+            self.writer(agency).store(agency_bets, sequence if len(bets_by_agency) == 1 else None)
+
+    def next_sequence(self, agency: int) -> int:
+        with self._segments_lock:
+            if agency not in self._segments:
+                return 0
+            segment, lock = self._segments[agency]
+        with lock:
+            return segment.next_sequence(agency)
+
+    def sync(self) -> None:
+        """
+        Flushes every segment to the disk, and the directory if a segment
+        was created since the last sync
+        """
+        with self._segments_lock:
+            segments = list(self._segments.values())
+            created, self._created_segments = self._created_segments, False
+        for segment, lock in segments:
+            with lock:
+                segment.sync()
+        if created:
+            directory = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+    def bets_at(self, agency: int, positions) -> list:
+        """
+        Decodes the bets stored at the given positions of the agency segment
+        """
+        segment, lock = self._segment(agency)
+        with lock:
+            return segment.bets_at(agency, positions)
+
+    def count(self) -> int:
+        return sum(self._map_segments(lambda segment: segment.count()))
+
+    def index_entries(self):
+        """
+        Yields (agency, numbers, positions) for every stored batch. The agency
+        is the segment one, which is where positions point to
+        """
+        with self._segments_lock:
+            segments = sorted(self._segments.items())
+        for agency, (segment, lock) in segments:
+            with lock:
+                entries = [(numbers, positions) for _, numbers, positions in segment.index_entries()]
+            for numbers, positions in entries:
+                yield agency, numbers, positions
+
+    def load(self) -> BetTable:
+        table = BetTable()
+        for segment_table in self._map_segments(lambda segment: segment.load()):
+            table.extend(segment_table)
+        return table
+
+    def winners(self, winner_number: int = LOTTERY_WINNER_NUMBER) -> BetTable:
+        winners = BetTable()
+        for segment_winners in self._map_segments(lambda segment: segment.winners(winner_number)):
+            winners.extend(segment_winners)
+        return winners
+
+    def partitions(self, amount: int) -> list:
+        """
+        Every segment is split in its share of amount partitions
+        """
+        with self._segments_lock:
+            segments = [self._segments[agency] for agency in sorted(self._segments)]
+        partitions = []
+        for segment, lock in segments:
+            with lock:
+                partitions += segment.partitions(max(1, -(-amount // len(segments))))
+        return partitions
+
+    def close(self) -> None:
+        with self._segments_lock:
+            for segment, _ in self._segments.values():
+                segment.close()
+            self._segments = {}
+
+    def _segment(self, agency: int) -> tuple:
+        with self._segments_lock:
+            if agency not in self._segments:
+                path = os.path.join(self.path, f"{self.SEGMENT_PREFIX}{agency}{self.SEGMENT_SUFFIX}")
+                self._segments[agency] = (BinaryBetStore(path, read_only=self._read_only), threading.Lock())
+                self._created_segments = True
+            return self._segments[agency]
+
+    def _map_segments(self, read) -> list:
+        """
+        Applies read to every segment, in agency order. Each segment is locked
+        while it is read, so no half written record is seen
+        """
+        with self._segments_lock:
+            segments = [self._segments[agency] for agency in sorted(self._segments)]
+
+        def read_segment(segment_and_lock):
+            segment, lock = segment_and_lock
+            with lock:
+                return read(segment)
+
+        if self._readers <= 1 or len(segments) <= 1:
+            return [read_segment(segment) for segment in segments]
+        with ThreadPoolExecutor(max_workers=self._readers) as executor:
+            return list(executor.map(read_segment, segments))
+
+
+""" Available storage backends, selected through STORAGE_BACKEND """
+STORAGE_BACKENDS = {
+    "csv": CsvBetStore,
+    "binary": BinaryBetStore,
+    "sharded": ShardedBetStore,
+}
+
+
+class RoundedBetStore:
+    """
+    Keeps the bets of every draw round in a segment of its own
+
+    open_segment(round_id) builds the store of a round (e.g. `create_store`
+    with that round). Everything but `start_round` goes to the segment of the
+    current round, so a draw only reads the bets of its round.
+    """
+    def __init__(self, open_segment, round_id: int = 1):
+        self._open_segment = open_segment
+        self.round_id = round_id
+        self._segment = open_segment(round_id)
+
+    def start_round(self, round_id: int) -> None:
+        """
+        Closes the segment of the previous round. Writers handed out before
+        must not be used after this
+        """
+        self._segment.close()
+        self.round_id = round_id
+        self._segment = self._open_segment(round_id)
+
+    def __getattr__(self, name):
+        return getattr(self._segment, name)
+
+
+class MergedBetStore:
+    """
+    Reads the stores of every ingest worker as a single one
+
+    What a draw needs, see draw.draw: bets and winners come in the order of
+    the stores, and each store is split in its share of the partitions.
+    """
+    def __init__(self, stores: list):
+        self._stores = stores
+        # Stores without partitions, like the indexed one, draw with a lookup
+        if all(hasattr(store, 'partitions') for store in stores):
+            self.partitions = self._partitions
+
+    def load(self) -> BetTable:
+        table = BetTable()
+        for store in self._stores:
+            table.extend(store.load())
+        return table
+
+    def winners(self, winner_number: int = LOTTERY_WINNER_NUMBER) -> BetTable:
+        winners = BetTable()
+        for store in self._stores:
+            winners.extend(store.winners(winner_number))
+        return winners
+
+    def _partitions(self, amount: int) -> list:
+        partitions = []
+        for store in self._stores:
+            partitions += store.partitions(max(1, -(-amount // len(self._stores))))
+        return partitions
+
+    def close(self) -> None:
+        for store in self._stores:
+            store.close()
+
+
+def round_path(path: str, round_id: int) -> str:
+    """
+    Where a round segment of the storage at path lives. The first round keeps
+    path, e.g. bets.csv, bets.round-2.csv, bets.round-3.csv...
+    """
+    if round_id == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.round-{round_id}{extension}"
+
+
+def worker_path(path: str, worker: int) -> str:
+    """
+    Where the storage at path of an ingest worker process lives, see
+    workers.MultiProcessServer. The first worker keeps path, e.g. bets.csv,
+    bets.worker-1.csv, bets.worker-2.csv...
+    """
+    if worker == 0:
+        return path
+    root, extension = os.path.splitext(path)
+    return f"{root}.worker-{worker}{extension}"
+
+
+def create_store(backend: str, readers: int = 1, round_id: int = 1, worker: int = 0, read_only: bool = False):
+    """
+    Builds one of the STORAGE_BACKENDS, for the given draw round and ingest
+    worker. readers only applies to the sharded one. read_only stores can
+    be opened while another process appends to them, see the stores
+    """
+    if backend == "sharded":
+        return ShardedBetStore(round_path(worker_path(SHARDED_STORAGE_DIRPATH, worker), round_id), readers=readers,
+                               read_only=read_only)
+    if backend == "binary":
+        return BinaryBetStore(round_path(worker_path(BINARY_STORAGE_FILEPATH, worker), round_id), read_only=read_only)
+    return CsvBetStore(round_path(worker_path(STORAGE_FILEPATH, worker), round_id), read_only=read_only)
+
+
+def winners_in_partition(partition: tuple, winner_number: int = LOTTERY_WINNER_NUMBER) -> BetTable:
+    """
+    Winners of one of the ranges returned by a store `partitions`. Only
+    takes picklable arguments, so it can run in another process
+    """
+    kind, path, start, end = partition
+    if kind == "binary":
+        return BinaryBetStore(path, read_only=True).winners(winner_number, start, end)
+
+    with open(path, 'rb') as file:
+        if start > 0:
+            # Skip the row that started in the previous range
+            file.seek(start - 1)
+            file.readline()
+        rows = []
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                break
+            rows.append(line.decode('utf-8'))
+    table = BetTable()
+    for row in csv.reader(rows, quoting=csv.QUOTE_MINIMAL):
+        table.append_row(int(row[0]), row[1].encode('utf-8'), row[2].encode('utf-8'),
+                         row[3].encode('utf-8'), row[4], int(row[5]))
+    return table.select(winners_mask(table, winner_number))
+
+
+def export_csv(store, csv_path: str) -> int:
+    """
+    Writes every stored bet in the utils.STORAGE_FILEPATH csv format.
+    Returns the amount of bets written
+    """
+    bets = store.load()
+    with open(csv_path, 'w') as file:
+        writer = csv.writer(file, quoting=csv.QUOTE_MINIMAL)
+        writer.writerows(bets.rows())
+    return len(bets)
+
+
+def _encode_bets(bets) -> tuple[bytes, array, array]:
+    # A decoded v1 batch already is in the stored format
+    if hasattr(bets, 'offsets') and getattr(bets, 'version', protocol.PROTOCOL_V1) == protocol.PROTOCOL_V1:
+        return bets.data, bets.numbers, bets.offsets
+
+    numbers = array('q')
+    offsets = array('I')
+    serialized = []
+    offset = 0
+    for bet in bets:
+        serialized_bet = protocol.SerializeBet(bet)
+        numbers.append(bet.number)
+        offsets.append(offset)
+        serialized.append(serialized_bet)
+        offset += len(serialized_bet)
+    return b''.join(serialized), numbers, offsets
+
+
+def to_little_endian(values: array) -> array:
+    if sys.byteorder == 'little':
+        return values
+    swapped = array(values.typecode, values)
+    swapped.byteswap()
+    return swapped
+
+
+def from_little_endian(typecode: str, raw: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(raw)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
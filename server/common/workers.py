@@ -0,0 +1,274 @@
+import logging
+import multiprocessing
+import signal
+import socket
+import threading
+from multiprocessing.connection import wait
+
+from . utils import round_winner_number
+from . server import Server
+from . draw import draw
+from . pipeline import DEFAULT_PIPELINE_WINDOW
+from . import metrics
+
+
+""" Ingest worker processes, unless configured otherwise """
+DEFAULT_WORKERS = 2
+""" Seconds a worker is given to stop before it is terminated """
+WORKER_STOP_TIMEOUT = 10
+
+# Messages between the coordinator and each worker, over a pipe of their own.
+# From a worker: (AGENCY_FINISHED, agency, round id) once every batch of the
+# agency for that round was stored
+AGENCY_FINISHED = 'finished'
+# From the coordinator: (ROUND_DRAWN, round id, winners) with the winners of
+# the agencies that finished the round on that worker, (ROUND_ABORTED, round
+# id, agencies) with those agencies if the round could not be drawn, or None
+# to stop
+ROUND_DRAWN = 'drawn'
+ROUND_ABORTED = 'aborted'
+
+
+class WorkerServer(Server):
+    """
+    `Server` of an ingest worker process
+
+    Agencies are accepted, ingested and stored as usual, but the round is
+    up to the MultiProcessServer at the other end of `coordinator`: an
+    agency that finishes is reported to it instead of counted here, and the
+    lottery only sends the winners it draws.
+    """
+    def __init__(self, server_socket: socket.socket, expected_clients: int, store, coordinator, failures,
+                 pipeline_window: int = DEFAULT_PIPELINE_WINDOW, limits=None):
+        super().__init__(None, None, expected_clients, store, pipeline_window=pipeline_window, limits=limits,
+                         server_socket=server_socket)
+        self._coordinator = coordinator
+        # Connection threads report agencies while the main one waits for winners
+        self._coordinator_lock = threading.Lock()
+        # Shared with the coordinator: rejected batches and dropped connections
+        self._shared_failures = failures
+        # An agency may come back through another worker, whose storage does
+        # not know the batches it stored here
+        self._resumable = False
+
+    def _finish_agency(self, client_id: int, round_id: int):
+        with self._coordinator_lock:
+            self._coordinator.send((AGENCY_FINISHED, client_id, round_id))
+
+    def _count_failures(self, batches: int = 0, connections: int = 0):
+        super()._count_failures(batches, connections)
+        with self._shared_failures.get_lock():
+            self._shared_failures[0] += batches
+            self._shared_failures[1] += connections
+
+    def _handle_lottery(self):
+        try:
+            message = self._coordinator.recv()
+        except EOFError:
+            # The coordinator is gone
+            message = None
+        if message is None:
+            self.finalize()
+            return
+
+        kind, round_id, payload = message
+        if kind == ROUND_ABORTED:
+            # Only the agencies that finished here: the others may already be
+            # back, through this worker, for the next round
+            self._abort_round(round_id, payload)
+            return
+        winners = payload
+        self._send_winners(self._serialize_winners(winners))
+        self._start_round(round_id + 1)
+
+
+class MultiProcessServer:
+    """
+    Lottery server that ingests from several processes
+
+    Decoding batches is CPU bound, so a single process tops out at one core.
+    Here each of `workers` processes runs a WorkerServer on the same port
+    (SO_REUSEPORT), the kernel spreads the agencies among them, and each
+    stores what it ingests in a storage of its own: open_store(worker)
+    builds it, in the worker process.
+
+    This process is the coordinator. It tracks which agencies finished the
+    round and on which worker, draws once every expected agency did, from
+    open_draw_store(round id) (the storage of every worker for that round,
+    see storage.MergedBetStore), and sends each worker the winners of its
+    agencies. Workers are forked right away, so like `Server` the port
+    accepts connections as soon as this is built. Metrics are kept by each
+    process, the ones of this process only cover the draws.
+    """
+    def __init__(self, port, listen_backlog, expected_clients: int, open_store, open_draw_store,
+                 workers: int = DEFAULT_WORKERS, draw_workers: int = 1,
+                 pipeline_window: int = DEFAULT_PIPELINE_WINDOW, winner_number=round_winner_number, limits=None):
+        # Holds the port without listening, only the workers accept. With
+        # port 0, they all take the one picked here
+        self._server_socket = self._reuse_port_socket()
+        self._server_socket.bind(('', port))
+        port = self._server_socket.getsockname()[1]
+
+        self._expected_clients = expected_clients
+        self._open_draw_store = open_draw_store
+        # Processes drawing the winners, see draw.draw
+        self._draw_workers = draw_workers
+        # Round open for bets and how its winner number is chosen
+        self._round = 1
+        self._winner_number = winner_number
+        # Round id -> agency -> worker it finished that round on
+        self._finished_by_round = {}
+
+        # Workers have threads of their own, the only way to hand them the
+        # store factories (closures) and the sockets is forking them now
+        context = multiprocessing.get_context("fork")
+        # Rejected batches and connections dropped, across every worker
+        self._failures = context.Array('q', 2)
+        # finalize may be called from a signal handler, it wakes up run
+        # through this pipe
+        self._wakeup_reader, self._wakeup_writer = context.Pipe(duplex=False)
+        self._killed = False
+
+        listeners = []
+        for _ in range(workers):
+            listener = self._reuse_port_socket()
+            listener.bind(('', port))
+            listener.listen(listen_backlog)
+            listeners.append(listener)
+        # (process, pipe to it)
+        self._workers = []
+        for worker, listener in enumerate(listeners):
+            connection, worker_connection = context.Pipe()
+            process = context.Process(
+                target=self._run_worker, name=f'ingest-worker-{worker}', daemon=True,
+                args=(worker, listeners, worker_connection, open_store, pipeline_window, limits),
+            )
+            process.start()
+            worker_connection.close()
+            self._workers.append((process, connection))
+            logging.info(f'action: start_worker | result: success | worker: {worker} | pid: {process.pid}')
+        for listener in listeners:
+            listener.close()
+
+    @staticmethod
+    def _reuse_port_socket() -> socket.socket:
+        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return skt
+
+    def _run_worker(self, worker: int, listeners: list, connection, open_store, pipeline_window: int, limits):
+        """
+        Body of a worker process
+        """
+        # Only the coordinator stops workers, through their pipe
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        # Whatever the worker does not use, so a worker that dies takes its
+        # listener and its pipe along
+        for other in listeners[:worker] + listeners[worker + 1:]:
+            other.close()
+        for _, other in self._workers:
+            other.close()
+        self._server_socket.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+        server = WorkerServer(listeners[worker], self._expected_clients, open_store(worker), connection,
+                              self._failures, pipeline_window, limits)
+        server.run()
+
+    def finalize(self):
+        """
+        Graceful shutdown. Safe to call from a signal handler or any thread
+        """
+        self._killed = True
+        self._wakeup_writer.send(None)
+
+    def failures(self) -> dict:
+        """
+        Batches rejected and agency connections dropped for breaking the
+        protocol by every worker, since the server started
+        """
+        with self._failures.get_lock():
+            return {'batches': self._failures[0], 'connections': self._failures[1]}
+
+    def run(self):
+        """
+        Coordinator loop
+
+        Collects the agencies that finished from every worker and draws each
+        round once all the expected ones did. A worker that dies is left out,
+        its agencies may connect again through the others
+        """
+        worker_by_connection = {connection: worker for worker, (_, connection) in enumerate(self._workers)}
+        try:
+            while not self._killed and worker_by_connection:
+                for ready in wait(list(worker_by_connection) + [self._wakeup_reader]):
+                    if ready is self._wakeup_reader:
+                        continue
+                    try:
+                        message = ready.recv()
+                    except EOFError:
+                        worker = worker_by_connection.pop(ready)
+                        logging.error(f'action: worker | result: fail | worker: {worker} | error: exited')
+                        continue
+                    _, agency, round_id = message
+                    self._finished_by_round.setdefault(round_id, {})[agency] = worker_by_connection[ready]
+                if self._lottery_is_callable():
+                    self._handle_lottery()
+        finally:
+            self._stop_workers()
+
+    def _lottery_is_callable(self) -> bool:
+        return len(self._finished_by_round.get(self._round, {})) >= self._expected_clients
+
+    def _handle_lottery(self):
+        round_id = self._round
+        finished = self._finished_by_round.pop(round_id)
+        store = self._open_draw_store(round_id)
+        try:
+            with metrics.DRAW_SECONDS.time():
+                winners = draw(store, self._draw_workers, self._winner_number(round_id))
+            logging.info(f'action: sorteo | result: success | round: {round_id} | cant_ganadores: {len(winners)}')
+        except Exception as e:
+            # Like in Server.run, the workers drop the agencies of the round
+            logging.error(f'action: sorteo | result: fail | round: {round_id} | error: {e}')
+            winners = None
+        finally:
+            store.close()
+
+        if winners is None:
+            kind = ROUND_ABORTED
+            payload_by_worker = {worker: [] for worker in range(len(self._workers))}
+            for agency, worker in finished.items():
+                payload_by_worker[worker].append(agency)
+        else:
+            kind = ROUND_DRAWN
+            payload_by_worker = {worker: [] for worker in range(len(self._workers))}
+            for winner in winners:
+                # An agency that left before finishing has nobody to send them to
+                if winner.agency in finished:
+                    payload_by_worker[finished[winner.agency]].append(winner)
+        for worker, (_, connection) in enumerate(self._workers):
+            try:
+                connection.send((kind, round_id, payload_by_worker[worker]))
+            except OSError:
+                # A dead worker, run notices it
+                pass
+        self._round = round_id + 1
+
+    def _stop_workers(self):
+        for _, connection in self._workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        for process, connection in self._workers:
+            process.join(timeout=WORKER_STOP_TIMEOUT)
+            if process.is_alive():
+                logging.error(f'action: stop_worker | result: fail | pid: {process.pid} | error: timed out')
+                process.terminate()
+                process.join()
+            connection.close()
+        self._server_socket.close()
@@ -0,0 +1,163 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from . import metrics
+
+
+""" Batches waiting for the writer thread, unless configured otherwise """
+DEFAULT_QUEUE_SIZE = 256
+""" Longest a batch waits for more to join its group, in seconds """
+DEFAULT_COMMIT_INTERVAL = 0
+""" Bytes after which a group is committed without waiting any longer """
+DEFAULT_COMMIT_BYTES = 1024 * 1024
+""" Size assumed for a bet of a batch that was not decoded from the wire """
+ESTIMATED_BET_SIZE = 64
+
+
+class WriteBehindWriter:
+    """
+    What `WriteBehindStore.writer` returns: hands the batches of an agency
+    to the writer thread
+
+    `store` returns once the batch is durable, so an ack sent after it is a
+    promise. `submit` does not wait, the returned future is done at the
+    same point.
+    """
+    def __init__(self, store, writer):
+        self._store = store
+        self._writer = writer
+
+    def submit(self, bets, sequence: int = None) -> Future:
+        return self._store.submit(self._writer, bets, sequence)
+
+    def store(self, bets, sequence: int = None):
+        return self.submit(bets, sequence).result()
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+class WriteBehindStore:
+    """
+    Stores batches from a single writer thread, with group commit
+
+    Connection handlers put their decoded batches in a bounded queue (a
+    handler that gets ahead of the disk just blocks). The writer thread
+    stores them one after another as they arrive, so the file sees a single
+    stream of sequential writes and no handler waits for a lock, and syncs
+    the store once per group: when `commit_interval` seconds passed since
+    the first batch of the group, or `commit_bytes` were written. Only then
+    the batches of the group are done. With no interval a group is whatever
+    was queued by the time the previous sync finished, so slower syncs make
+    bigger groups.
+
+    Everything but storing goes straight to the wrapped store, a
+    storage.RoundedBetStore included. Rounds are only drawn once every
+    batch was acked, so no batch is pending when the round changes.
+    """
+    def __init__(self, store, queue_size: int = DEFAULT_QUEUE_SIZE,
+                 commit_interval: float = DEFAULT_COMMIT_INTERVAL, commit_bytes: int = DEFAULT_COMMIT_BYTES):
+        self._store = store
+        self._commit_interval = commit_interval
+        self._commit_bytes = commit_bytes
+        # (writer, bets, sequence, future), None to stop
+        self._batches = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def writer(self, agency: int) -> WriteBehindWriter:
+        return WriteBehindWriter(self, self._store.writer(agency))
+
+    def submit(self, writer, bets, sequence: int = None) -> Future:
+        """
+        Queues bets to be stored through writer (anything with a `store`)
+        """
+        future = Future()
+        self._batches.put((writer, bets, sequence, future))
+        return future
+
+    def store(self, bets, sequence: int = None):
+        return self.submit(self._store, bets, sequence).result()
+
+    def next_sequence(self, agency: int) -> int:
+        """
+        Waits for the batches already queued to be synced, so the agency
+        only resumes after durable ones
+        """
+        self.submit(_COMMIT_NOW, []).result()
+        return self._store.next_sequence(agency)
+
+    def close(self) -> None:
+        """
+        Commits whatever is pending, then closes the wrapped store
+        """
+        self._batches.put(None)
+        self._thread.join()
+        self._store.close()
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._batches.get()
+            if item is None:
+                return
+            deadline = time.monotonic() + self._commit_interval
+            group = []
+            written = 0
+            while True:
+                written += self._write(item, group)
+                if written >= self._commit_bytes or item[0] is _COMMIT_NOW:
+                    break
+                try:
+                    item = self._batches.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+            self._commit(group)
+
+    def _write(self, item: tuple, group: list) -> int:
+        """
+        Stores a batch, to be done by the next commit. Returns its size
+        """
+        writer, bets, sequence, future = item
+        try:
+            group.append((future, writer.store(bets, sequence)))
+        except Exception as e:
+            future.set_exception(e)
+            return 0
+        if hasattr(bets, 'data'):
+            return len(bets.data)
+        return ESTIMATED_BET_SIZE * len(bets)
+
+    def _commit(self, group: list) -> None:
+        if not group:
+            return
+        try:
+            with metrics.STORE_COMMIT_SECONDS.time():
+                self._store.sync()
+        except Exception as e:
+            logging.error(f'action: group_commit | result: fail | batches: {len(group)} | error: {e}')
+            for future, _ in group:
+                future.set_exception(e)
+            return
+        metrics.STORE_COMMIT_BATCHES.record(len(group))
+        for future, stored in group:
+            future.set_result(stored)
+
+
+class _NothingWriter:
+    """ Stores nothing, its batch is done by the next commit """
+    def store(self, bets, sequence: int = None):
+        return None
+
+
+""" Commits its group right away, without waiting for the interval """
+_COMMIT_NOW = _NothingWriter()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+from common.storage import BinaryBetStore, BINARY_STORAGE_FILEPATH, export_csv
+from common.utils import STORAGE_FILEPATH
+import argparse
+
+
+def main():
+    """
+    Exports a binary bets log to the bets.csv format, for the tools that
+    still read it
+    """
+    parser = argparse.ArgumentParser(description="Export a binary bets log as csv")
+    parser.add_argument("log", nargs="?", default=BINARY_STORAGE_FILEPATH, help="binary bets log")
+    parser.add_argument("csv", nargs="?", default=STORAGE_FILEPATH, help="destination csv file")
+    args = parser.parse_args()
+
+    store = BinaryBetStore(args.log)
+    try:
+        exported = export_csv(store, args.csv)
+    finally:
+        store.close()
+    print(f"action: export_csv | result: success | bets: {exported} | file: {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
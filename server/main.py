@@ -1,10 +1,63 @@
 #!/usr/bin/env python3
 
-from configparser import ConfigParser
-from common.server import Server
-import logging
+# The port is listened on before anything else (see main), so only what
+# that takes is imported here. The rest waits until the port already takes
+# connections, and only what the configuration uses
+from common.listener import listening_socket
+import importlib
 import os
 import signal
+import time
+
+
+# Available server implementations, selected through SERVER_ENGINE, as
+# (module, class): only the one in use is imported
+SERVER_ENGINES = {
+    "threads": ("common.server", "Server"),
+    "asyncio": ("common.async_server", "AsyncServer"),
+}
+
+
+def read_config_file():
+    """ config.ini, with the environment variables as its defaults """
+    from configparser import ConfigParser
+
+    config = ConfigParser(os.environ)
+    # If config.ini does not exists original config object is not modified
+    config.read("config.ini")
+    return config
+
+
+def initialize_listen_config():
+    """ Find the config params needed to listen: port, backlog and ingest workers
+
+    Environment variables first, like initialize_config, and config.ini is
+    only read if any of them is not there, as importing configparser alone
+    takes longer than listening. Throws KeyError and ValueError like
+    initialize_config
+    """
+    values = {key: os.getenv(key) for key in ('SERVER_PORT', 'SERVER_LISTEN_BACKLOG', 'INGEST_WORKERS')}
+    if None in values.values():
+        config = read_config_file()
+        for key, value in values.items():
+            if value is None:
+                values[key] = config["DEFAULT"].get(key)
+
+    config_params = {}
+    try:
+        for key in ('SERVER_PORT', 'SERVER_LISTEN_BACKLOG'):
+            if values[key] is None:
+                raise KeyError(key)
+        config_params["port"] = int(values["SERVER_PORT"])
+        config_params["listen_backlog"] = int(values["SERVER_LISTEN_BACKLOG"])
+        # Optional: older config files do not define it
+        config_params["ingest_workers"] = int(values["INGEST_WORKERS"] or "1")
+    except KeyError as e:
+        raise KeyError("Key was not found. Error: {} .Aborting server".format(e))
+    except ValueError as e:
+        raise ValueError("Key could not be parsed. Error: {}. Aborting server".format(e))
+
+    return config_params
 
 
 def initialize_config():
@@ -17,10 +70,13 @@ def initialize_config():
     If parsing succeeded, the function returns a ConfigParser object 
     with config parameters
     """
+    from common.storage import STORAGE_BACKENDS
+    from common.pipeline import DEFAULT_PIPELINE_WINDOW
+    from common.write_behind import DEFAULT_QUEUE_SIZE, DEFAULT_COMMIT_INTERVAL, DEFAULT_COMMIT_BYTES
+    from common.admission import IngestLimits, DEFAULT_MAX_BATCH_BYTES, DEFAULT_MAX_BUFFERED_BYTES, DEFAULT_MAX_DECODING
+    from common.profiling import PROFILE_FILEPATH, DEFAULT_WINDOW_SECONDS, DEFAULT_SAMPLE_INTERVAL
 
-    config = ConfigParser(os.environ)
-    # If config.ini does not exists original config object is not modified
-    config.read("config.ini")
+    config = read_config_file()
 
     config_params = {}
     try:
@@ -28,6 +84,48 @@ def initialize_config():
         config_params["listen_backlog"] = int(os.getenv('SERVER_LISTEN_BACKLOG', config["DEFAULT"]["SERVER_LISTEN_BACKLOG"]))
         config_params["logging_level"] = os.getenv('LOGGING_LEVEL', config["DEFAULT"]["LOGGING_LEVEL"])
         config_params["amount_of_clients"] = os.getenv('AMOUNT_OF_CLIENTS', config["DEFAULT"]["AMOUNT_OF_CLIENTS"])
+        # Optional: older config files do not define it
+        config_params["engine"] = os.getenv('SERVER_ENGINE', config["DEFAULT"].get("SERVER_ENGINE", "threads"))
+        if config_params["engine"] not in SERVER_ENGINES:
+            raise ValueError("unknown SERVER_ENGINE '{}'".format(config_params["engine"]))
+        config_params["storage"] = os.getenv('STORAGE_BACKEND', config["DEFAULT"].get("STORAGE_BACKEND", "csv"))
+        if config_params["storage"] not in STORAGE_BACKENDS:
+            raise ValueError("unknown STORAGE_BACKEND '{}'".format(config_params["storage"]))
+        config_params["storage_readers"] = int(os.getenv('STORAGE_READERS', config["DEFAULT"].get("STORAGE_READERS", "1")))
+        config_params["winner_index"] = parse_bool(os.getenv('WINNER_INDEX', config["DEFAULT"].get("WINNER_INDEX", "false")))
+        if config_params["winner_index"] and config_params["storage"] == "csv":
+            raise ValueError("WINNER_INDEX needs a binary or sharded STORAGE_BACKEND")
+        config_params["query_index"] = parse_bool(os.getenv('QUERY_INDEX', config["DEFAULT"].get("QUERY_INDEX", "false")))
+        if config_params["query_index"] and config_params["storage"] == "csv":
+            raise ValueError("QUERY_INDEX needs a binary or sharded STORAGE_BACKEND")
+        config_params["draw_workers"] = int(os.getenv('DRAW_WORKERS', config["DEFAULT"].get("DRAW_WORKERS", "1")))
+        config_params["pipeline_window"] = int(os.getenv('PIPELINE_WINDOW', config["DEFAULT"].get("PIPELINE_WINDOW", str(DEFAULT_PIPELINE_WINDOW))))
+        if not 1 <= config_params["pipeline_window"] <= 255:
+            raise ValueError("PIPELINE_WINDOW must be between 1 and 255")
+        config_params["ingest_workers"] = int(os.getenv('INGEST_WORKERS', config["DEFAULT"].get("INGEST_WORKERS", "1")))
+        if config_params["ingest_workers"] < 1:
+            raise ValueError("INGEST_WORKERS must be at least 1")
+        if config_params["ingest_workers"] > 1 and config_params["engine"] != "threads":
+            raise ValueError("INGEST_WORKERS above 1 needs the threads SERVER_ENGINE")
+        config_params["write_behind"] = parse_bool(os.getenv('WRITE_BEHIND', config["DEFAULT"].get("WRITE_BEHIND", "false")))
+        config_params["write_behind_queue"] = int(os.getenv('WRITE_BEHIND_QUEUE', config["DEFAULT"].get("WRITE_BEHIND_QUEUE", str(DEFAULT_QUEUE_SIZE))))
+        config_params["group_commit_interval"] = float(os.getenv('GROUP_COMMIT_INTERVAL_MS', config["DEFAULT"].get("GROUP_COMMIT_INTERVAL_MS", str(DEFAULT_COMMIT_INTERVAL * 1000)))) / 1000
+        config_params["group_commit_bytes"] = int(os.getenv('GROUP_COMMIT_BYTES', config["DEFAULT"].get("GROUP_COMMIT_BYTES", str(DEFAULT_COMMIT_BYTES))))
+        config_params["ingest_limits"] = IngestLimits(
+            int(os.getenv('MAX_BATCH_BYTES', config["DEFAULT"].get("MAX_BATCH_BYTES", str(DEFAULT_MAX_BATCH_BYTES)))),
+            int(os.getenv('MAX_BUFFERED_BYTES', config["DEFAULT"].get("MAX_BUFFERED_BYTES", str(DEFAULT_MAX_BUFFERED_BYTES)))),
+            int(os.getenv('MAX_DECODING_AGENCIES', config["DEFAULT"].get("MAX_DECODING_AGENCIES", str(DEFAULT_MAX_DECODING)))),
+        )
+        # Empty disables the metrics endpoint
+        config_params["metrics_address"] = os.getenv('METRICS_ADDRESS', config["DEFAULT"].get("METRICS_ADDRESS", ""))
+        if config_params["metrics_address"] and config_params["ingest_workers"] > 1:
+            # The endpoint would only see the coordinator, every ingest metric is in the workers
+            raise ValueError("METRICS_ADDRESS needs INGEST_WORKERS 1")
+        config_params["profile_seconds"] = float(os.getenv('PROFILE_SECONDS', config["DEFAULT"].get("PROFILE_SECONDS", str(DEFAULT_WINDOW_SECONDS))))
+        config_params["profile_sample_interval"] = float(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', config["DEFAULT"].get("PROFILE_SAMPLE_INTERVAL_MS", str(DEFAULT_SAMPLE_INTERVAL * 1000)))) / 1000
+        if config_params["profile_seconds"] <= 0 or config_params["profile_sample_interval"] <= 0:
+            raise ValueError("PROFILE_SECONDS and PROFILE_SAMPLE_INTERVAL_MS must be positive")
+        config_params["profile_filepath"] = os.getenv('PROFILE_FILEPATH', config["DEFAULT"].get("PROFILE_FILEPATH", PROFILE_FILEPATH))
     except KeyError as e:
         raise KeyError("Key was not found. Error: {} .Aborting server".format(e))
     except ValueError as e:
@@ -36,22 +134,100 @@ def initialize_config():
     return config_params
 
 
+def parse_bool(value: str) -> bool:
+    """ Parses a boolean config param the way ConfigParser.getboolean does """
+    from configparser import ConfigParser
+
+    if value.lower() not in ConfigParser.BOOLEAN_STATES:
+        raise ValueError("not a boolean: '{}'".format(value))
+    return ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
 def main():
+    started = time.perf_counter()
+    listen_params = initialize_listen_config()
+    # Several ingest workers listen on the port themselves, see
+    # workers.MultiProcessServer. Otherwise agencies that connect from now on
+    # wait in the backlog while the rest starts
+    server_socket = None
+    if listen_params["ingest_workers"] == 1:
+        server_socket = listening_socket(listen_params["port"], listen_params["listen_backlog"])
+    time_to_listen = time.perf_counter() - started
+
+    import logging
+    from common.storage import RoundedBetStore, MergedBetStore, create_store, round_path, worker_path
+    from common.profiling import Profiler
+
     config_params = initialize_config()
     logging_level = config_params["logging_level"]
     port = config_params["port"]
     listen_backlog = config_params["listen_backlog"]
     amount_of_clients = config_params["amount_of_clients"]
+    engine = config_params["engine"]
+    storage = config_params["storage"]
 
     initialize_log(logging_level)
 
     # Log config parameters at the beginning of the program to verify the configuration
     # of the component
     logging.debug(f"action: config | result: success | port: {port} | "
-                  f"listen_backlog: {listen_backlog} | logging_level: {logging_level}")
+                  f"listen_backlog: {listen_backlog} | logging_level: {logging_level} | engine: {engine} | "
+                  f"storage: {storage} | ingest_workers: {config_params['ingest_workers']}")
+    if config_params["ingest_workers"] > 1:
+        # An agency may come back through another worker, see workers.WorkerServer
+        logging.warning(f'action: config | result: success | ingest_workers: {config_params["ingest_workers"]} | '
+                        f'resume: disabled')
+    if server_socket is not None:
+        logging.info(f'action: listen | result: success | port: {server_socket.getsockname()[1]} | '
+                     f'time_to_listen_ms: {time_to_listen * 1000:.1f}')
 
     # Initialize server and start server loop
-    server = Server(port, listen_backlog, int(amount_of_clients))
+    # Every round is stored in a segment of its own, see storage.round_path,
+    # and so is every ingest worker, see storage.worker_path
+    def open_round(round_id, worker=0):
+        store = create_store(storage, config_params["storage_readers"], round_id, worker)
+        if config_params["winner_index"]:
+            from common.index import IndexedBetStore, INDEX_FILEPATH
+            store = IndexedBetStore(store, round_path(worker_path(INDEX_FILEPATH, worker), round_id))
+        if config_params["query_index"]:
+            from common.query import QueryableBetStore, QUERY_INDEX_FILEPATH
+            store = QueryableBetStore(store, round_path(worker_path(QUERY_INDEX_FILEPATH, worker), round_id))
+        return store
+
+    def open_store(worker=0):
+        store = RoundedBetStore(lambda round_id: open_round(round_id, worker))
+        if config_params["write_behind"]:
+            from common.write_behind import WriteBehindStore
+            store = WriteBehindStore(store, config_params["write_behind_queue"],
+                                     config_params["group_commit_interval"], config_params["group_commit_bytes"])
+        return store
+
+    # SIGUSR1 profiles the process for a window, or ends the running one, see
+    # profiling.Profiler. Set before the ingest workers are forked, so each
+    # is profiled on its own when signaled
+    profiler = Profiler(config_params["profile_filepath"], config_params["profile_seconds"],
+                        config_params["profile_sample_interval"])
+    signal.signal(signal.SIGUSR1, lambda sig, frame: profiler.toggle())
+
+    ingest_workers = config_params["ingest_workers"]
+    if ingest_workers > 1:
+        from common.workers import MultiProcessServer
+
+        # The workers still have these files open for appending: the draw
+        # only reads them, without the indexes, which opening would rebuild
+        def open_draw_store(round_id):
+            return MergedBetStore([create_store(storage, config_params["storage_readers"], round_id, worker, read_only=True)
+                                   for worker in range(ingest_workers)])
+
+        server = MultiProcessServer(port, listen_backlog, int(amount_of_clients), open_store, open_draw_store,
+                                    ingest_workers, config_params["draw_workers"], config_params["pipeline_window"],
+                                    limits=config_params["ingest_limits"])
+    else:
+        module_name, class_name = SERVER_ENGINES[engine]
+        server_class = getattr(importlib.import_module(module_name), class_name)
+        server = server_class(port, listen_backlog, int(amount_of_clients), open_store(),
+                              config_params["draw_workers"], config_params["pipeline_window"],
+                              limits=config_params["ingest_limits"], server_socket=server_socket)
 
     # Defino este closure para frenar al server
     def signal_handler(sig, frame):
@@ -59,8 +235,22 @@ def main():
 
     signal.signal(signal.SIGTERM, signal_handler)
 
+    metrics_server = None
+    if config_params["metrics_address"]:
+        from common.metrics_http import MetricsServer
+        metrics_server = MetricsServer(config_params["metrics_address"])
+        metrics_server.start()
+        logging.info(f'action: metrics | result: success | address: {config_params["metrics_address"]}')
+
+    logging.info(f'action: server_ready | result: success | '
+                 f'time_to_ready_ms: {(time.perf_counter() - started) * 1000:.1f}')
     server.run()
 
+    # A window still running is written with what it gathered
+    profiler.stop()
+    if metrics_server is not None:
+        metrics_server.close()
+
 def initialize_log(logging_level):
     """
     Python custom logging initialization
@@ -68,6 +258,8 @@ def initialize_log(logging_level):
     Current timestamp is added to be able to identify in docker
     compose logs the date when the log has arrived
     """
+    import logging
+
     logging.basicConfig(
         format='%(asctime)s %(levelname)-8s %(message)s',
         level=logging_level,
@@ -18,13 +18,22 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(7500, b.number)
 
     def test_has_won_with_winner_number_must_be_true(self):
-        b = bet('1', 'first', 'last', 10000000,'2000-12-20', LOTTERY_WINNER_NUMBER)
+        b = Bet('1', 'first', 'last', 10000000,'2000-12-20', LOTTERY_WINNER_NUMBER)
         self.assertTrue(has_won(b))
 
-    def test_has_won_with_winner_number_must_be_true(self):
+    def test_has_won_with_other_number_must_be_false(self):
         b = Bet('1', 'first', 'last', 10000000,'2000-12-20', LOTTERY_WINNER_NUMBER + 1)
         self.assertFalse(has_won(b))
 
+    def test_has_won_with_round_winner_number(self):
+        b = Bet('1', 'first', 'last', 10000000, '2000-12-20', round_winner_number(2))
+        self.assertTrue(has_won(b, round_winner_number(2)))
+
+    def test_round_winner_number_is_the_same_for_a_round(self):
+        self.assertEqual(LOTTERY_WINNER_NUMBER, round_winner_number(1))
+        self.assertEqual(round_winner_number(5), round_winner_number(5))
+        self.assertTrue(0 <= round_winner_number(5) < 10000)
+
     def test_store_bets_and_load_bets_keeps_fields_data(self):
         to_store = [Bet('1', 'first', 'last', '10000000','2000-12-20', 7500)]
         store_bets(to_store)
@@ -46,6 +55,44 @@ class TestUtils(unittest.TestCase):
         self._assert_equal_bets(to_store[0], from_load[0])
         self._assert_equal_bets(to_store[1], from_load[1])
 
+    def test_bet_has_no_instance_dict(self):
+        b = Bet('1', 'first', 'last', '10000000','2000-12-20', 7500)
+        self.assertFalse(hasattr(b, '__dict__'))
+
+    def test_bet_table_keeps_fields_data(self):
+        to_store = [
+            Bet('0', 'first_0', 'last_0', '10000000','2000-12-20', 7500),
+            Bet('1', 'ñandú', 'last_1', '10000001','2000-12-21', 7501),
+        ]
+        table = BetTable()
+        table.extend(to_store)
+
+        self.assertEqual(2, len(table))
+        self._assert_equal_bets(to_store[0], table[0])
+        self._assert_equal_bets(to_store[1], table[1])
+
+    def test_winners_mask_selects_winners(self):
+        table = BetTable()
+        table.extend([
+            Bet('0', 'first_0', 'last_0', '10000000','2000-12-20', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'first_1', 'last_1', '10000001','2000-12-21', LOTTERY_WINNER_NUMBER + 1),
+        ])
+
+        winners = table.select(winners_mask(table))
+
+        self.assertEqual([True, False], winners_mask(table))
+        self.assertEqual(1, len(winners))
+        self._assert_equal_bets(table[0], winners[0])
+
+    def test_store_bet_table_and_load_bets_table_keeps_fields_data(self):
+        table = BetTable()
+        table.extend([Bet('1', 'first', 'last', '10000000','2000-12-20', 7500)])
+        store_bets(table)
+        from_load = load_bets_table()
+
+        self.assertEqual(1, len(from_load))
+        self._assert_equal_bets(table[0], from_load[0])
+
     def _assert_equal_bets(self, b1, b2):
         self.assertEqual(b1.agency, b2.agency)
         self.assertEqual(b1.first_name, b2.first_name)
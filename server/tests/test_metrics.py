@@ -0,0 +1,250 @@
+from common.utils import *
+from common.metrics import Histogram, Registry
+from common.metrics_http import MetricsServer
+from common.server import Server
+from common.storage import CsvBetStore
+from common.profiling import Profiler
+from common import metrics
+from common import profiling
+from common import protocol
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+
+
+def get_over_unix_socket(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as skt:
+        skt.connect(path)
+        skt.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            received = skt.recv(4096)
+            if not received:
+                return response
+            response += received
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_quantiles_are_within_the_bucket_precision(self):
+        histogram = Histogram('latency', 'help')
+        values = random.Random(15).choices(range(1, 10 ** 9), k=10000)
+        for value in values:
+            histogram.record(value)
+
+        values.sort()
+        for quantile in (0.5, 0.9, 0.99):
+            exact = values[int(quantile * len(values)) - 1]
+            self.assertAlmostEqual(exact, histogram.quantile(quantile), delta=exact / 32)
+        self.assertEqual(len(values), histogram.count)
+        self.assertEqual(sum(values), histogram.sum)
+
+    def test_small_values_are_exact(self):
+        histogram = Histogram('bytes', 'help')
+        for value in (0, 1, 5, 63):
+            histogram.record(value)
+
+        self.assertEqual(5, histogram.quantile(0.75))
+        self.assertEqual(63, histogram.quantile(1))
+
+    def test_exposed_buckets_are_cumulative_and_scaled(self):
+        histogram = Histogram('draw_seconds', 'Draw time', scale=1e-9)
+        with histogram.time():
+            pass
+        histogram.record(2 * 10 ** 9)
+
+        lines = histogram.expose()
+
+        self.assertEqual('# TYPE draw_seconds histogram', lines[1])
+        buckets = [line for line in lines if line.startswith('draw_seconds_bucket')]
+        self.assertEqual('1', buckets[0].rsplit(' ', 1)[1])
+        self.assertEqual('draw_seconds_bucket{le="+Inf"} 2', buckets[-1])
+        self.assertAlmostEqual(2.0, float(buckets[-2].split('"')[1]), delta=2.0 / 32)
+        self.assertEqual('draw_seconds_count 2', lines[-1])
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_labeled_counters(self):
+        registry = Registry()
+        counter = registry.counter('bets_total', 'Bets', label='agency')
+        counter.inc(3, 1)
+        counter.inc(2, 1)
+        counter.inc(1, 2)
+
+        exposed = registry.expose()
+
+        self.assertIn('bets_total{agency="1"} 5\n', exposed)
+        self.assertIn('bets_total{agency="2"} 1\n', exposed)
+
+    def test_gauges_go_up_and_down(self):
+        registry = Registry()
+        gauge = registry.gauge('buffered_bytes', 'Buffered')
+        gauge.inc(10)
+        gauge.dec(4)
+
+        self.assertIn('# TYPE buffered_bytes gauge\nbuffered_bytes 6\n', registry.expose())
+
+    def test_served_over_http_and_unix_socket(self):
+        registry = Registry()
+        registry.counter('failures_total', 'Failures').inc()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.sock')
+            servers = [MetricsServer('127.0.0.1:0', registry), MetricsServer(f'unix:{path}', registry)]
+            for server in servers:
+                server.start()
+            try:
+                host, port = servers[0].address
+                with urllib.request.urlopen(f'http://{host}:{port}/metrics') as response:
+                    self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+                    self.assertIn('failures_total 1', response.read().decode('utf-8'))
+                self.assertIn(b'failures_total 1', get_over_unix_socket(path))
+            finally:
+                for server in servers:
+                    server.close()
+            self.assertFalse(os.path.exists(path))
+
+
+class TestServerMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(0, 5, 1, CsvBetStore())
+        self.port = self.server._server_socket.getsockname()[1]
+        self.server_thread = threading.Thread(target=self.server.run)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.finalize()
+        self.server_thread.join(timeout=5)
+        if os.path.exists(STORAGE_FILEPATH):
+            os.remove(STORAGE_FILEPATH)
+
+    def send_agency_bets(self, agency: int):
+        batch = b''.join(protocol.SerializeBet(Bet(str(agency), 'first', 'last', str(i), '2000-12-20', i)) for i in range(3))
+        with socket.create_connection(('localhost', self.port)) as skt:
+            skt.sendall(protocol.SerializeString(str(agency)))
+            skt.sendall(protocol.SerializeUInteger8(protocol.BETS_BATCH) + protocol.SerializeUInteger64(len(batch)) + batch)
+            skt.recv(1)
+            skt.sendall(protocol.SerializeUInteger8(protocol.BETS_END))
+            # Winners header: the round was drawn
+            skt.recv(11)
+        return batch
+
+    def test_ingest_is_recorded(self):
+        agency = 4821
+        bets_before = metrics.BETS_RECEIVED.value(agency)
+        draws_before = metrics.DRAW_SECONDS.count
+        decodes_before = metrics.BATCH_DECODE_SECONDS.count
+        batch = self.send_agency_bets(agency)
+
+        self.assertEqual(3, metrics.BETS_RECEIVED.value(agency) - bets_before)
+        self.assertEqual(11 + len(batch), metrics.BYTES_RECEIVED.value(agency))
+        self.assertEqual(1, metrics.BATCH_DECODE_SECONDS.count - decodes_before)
+        self.assertEqual(1, metrics.DRAW_SECONDS.count - draws_before)
+        self.assertIn(f'lottery_bets_received_total{{agency="{agency}"}}', metrics.REGISTRY.expose())
+
+    def test_handling_phases_are_profiled(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(os.path.join(directory, 'profile.txt'), interval=0.001)
+            profiler.start()
+            self.send_agency_bets(4822)
+            path = profiler.stop()
+
+            phases = read_profile(path)[0]
+
+        # Winners may still be sent when the agency gets them
+        for name in ('handshake', 'read_batch', 'decode', 'store_lock_wait', 'store', 'ack', 'draw', 'serialize_winners'):
+            self.assertIn(name, phases)
+        self.assertEqual(1, phases['decode'][0])
+
+
+def read_profile(path):
+    """
+    (phase -> (count, total_ms), folded stack -> samples) of a profile
+    """
+    phases, stacks = {}, {}
+    with open(path) as profile:
+        lines = profile.read().splitlines()
+    # The header and the column names
+    for line in lines[2:]:
+        if line.startswith('# '):
+            name, count, total = line[2:].split()[:3]
+            phases[name] = (int(count), float(total))
+        else:
+            folded, samples = line.rsplit(' ', 1)
+            stacks[folded] = int(samples)
+    return phases, stacks
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'profile.txt')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_phases_are_not_timed_while_off(self):
+        self.assertIs(profiling._UNTIMED, profiling.phase('decode'))
+        profiling.record('store', 1000)
+
+        profiler = Profiler(self.path)
+        profiler.start()
+        profiler.stop()
+
+        self.assertIs(profiling._UNTIMED, profiling.phase('decode'))
+
+    def test_window_has_phases_and_stacks(self):
+        profiler = Profiler(self.path, interval=0.001)
+        path = profiler.start()
+        with profiling.phase('decode'):
+            time.sleep(0.05)
+        profiling.record('store', 5 * 10 ** 6)
+
+        self.assertEqual(path, profiler.stop())
+        phases, stacks = read_profile(path)
+
+        self.assertEqual(1, phases['decode'][0])
+        self.assertGreaterEqual(phases['decode'][1], 50)
+        self.assertEqual((1, 5.0), phases['store'])
+        # The test thread, caught sleeping
+        self.assertTrue(any('test_metrics.py:test_window_has_phases_and_stacks' in folded for folded in stacks))
+        self.assertFalse(any('profiling.py:_run' in folded for folded in stacks))
+
+    def test_window_ends_on_its_own(self):
+        profiler = Profiler(self.path, seconds=0.05, interval=0.001)
+        path = profiler.start()
+        profiler._sampler.join(timeout=5)
+
+        self.assertTrue(os.path.exists(path))
+        self.assertIsNone(profiler.stop())
+
+    def test_toggle_starts_and_ends_a_window(self):
+        profiler = Profiler(self.path, seconds=60, interval=0.001)
+        profiler.toggle()
+        sampler = profiler._sampler
+        profiler.toggle()
+        sampler.join(timeout=5)
+
+        self.assertFalse(sampler.is_alive())
+        self.assertEqual(1, len(os.listdir(self.directory.name)))
+        # Windows are told apart by the millisecond they started
+        time.sleep(0.01)
+        profiler.toggle()
+        self.assertIsNotNone(profiler.stop())
+        self.assertEqual(2, len(os.listdir(self.directory.name)))
+
+    def test_profile_path_has_the_process_and_the_time(self):
+        path = profiling.profile_path('./profile.txt', 4242, time.mktime((2024, 5, 21, 13, 4, 55, 0, 0, -1)) + 0.125)
+
+        self.assertEqual('./profile-4242-20240521T130455.125.txt', path)
+
+
+if __name__ == '__main__':
+    unittest.main()
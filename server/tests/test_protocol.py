@@ -0,0 +1,353 @@
+from common.utils import *
+from common.framing import FrameReader, send_frames
+from common.batch import decode_batch, decode_batch_v2
+from common.compression import BatchInflater, compress_batch
+from common import protocol
+import random
+import socket
+import threading
+import unittest
+import zlib
+
+
+def bet_fields(bet):
+    return [getattr(bet, field) for field in Bet.__slots__]
+
+class TestProtocol(unittest.TestCase):
+
+    def test_deserialize_bets_keeps_fields_and_order(self):
+        to_send = [
+            Bet('1', 'first_0', 'last_0', '10000000', '2000-12-20', 7500),
+            Bet('1', 'ñandú', 'last_1', '10000001', '2000-12-21', 7501),
+        ]
+        batch = b''.join(protocol.SerializeBet(bet) for bet in to_send)
+
+        received = protocol.DeserializeBets(memoryview(bytearray(batch)))
+
+        self.assertEqual([bet_fields(bet) for bet in to_send], [bet_fields(bet) for bet in received])
+
+    def test_deserialize_bets_with_fields_longer_than_127_bytes(self):
+        bet = Bet('1', 'a' * 100, 'b' * 50, '10000000', '2000-12-20', 7500)
+
+        received = protocol.DeserializeBets(protocol.SerializeBet(bet))
+
+        self.assertEqual('a' * 100, received[0].first_name)
+
+    def test_deserialize_bet_with_wrong_number_type_fails(self):
+        serialized = bytearray(protocol.SerializeBet(Bet('1', 'first', 'last', '1', '2000-12-20', 1)))
+        serialized[-10] = protocol.STRING
+
+        with self.assertRaises(ValueError):
+            protocol.DeserializeBet(serialized)
+
+    def test_winners_frames_match_serialized_winners(self):
+        winners = [Bet('1', 'first', 'last', str(i), '2000-12-20', 7574) for i in range(3)]
+
+        frames = protocol.WinnersFrames(winners)
+
+        self.assertEqual(4, len(frames))
+        self.assertEqual(protocol.SerializeWinners(winners), b''.join(frames))
+        size, _ = protocol.DeserializeUInteger64(frames[0][1:])
+        self.assertEqual(sum(len(frame) for frame in frames[1:]), size)
+
+
+class TestProtocolErrors(unittest.TestCase):
+
+    def test_query_answers_carry_an_amount_or_bets(self):
+        bets = [Bet('1', 'first', 'last', '1', '2000-12-20', 7)]
+
+        count = protocol.SerializeQueryAnswer(3)
+        self.assertEqual(protocol.QUERY_ANSWER, count[0])
+        self.assertEqual((10, b''), protocol.DeserializeUInteger64(count[1:11]))
+        self.assertEqual((3, b''), protocol.DeserializeUInteger64(count[11:]))
+
+        found = protocol.SerializeQueryAnswer(bets, protocol.PROTOCOL_V2)
+        _, deserialize_bets = protocol.CODECS[protocol.PROTOCOL_V2]
+        self.assertEqual([bet.document for bet in bets], [bet.document for bet in deserialize_bets(found[11:])])
+
+    def test_broken_uint64_raises_instead_of_aborting(self):
+        for broken in (b'\x00\x08' + bytes(8), b'\x01\x04' + bytes(8), b'\x01\x08\x00'):
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.DeserializeUInteger64(broken)
+
+    def test_batch_size_is_bounded(self):
+        self.assertEqual(8000, protocol.DeserializeBatchSize(protocol.SerializeUInteger64(8000)))
+        for size in (protocol.MAX_BATCH_FRAME_SIZE + 1, 2 ** 64 - 1):
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.DeserializeBatchSize(protocol.SerializeUInteger64(size))
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.DeserializeBatchSize(protocol.SerializeUInteger64(8001), max_size=8000)
+
+    def test_fuzzed_batches_only_raise_malformed_batch(self):
+        fuzz = random.Random(14)
+        bets = [Bet(str(fuzz.randint(1, 300)), 'ñandú', 'last', str(i), '2000-12-20', fuzz.randrange(10000)) for i in range(20)]
+        decoders = [
+            (b''.join(protocol.SerializeBet(bet) for bet in bets), [decode_batch, protocol.DeserializeBets]),
+            (b''.join(protocol.SerializeBetV2(bet) for bet in bets), [decode_batch_v2, protocol.DeserializeBetsV2]),
+        ]
+        for valid, decode_functions in decoders:
+            for _ in range(300):
+                broken = bytearray(valid)
+                mutation = fuzz.randrange(3)
+                if mutation == 0:
+                    broken = broken[:fuzz.randrange(len(broken))]
+                elif mutation == 1:
+                    for _ in range(fuzz.randint(1, 4)):
+                        broken[fuzz.randrange(len(broken))] = fuzz.randrange(256)
+                else:
+                    broken = bytearray(fuzz.randbytes(fuzz.randint(1, 200)))
+                for decode in decode_functions:
+                    try:
+                        decode(bytes(broken))
+                    except protocol.MalformedBatchError:
+                        pass
+
+    def test_fuzzed_compressed_batches_only_raise_malformed_batch(self):
+        fuzz = random.Random(14)
+        compressed = compress_batch([Bet('1', 'first', 'last', str(i), '2000-12-20', i) for i in range(50)])
+        for _ in range(200):
+            broken = bytearray(compressed)
+            broken[fuzz.randrange(len(broken))] = fuzz.randrange(256)
+            inflater = BatchInflater(1)
+            inflater.feed(bytes(broken))
+            try:
+                decode_batch(inflater.finish())
+            except protocol.MalformedBatchError:
+                pass
+
+
+class TestProtocolV2(unittest.TestCase):
+
+    def test_varints_round_trip(self):
+        for integer in (0, 1, 127, 128, 300, 16383, 16384, 2 ** 32, 2 ** 64 - 1):
+            varint = protocol.SerializeVarint(integer)
+            self.assertEqual((integer, len(varint)), protocol.DeserializeVarintAt(varint, 0))
+        self.assertEqual(b'\xac\x02', protocol.SerializeVarint(300))
+
+    def test_deserialize_v2_bets_keeps_fields_and_order(self):
+        to_send = [
+            Bet('1', 'first_0', 'last_0', '10000000', '2000-12-20', 7500),
+            Bet('300', 'ñandú', 'b' * 200, '10000001', '0001-01-01', 0),
+        ]
+        batch = b''.join(protocol.SerializeBetV2(bet) for bet in to_send)
+
+        self.assertEqual([bet_fields(bet) for bet in to_send], [bet_fields(bet) for bet in protocol.DeserializeBetsV2(batch)])
+        self.assertEqual([bet_fields(bet) for bet in to_send], [bet_fields(bet) for bet in decode_batch_v2(batch)])
+
+    def test_v2_bets_that_cannot_be_stored_as_v1_fail(self):
+        # 255 bytes as v1, the most it takes
+        fitting = Bet('300', 'ñandú', 'b' * 207, '10000001', '2000-12-20', 2 ** 40)
+        too_long = Bet('300', 'ñandú', 'b' * 208, '10000001', '2000-12-20', 1)
+
+        self.assertEqual(257, len(protocol.SerializeBet(fitting)))
+        batch = decode_batch_v2(protocol.SerializeBetV2(fitting))
+        self.assertEqual('b' * 207, batch.last_names[0])
+        with self.assertRaises(protocol.MalformedBatchError):
+            decode_batch_v2(protocol.SerializeBetV2(too_long))
+
+    def test_v2_bets_are_smaller(self):
+        bet = Bet('1', 'first', 'last', '30904465', '1999-03-17', 7574)
+
+        # No type tags, packed date and number, 2 bytes length
+        self.assertEqual(50, len(protocol.SerializeBet(bet)))
+        self.assertEqual(29, len(protocol.SerializeBetV2(bet)))
+
+    def test_decode_v2_batch_columns(self):
+        to_send = [Bet('3', 'first', 'last', str(i), '2000-12-20', 7500 + i) for i in range(3)]
+        batch = decode_batch_v2(b''.join(protocol.SerializeBetV2(bet) for bet in to_send))
+
+        self.assertEqual([3, 3, 3], list(batch.agencies))
+        self.assertEqual([7500, 7501, 7502], list(batch.numbers))
+        self.assertEqual('2000-12-20', list(batch.rows())[1][4])
+
+    def test_broken_v2_batches_fail(self):
+        serialized = protocol.SerializeBetV2(Bet('1', 'first', 'last', '1', '2000-12-20', 1))
+        bad_date = bytearray(serialized)
+        # Month 13
+        bad_date[-3] = 13
+
+        bad_utf8 = serialized.replace(b'first', b'fir\xff\xfe')
+
+        for broken in (serialized[:-1], serialized + b'\x00', bytes(bad_date), bad_utf8):
+            with self.assertRaises(ValueError):
+                decode_batch_v2(broken)
+
+    def test_unfinished_utf8_before_a_long_string_fails(self):
+        # The first name ends in the lead byte of a 2 bytes sequence, and the
+        # first byte of the last name length (150, a 2 bytes varint) would
+        # pass for the one that completes it
+        serialized = protocol.SerializeBetV2(Bet('1', 'first', 'x' * 150, '1', '2000-12-20', 1))
+
+        with self.assertRaises(protocol.MalformedBatchError):
+            decode_batch_v2(serialized.replace(b'first', b'firs\xc3'))
+
+    def test_long_utf8_strings_are_kept_in_v2(self):
+        batch = decode_batch_v2(protocol.SerializeBetV2(Bet('1', 'ñ' * 70, 'x' * 60, '1', '2000-12-20', 1)))
+
+        self.assertEqual('ñ' * 70, batch.first_names[0])
+        self.assertEqual('x' * 60, batch.last_names[0])
+
+    def test_winners_frames_in_v2(self):
+        winners = [Bet('1', 'first', 'last', str(i), '2000-12-20', 7574) for i in range(3)]
+
+        message = protocol.SerializeWinners(winners, protocol.PROTOCOL_V2)
+
+        size, _ = protocol.DeserializeUInteger64(message[1:11])
+        self.assertEqual(len(message) - 11, size)
+        self.assertEqual(['0', '1', '2'], [bet.document for bet in protocol.DeserializeBetsV2(message[11:])])
+
+
+class TestDecodeBatch(unittest.TestCase):
+
+    def test_decode_batch_keeps_columns(self):
+        to_send = [
+            Bet('3', 'first_0', 'last_0', '10000000', '2000-12-20', 7500),
+            Bet('3', 'ñandú', 'last_1', '10000001', '2000-12-21', 7501),
+        ]
+        batch = decode_batch(b''.join(protocol.SerializeBet(bet) for bet in to_send))
+
+        self.assertEqual(2, len(batch))
+        self.assertEqual([3, 3], list(batch.agencies))
+        self.assertEqual([7500, 7501], list(batch.numbers))
+        self.assertEqual('ñandú', batch.first_names[1])
+        self.assertEqual('2000-12-21', batch.birthdates[1])
+
+    def test_invalid_birthdate_fails(self):
+        serialized = protocol.SerializeBet(Bet('1', 'first', 'last', '1', '2000-12-20', 1))
+
+        with self.assertRaises(protocol.MalformedBatchError):
+            decode_batch(serialized.replace(b'2000-12-20', b'2000-13-45'))
+
+    def test_invalid_utf8_fails(self):
+        serialized = protocol.SerializeBet(Bet('1', 'first', 'last', '1', '2000-12-20', 1))
+
+        with self.assertRaises(protocol.MalformedBatchError):
+            decode_batch(serialized.replace(b'first', b'fir\xff\xfe'))
+
+    def test_long_utf8_strings_are_kept(self):
+        to_send = [Bet('1', 'ñ' * 100, 'last', '1', '2000-12-20', 1)]
+
+        batch = decode_batch(protocol.SerializeBet(to_send[0]))
+
+        self.assertEqual('ñ' * 100, batch.first_names[0])
+
+    def test_decode_batch_builds_equal_bets(self):
+        to_send = [Bet('1', 'first', 'last', '10000000', '2000-12-20', 7500)]
+        batch = decode_batch(protocol.SerializeBet(to_send[0]))
+
+        self.assertEqual([bet_fields(bet) for bet in to_send], [bet_fields(bet) for bet in batch])
+
+
+class TestBatchInflater(unittest.TestCase):
+
+    def test_inflated_batch_gets_the_agency_back(self):
+        to_send = [Bet('12', f'first_{i}', 'ñandú', str(10000000 + i), '2000-12-20', i) for i in range(100)]
+        compressed = compress_batch(to_send)
+
+        inflater = BatchInflater(12)
+        # Chunks split bets at arbitrary points
+        for i in range(0, len(compressed), 7):
+            inflater.feed(compressed[i:i + 7])
+        batch = inflater.finish()
+
+        self.assertEqual(b''.join(protocol.SerializeBet(bet) for bet in to_send), batch)
+        self.assertEqual([bet_fields(bet) for bet in to_send], [bet_fields(bet) for bet in decode_batch(batch)])
+
+    def test_hoisting_the_agency_makes_the_batch_smaller(self):
+        to_send = [Bet('1', 'first', 'last', str(10000000 + i), '2000-12-20', i) for i in range(100)]
+
+        plain = b''.join(protocol.SerializeBet(bet) for bet in to_send)
+
+        self.assertEqual(len(plain) - 3 * 100, len(b''.join(protocol.SerializeHoistedBet(bet) for bet in to_send)))
+        self.assertLess(len(compress_batch(to_send)), len(plain) // 3)
+
+    def test_inflated_v2_batch_gets_the_agency_back(self):
+        to_send = [Bet('200', f'first_{i}', 'ñandú', str(10000000 + i), '2000-12-20', i) for i in range(100)]
+        compressed = compress_batch(to_send, version=protocol.PROTOCOL_V2)
+
+        inflater = BatchInflater(200, protocol.PROTOCOL_V2)
+        for i in range(0, len(compressed), 7):
+            inflater.feed(compressed[i:i + 7])
+
+        self.assertEqual(b''.join(protocol.SerializeBetV2(bet) for bet in to_send), inflater.finish())
+
+    def test_inflating_stops_at_max_size(self):
+        # 64 MiB of zeroes in a single 64 KiB chunk
+        bomb = zlib.compress(b'\x00' * (64 * 1024 * 1024), 9)
+
+        inflater = BatchInflater(1, max_size=8000)
+        inflater.feed(bomb)
+
+        # Not 64 MiB: the inflated bytes stop at the limit, and only get
+        # their agency fields back (5 bytes every 2 zeroes, empty bets)
+        self.assertLessEqual(len(inflater._batch) + len(inflater._pending), 8001 * 5 // 2)
+        with self.assertRaises(protocol.MalformedBatchError):
+            inflater.finish()
+
+    def test_broken_compressed_batch_fails(self):
+        compressed = compress_batch([Bet('1', 'first', 'last', '1', '2000-12-20', 1)])
+
+        for broken in (compressed[:-3], b'not zlib' + compressed):
+            inflater = BatchInflater(1)
+            inflater.feed(broken)
+            with self.assertRaises(ValueError):
+                inflater.finish()
+
+
+class TestFrameReader(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_read_does_not_consume_next_frame(self):
+        self.sender.sendall(b'abc' + b'defgh')
+        reader = FrameReader(self.receiver)
+
+        self.assertEqual(b'abc', bytes(reader.read(3)))
+        self.assertEqual(b'defgh', bytes(reader.read(5)))
+
+    def test_read_frames_bigger_than_the_buffer(self):
+        frame = bytes(range(256)) * 4
+        self.sender.sendall(frame)
+        reader = FrameReader(self.receiver, initial_size=16)
+
+        self.assertEqual(frame, bytes(reader.read(len(frame))))
+
+    def test_read_from_closed_connection_fails(self):
+        self.sender.sendall(b'ab')
+        self.sender.close()
+        reader = FrameReader(self.receiver)
+
+        with self.assertRaises(ConnectionError):
+            reader.read(3)
+
+
+class TestSendFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_send_frames_delivers_everything_in_order(self):
+        # Way more than the socket buffers, so sendmsg writes short
+        frames = [bytes([i % 256]) * 1000 for i in range(3000)]
+        expected = b''.join(frames)
+        received = []
+        reader = threading.Thread(target=lambda: received.append(bytes(FrameReader(self.receiver).read(len(expected)))))
+        reader.start()
+
+        send_frames(self.sender, frames)
+        reader.join(timeout=5)
+
+        self.assertEqual(expected, received[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,915 @@
+from common.utils import *
+from common.server import Server
+from common.async_server import AsyncServer
+from common.storage import CsvBetStore, BinaryBetStore, ShardedBetStore, RoundedBetStore, BINARY_STORAGE_FILEPATH, SHARDED_STORAGE_DIRPATH
+from common.storage import create_store, round_path, MergedBetStore
+from common.index import IndexedBetStore, INDEX_FILEPATH
+from common.query import QueryableBetStore, QUERY_INDEX_FILEPATH
+from common.pipeline import DEFAULT_PIPELINE_WINDOW
+from common.write_behind import WriteBehindStore
+from common.compression import COMPRESSION_ZLIB, compress_batch
+from common.admission import IngestBudget, IngestLimits
+from common.workers import MultiProcessServer
+from common.listener import listening_socket
+from common import protocol
+import glob
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+
+class AgencyClient:
+    """ Plays an agency over the wire protocol, a message at a time. Bets go in the negotiated protocol version """
+
+    def __init__(self, port, agency):
+        self.agency = agency
+        self.version = protocol.PROTOCOL_V1
+        self._skt = socket.create_connection(('localhost', port))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self._skt.close()
+
+    def send(self, data):
+        self._skt.sendall(data)
+
+    def receive(self, size):
+        return receive_exactly(self._skt, size)
+
+    def closed(self):
+        """ Whether the server closed the connection without answering """
+        return self._skt.recv(1) == b''
+
+    def hello(self):
+        self.send(protocol.SerializeString(str(self.agency)))
+
+    def hello_pipelined(self, window):
+        """ Returns the granted window """
+        agency_id = str(self.agency).encode('utf-8')
+        self.send(bytes([protocol.HANDSHAKE_PIPELINED, len(agency_id)]) + agency_id + bytes([window]))
+        return self.receive(1)[0]
+
+    def hello_with_options(self, options):
+        """ Returns the granted options and the sequence number to resume from, 0 unless resuming was granted """
+        agency_id = str(self.agency).encode('utf-8')
+        self.send(bytes([protocol.HANDSHAKE_OPTIONS, len(agency_id)]) + agency_id + protocol.SerializeOptions(options))
+        amount_of_options = self.receive(1)[0]
+        granted = protocol.DeserializeOptions(self.receive(2 * amount_of_options))
+        self.version = dict(granted).get(protocol.OPTION_VERSION, protocol.PROTOCOL_V1)
+        resume_from = 0
+        if dict(granted).get(protocol.OPTION_RESUME):
+            resume_from, _ = protocol.DeserializeUInteger64(self.receive(10))
+        return granted, resume_from
+
+    def send_frame(self, batch, sequence=None, indicator=protocol.BETS_BATCH):
+        header = protocol.SerializeUInteger8(indicator)
+        if sequence is not None:
+            header += protocol.SerializeUInteger64(sequence)
+        self.send(header + protocol.SerializeUInteger64(len(batch)) + batch)
+
+    def send_batch(self, bets, sequence=None, compressed=False):
+        if compressed:
+            self.send_frame(compress_batch(bets, version=self.version), sequence, protocol.BETS_BATCH_COMPRESSED)
+        else:
+            serialize_bet, _ = protocol.CODECS[self.version]
+            self.send_frame(b''.join(serialize_bet(bet) for bet in bets), sequence)
+
+    def receive_ack(self):
+        return self.receive(1)
+
+    def receive_sequenced_ack(self):
+        """ Returns the acked sequence number and the ack """
+        ack = self.receive(11)
+        return protocol.DeserializeUInteger64(ack[1:])[0], ack[0:1]
+
+    def send_round(self, round_id):
+        self.send(protocol.SerializeUInteger8(protocol.ROUND) + protocol.SerializeUInteger64(round_id))
+
+    def receive_round_ack(self):
+        """ Returns the ack and the open round """
+        ack = self.receive(11)
+        return ack[0:1], protocol.DeserializeUInteger64(ack[1:])[0]
+
+    def query(self, query, argument):
+        self.send(protocol.SerializeUInteger8(protocol.QUERY) + protocol.SerializeUInteger8(query) + argument)
+
+    def receive_answer(self, query):
+        """ Returns an amount for QUERY_COUNT, bets for the others """
+        header = self.receive(11)
+        if header[0] != protocol.QUERY_ANSWER:
+            raise ValueError(f"query answer expected, got {header[0]}")
+        size, _ = protocol.DeserializeUInteger64(header[1:])
+        data = self.receive(size)
+        return protocol.DeserializeUInteger64(data)[0] if query == protocol.QUERY_COUNT else protocol.DeserializeBets(data)
+
+    def end_bets(self):
+        self.send(protocol.SerializeUInteger8(protocol.BETS_END))
+
+    def receive_winners(self):
+        _, deserialize_bets = protocol.CODECS[self.version]
+        header = self.receive(11)
+        size, _ = protocol.DeserializeUInteger64(header[1:])
+        return deserialize_bets(self.receive(size))
+
+
+def batches_of(bets, batch_size):
+    return [bets[i:i + batch_size] for i in range(0, len(bets), batch_size)]
+
+
+def send_agency(port, agency, bets, batch_size=2):
+    """ Plays an agency over the wire protocol. Returns the acks and the winners """
+    with AgencyClient(port, agency) as client:
+        client.hello()
+        acks = []
+        for batch in batches_of(bets, batch_size):
+            client.send_batch(batch)
+            acks.append(client.receive_ack())
+        client.end_bets()
+        return acks, client.receive_winners()
+
+
+def send_agency_pipelined(port, agency, bets, window, batch_size=2):
+    """ Like send_agency, but every batch is sent before reading any ack. Returns the granted window too """
+    with AgencyClient(port, agency) as client:
+        granted = client.hello_pipelined(window)
+        batches = batches_of(bets, batch_size)
+        for sequence, batch in enumerate(batches):
+            client.send_batch(batch, sequence)
+        acks = dict(client.receive_sequenced_ack() for _ in batches)
+        client.end_bets()
+        return granted, acks, client.receive_winners()
+
+
+def send_agency_compressed(port, agency, bets, options, batch_size=2, compressed=True):
+    """ Like send_agency, but negotiating options and sending compressed batches. Returns the granted options too """
+    with AgencyClient(port, agency) as client:
+        granted, _ = client.hello_with_options(options)
+        acks = []
+        for batch in batches_of(bets, batch_size):
+            client.send_batch(batch, compressed=compressed)
+            acks.append(client.receive_ack())
+        client.end_bets()
+        return granted, acks, client.receive_winners()
+
+
+def send_agency_resuming(port, agency, bets, batch_size=2, leave_after=None):
+    """
+    Like send_agency_pipelined, asking to resume: batches before the sequence number the server answers are
+    skipped. With leave_after, the agency leaves once that batch was acked, without ending its bets.
+    Returns the granted options, the sequence number it resumed from and the winners, None if it left
+    """
+    with AgencyClient(port, agency) as client:
+        granted, resume_from = client.hello_with_options([(protocol.OPTION_WINDOW, 4), (protocol.OPTION_RESUME, 1)])
+        batches = batches_of(bets, batch_size)
+        for sequence in range(resume_from, len(batches) if leave_after is None else leave_after):
+            client.send_batch(batches[sequence], sequence)
+            client.receive_sequenced_ack()
+        if leave_after is not None:
+            return granted, resume_from, None
+        client.end_bets()
+        return granted, resume_from, client.receive_winners()
+
+
+def send_agency_querying(port, agency, bets, queries, batch_size=2):
+    """
+    Like send_agency_pipelined, sending the (query, serialized argument) queries right after the batches,
+    before reading any ack. Returns the answers
+    """
+    with AgencyClient(port, agency) as client:
+        client.hello_pipelined(DEFAULT_PIPELINE_WINDOW)
+        batches = batches_of(bets, batch_size)
+        for sequence, batch in enumerate(batches):
+            client.send_batch(batch, sequence)
+        for query, argument in queries:
+            client.query(query, argument)
+        for _ in batches:
+            client.receive_sequenced_ack()
+        answers = [client.receive_answer(query) for query, _ in queries]
+        client.end_bets()
+        client.receive_winners()
+        return answers
+
+
+def bet_on_rounds(port, agency, bets_by_round, batch_size=2):
+    """ Plays an agency betting on successive rounds over a single connection. Returns the round acks and winners """
+    results = []
+    with AgencyClient(port, agency) as client:
+        client.hello()
+        for round_id, bets in bets_by_round:
+            client.send_round(round_id)
+            round_ack, open_round = client.receive_round_ack()
+            for batch in batches_of(bets, batch_size):
+                client.send_batch(batch)
+                client.receive_ack()
+            client.end_bets()
+            results.append((round_ack, open_round, client.receive_winners()))
+    return results
+
+
+def bet_on_open_round(port, agency, round_id, bets):
+    """
+    Plays an agency betting on a single round, connecting again until the
+    server acks it as the open one: a worker may learn late that the round
+    before ended. Returns the winners
+    """
+    while True:
+        with AgencyClient(port, agency) as client:
+            client.hello()
+            client.send_round(round_id)
+            if client.receive_round_ack()[0] != protocol.ACK_OK:
+                time.sleep(0.01)
+                continue
+            client.send_batch(bets)
+            client.receive_ack()
+            client.end_bets()
+            return client.receive_winners()
+
+
+def receive_exactly(skt, size):
+    buff = b''
+    while len(buff) < size:
+        received = skt.recv(size - len(buff))
+        if not received:
+            raise ConnectionError("connection closed")
+        buff += received
+    return buff
+
+
+class ServerEnginesTest:
+    """ Runs against every engine and storage through `engine` and `store` """
+    engine = None
+    store = CsvBetStore
+    limits = None
+
+    def setUp(self):
+        self.server = self.engine(0, 5, 2, self.store(), limits=self.limits)
+        self.port = self.server._server_socket.getsockname()[1]
+        self.server_thread = threading.Thread(target=self.server.run)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.finalize()
+        self.server_thread.join(timeout=5)
+        for path in (STORAGE_FILEPATH, BINARY_STORAGE_FILEPATH, INDEX_FILEPATH, QUERY_INDEX_FILEPATH, *glob.glob("./bets.round-*"),
+                     *glob.glob("./bets.worker-*")):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree(SHARDED_STORAGE_DIRPATH, ignore_errors=True)
+
+    def stored_bets(self):
+        """ Bets of the first round, the engine may be on the next one by now """
+        return self.server._store.load()
+
+    def test_every_agency_receives_only_its_winners(self):
+        bets = {
+            1: [Bet('1', 'first', 'last', '1', '2000-12-20', LOTTERY_WINNER_NUMBER),
+                Bet('1', 'first', 'last', '2', '2000-12-20', 1),
+                Bet('1', 'first', 'last', '3', '2000-12-20', LOTTERY_WINNER_NUMBER)],
+            2: [Bet('2', 'first', 'last', '4', '2000-12-20', 2)],
+        }
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda agency=agency: results.update({agency: send_agency(self.port, agency, bets[agency])}))
+            for agency in bets
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        acks, winners = results[1]
+        self.assertEqual([protocol.ACK_OK, protocol.ACK_OK], acks)
+        self.assertEqual(['1', '3'], [winner.document for winner in winners])
+
+        acks, winners = results[2]
+        self.assertEqual([protocol.ACK_OK], acks)
+        self.assertEqual([], winners)
+
+        self.assertEqual(4, len(self.stored_bets()))
+
+    def test_pipelined_batches_of_agencies_are_stored_in_order(self):
+        bets = {agency: [Bet(str(agency), 'first', 'last', str(i), '2000-12-20', i) for i in range(60)] for agency in (1, 2)}
+        agencies = [
+            threading.Thread(target=send_agency_pipelined, args=(self.port, agency, bets[agency], 255, 1))
+            for agency in bets
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        stored = self.stored_bets()
+        for agency in bets:
+            self.assertEqual([str(i) for i in range(60)], [bet.document for bet in stored if bet.agency == agency])
+
+    def test_pipelined_agency_is_acked_by_sequence_number(self):
+        pipelined_bets = [Bet('1', 'first', 'last', str(i), '2000-12-20', LOTTERY_WINNER_NUMBER if i == 7 else i)
+                          for i in range(10)]
+        plain_bets = [Bet('2', 'first', 'last', '100', '2000-12-20', LOTTERY_WINNER_NUMBER)]
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda: results.update({1: send_agency_pipelined(self.port, 1, pipelined_bets, 255)})),
+            threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, plain_bets)})),
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        granted, acks, winners = results[1]
+        self.assertEqual(DEFAULT_PIPELINE_WINDOW, granted)
+        self.assertEqual({sequence: protocol.ACK_OK for sequence in range(5)}, acks)
+        self.assertEqual(['7'], [winner.document for winner in winners])
+
+        acks, winners = results[2]
+        self.assertEqual([protocol.ACK_OK], acks)
+        self.assertEqual(['100'], [winner.document for winner in winners])
+
+        self.assertEqual(11, len(self.stored_bets()))
+
+    def test_agency_resumes_after_its_last_stored_batch(self):
+        bets = [Bet('1', 'first', 'last', str(i), '2000-12-20', LOTTERY_WINNER_NUMBER if i == 9 else i)
+                for i in range(10)]
+        granted, _, _ = send_agency_resuming(self.port, 1, bets, leave_after=3)
+        if not getattr(self.server._store, 'resumable', False):
+            self.assertEqual((protocol.OPTION_RESUME, 0), granted[-1])
+            return
+
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda: results.update({1: send_agency_resuming(self.port, 1, bets)})),
+            threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, [Bet('2', 'first', 'last', '100', '2000-12-20', 1)])})),
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        granted, resume_from, winners = results[1]
+        self.assertEqual([(protocol.OPTION_WINDOW, 4), (protocol.OPTION_RESUME, 1)], granted)
+        self.assertEqual(3, resume_from)
+        self.assertEqual(['9'], [winner.document for winner in winners])
+        self.assertEqual(sorted([str(i) for i in range(10)] + ['100']), sorted(bet.document for bet in self.stored_bets()))
+
+    def test_agency_queries_its_own_bets(self):
+        bets = [Bet('1', 'first', 'last', str(i % 4), '2000-12-20', i) for i in range(10)]
+        queries = [
+            (protocol.QUERY_COUNT, b''),
+            (protocol.QUERY_DOCUMENT, protocol.SerializeString('3')),
+            (protocol.QUERY_NUMBER, protocol.SerializeUInteger64(5)),
+            (protocol.QUERY_DOCUMENT, protocol.SerializeString('100')),
+        ]
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda: results.update({1: send_agency_querying(self.port, 1, bets, queries)})),
+            threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, [Bet('2', 'first', 'last', '3', '2000-12-20', 5)])})),
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        count, by_document, by_number, missing = results[1]
+        self.assertEqual(10, count)
+        self.assertEqual([(1, 3), (1, 7)], sorted((bet.agency, bet.number) for bet in by_document))
+        self.assertEqual([(1, '1')], [(bet.agency, bet.document) for bet in by_number])
+        self.assertEqual([], missing)
+
+    def test_compressed_batches_are_stored_as_plain_ones(self):
+        compressed_bets = [Bet('1', 'first', 'last', str(i), '2000-12-20', LOTTERY_WINNER_NUMBER if i == 3 else i)
+                           for i in range(5)]
+        plain_bets = [Bet('2', 'first', 'last', '100', '2000-12-20', 1)]
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda: results.update({1: send_agency_compressed(
+                self.port, 1, compressed_bets, [(protocol.OPTION_COMPRESSION, COMPRESSION_ZLIB), (200, 1)])})),
+            threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, plain_bets)})),
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        granted, acks, winners = results[1]
+        self.assertEqual([(protocol.OPTION_COMPRESSION, COMPRESSION_ZLIB), (200, 0)], granted)
+        self.assertEqual([protocol.ACK_OK] * 3, acks)
+        self.assertEqual(['3'], [winner.document for winner in winners])
+        self.assertEqual(6, len(self.stored_bets()))
+
+    def test_compressed_batches_without_negotiating_fail(self):
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda agency=agency: results.update({agency: send_agency_compressed(
+                self.port, agency, [Bet(str(agency), 'first', 'last', '1', '2000-12-20', 1)], [])}))
+            for agency in (1, 2)
+        ]
+        # Only read, never inflated
+        with mock.patch('common.server.BatchInflater') as inflater, \
+                mock.patch('common.async_server.BatchInflater') as async_inflater:
+            for agency in agencies:
+                agency.start()
+            for agency in agencies:
+                agency.join(timeout=5)
+
+        self.assertEqual([protocol.ACK_FAIL], results[1][1])
+        self.assertEqual(0, len(self.stored_bets()))
+        inflater.assert_not_called()
+        async_inflater.assert_not_called()
+
+    def test_agencies_speaking_v2_and_v1_share_the_draw(self):
+        v2_bets = [Bet('1', 'ñandú', 'last', str(i), '1999-03-17', LOTTERY_WINNER_NUMBER if i % 2 else 300 + i)
+                   for i in range(5)]
+        plain_bets = [Bet('2', 'first', 'last', '100', '2000-12-20', LOTTERY_WINNER_NUMBER)]
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda: results.update({1: send_agency_compressed(
+                self.port, 1, v2_bets, [(protocol.OPTION_VERSION, 9)], compressed=False)})),
+            threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, plain_bets)})),
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        granted, acks, winners = results[1]
+        self.assertEqual([(protocol.OPTION_VERSION, protocol.PROTOCOL_V2)], granted)
+        self.assertEqual([protocol.ACK_OK] * 3, acks)
+        self.assertEqual([('ñandú', '1', '1999-03-17'), ('ñandú', '3', '1999-03-17')],
+                         [(winner.first_name, winner.document, winner.birthdate.isoformat()) for winner in winners])
+        self.assertEqual(['100'], [winner.document for winner in results[2][1]])
+        self.assertEqual(6, len(self.stored_bets()))
+
+    def test_compressed_v2_batches(self):
+        compressed_bets = [Bet('1', 'first', 'last', str(i), '2000-12-20', LOTTERY_WINNER_NUMBER + i) for i in range(3)]
+        options = [(protocol.OPTION_COMPRESSION, COMPRESSION_ZLIB), (protocol.OPTION_VERSION, protocol.PROTOCOL_V2)]
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda: results.update({1: send_agency_compressed(
+                self.port, 1, compressed_bets, options)})),
+            threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, [])})),
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        granted, acks, winners = results[1]
+        self.assertEqual(options, granted)
+        self.assertEqual([protocol.ACK_OK] * 2, acks)
+        self.assertEqual(['0'], [winner.document for winner in winners])
+        self.assertEqual(3, len(self.stored_bets()))
+
+    def test_broken_frames_only_drop_their_agency(self):
+        broken_frames = [
+            # Not an uint64 length
+            protocol.SerializeUInteger8(protocol.BETS_BATCH) + b'\x07' * 10,
+            # Unknown message indicator
+            bytes([200]),
+            # Absurd length
+            protocol.SerializeUInteger8(protocol.BETS_BATCH) + protocol.SerializeUInteger64(2 ** 62),
+        ]
+        for frame in broken_frames:
+            with AgencyClient(self.port, 9) as client:
+                client.hello()
+                client.send(frame)
+                # Dropped: the connection is closed without an answer
+                self.assertTrue(client.closed())
+
+        bets = {agency: [Bet(str(agency), 'first', 'last', str(agency), '2000-12-20', LOTTERY_WINNER_NUMBER)] for agency in (1, 2)}
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda agency=agency: results.update({agency: send_agency(self.port, agency, bets[agency])}))
+            for agency in bets
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        self.assertEqual(['1'], [winner.document for winner in results[1][1]])
+        self.assertEqual(['2'], [winner.document for winner in results[2][1]])
+        self.assertEqual({'batches': 0, 'connections': 3}, self.server.failures())
+
+    def test_malformed_batch_is_rejected_and_counted(self):
+        valid = protocol.SerializeBet(Bet('1', 'first', 'last', '1', '2000-12-20', LOTTERY_WINNER_NUMBER))
+        acks = []
+        results = {}
+        agency = threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, [])}))
+        agency.start()
+        with AgencyClient(self.port, 1) as client:
+            client.hello()
+            # Truncated bet, then the same bet whole: the connection is still in sync
+            for batch in (valid[:-3], valid):
+                client.send_frame(batch)
+                acks.append(client.receive_ack())
+            client.end_bets()
+            winners = client.receive_winners()
+        agency.join(timeout=5)
+
+        self.assertEqual([protocol.ACK_FAIL, protocol.ACK_OK], acks)
+        self.assertEqual(['1'], [winner.document for winner in winners])
+        self.assertEqual({'batches': 1, 'connections': 0}, self.server.failures())
+
+    def test_batches_with_invalid_values_are_rejected_and_the_draw_completes(self):
+        valid = protocol.SerializeBet(Bet('1', 'first', 'last', '1', '2000-12-20', LOTTERY_WINNER_NUMBER))
+        acks = []
+        results = {}
+        agency = threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, [])}))
+        agency.start()
+        with AgencyClient(self.port, 1) as client:
+            client.hello()
+            for batch in (valid.replace(b'2000-12-20', b'2000-13-45'), valid.replace(b'first', b'fir\xff\xfe'), valid):
+                client.send_frame(batch)
+                acks.append(client.receive_ack())
+            client.end_bets()
+            winners = client.receive_winners()
+        agency.join(timeout=5)
+
+        self.assertEqual([protocol.ACK_FAIL, protocol.ACK_FAIL, protocol.ACK_OK], acks)
+        self.assertEqual(['1'], [winner.document for winner in winners])
+        self.assertEqual(['1'], [bet.document for bet in self.stored_bets()])
+
+    def test_round_that_cannot_be_drawn_drops_its_agencies(self):
+        def winner_number(round_id):
+            if round_id == 1:
+                raise ValueError("unreadable round")
+            return round_winner_number(round_id)
+        self.server._winner_number = winner_number
+        second_number = round_winner_number(2)
+        # Bets of the dropped round are kept, so they must not win the next one
+        dropped_bets = {agency: [Bet(str(agency), 'first', 'last', '0', '2000-12-20', second_number + 1)] for agency in (1, 2)}
+        bets = {agency: [Bet(str(agency), 'first', 'last', str(agency), '2000-12-20', second_number)] for agency in (1, 2)}
+
+        dropped = {}
+        agencies = [
+            threading.Thread(target=lambda agency=agency: dropped.update(
+                {agency: self.assertRaises(ConnectionError, send_agency, self.port, agency, dropped_bets[agency])}))
+            for agency in bets
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+        self.assertEqual({1, 2}, set(dropped))
+
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda agency=agency: results.update({agency: bet_on_open_round(self.port, agency, 2, bets[agency])}))
+            for agency in bets
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        for agency in (1, 2):
+            self.assertEqual([str(agency)], [winner.document for winner in results[agency]])
+
+    def test_agencies_bet_on_successive_rounds_on_the_same_connection(self):
+        second_number = round_winner_number(2)
+        bets_by_agency = {
+            agency: [
+                (1, [Bet(str(agency), 'first', 'last', f'{agency}1', '2000-12-20', LOTTERY_WINNER_NUMBER)]),
+                (2, [Bet(str(agency), 'first', 'last', f'{agency}2', '2000-12-20', second_number)]),
+            ]
+            for agency in (1, 2)
+        }
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda agency=agency: results.update({agency: bet_on_rounds(self.port, agency, bets_by_agency[agency])}))
+            for agency in bets_by_agency
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        for agency in (1, 2):
+            (first_ack, first_round, first_winners), (second_ack, second_round, second_winners) = results[agency]
+            self.assertEqual((protocol.ACK_OK, 1), (first_ack, first_round))
+            self.assertEqual([f'{agency}1'], [winner.document for winner in first_winners])
+            self.assertEqual((protocol.ACK_OK, 2), (second_ack, second_round))
+            self.assertEqual([f'{agency}2'], [winner.document for winner in second_winners])
+
+    def test_round_is_answered_after_the_acks_before_it(self):
+        bets = [Bet('1', 'first', 'last', str(i), '2000-12-20', i) for i in range(20)]
+        agency = threading.Thread(target=send_agency, args=(self.port, 2, []))
+        agency.start()
+        with AgencyClient(self.port, 1) as client:
+            client.hello_pipelined(DEFAULT_PIPELINE_WINDOW)
+            for sequence, bet in enumerate(bets):
+                client.send_batch([bet], sequence)
+            client.send_round(1)
+
+            acks = dict(client.receive_sequenced_ack() for _ in bets)
+            round_ack = client.receive_round_ack()
+            client.end_bets()
+            client.receive_winners()
+        agency.join(timeout=5)
+
+        self.assertEqual({sequence: protocol.ACK_OK for sequence in range(20)}, acks)
+        self.assertEqual((protocol.ACK_OK, 1), round_ack)
+
+    def test_bets_for_a_drawn_round_are_rejected(self):
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda agency=agency: results.update({agency: bet_on_rounds(self.port, agency, [(1, []), (1, [])])}))
+            for agency in (1, 2)
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        self.assertEqual([(protocol.ACK_OK, 1), (protocol.ACK_FAIL, 2)], [result[:2] for result in results[1]])
+
+    def test_finalize_stops_server_waiting_for_agencies(self):
+        self.server.finalize()
+        self.server_thread.join(timeout=5)
+        self.assertFalse(self.server_thread.is_alive())
+
+
+class IngestLimitsTest(ServerEnginesTest):
+    """ Every engine test again, with room for a single small batch at a time """
+    limits = IngestLimits(max_batch_bytes=256, max_buffered_bytes=256, max_decoding=1)
+
+    def test_batch_over_max_batch_bytes_drops_its_agency(self):
+        batch = b''.join(protocol.SerializeBet(Bet('9', 'first', 'last', str(i), '2000-12-20', i)) for i in range(10))
+        self.assertGreater(len(batch), self.limits.max_batch_bytes)
+        with AgencyClient(self.port, 9) as client:
+            client.hello()
+            # Dropped on the header, the batch is never read
+            client.send(protocol.SerializeUInteger8(protocol.BETS_BATCH) + protocol.SerializeUInteger64(len(batch)))
+            self.assertTrue(client.closed())
+
+        self.assertEqual({'batches': 0, 'connections': 1}, self.server.failures())
+
+    def test_stored_batches_are_no_longer_buffered(self):
+        bets = [Bet('1', 'first', 'last', str(i), '2000-12-20', i) for i in range(20)]
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda: results.update({1: send_agency_pipelined(self.port, 1, bets, 8)})),
+            threading.Thread(target=lambda: results.update({2: send_agency(self.port, 2, bets[:4])})),
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        self.assertEqual({sequence: protocol.ACK_OK for sequence in range(10)}, results[1][1])
+        self.assertEqual(0, self.server._budget.buffered)
+
+
+class MultiProcessServerTest(ServerEnginesTest):
+    """ Every engine test again, ingesting from two worker processes that store to `backend` """
+    backend = None
+    workers = 2
+
+    def setUp(self):
+        self.server = MultiProcessServer(0, 5, 2, self.open_store, self.open_draw_store, self.workers)
+        self.port = self.server._server_socket.getsockname()[1]
+        self.server_thread = threading.Thread(target=self.server.run)
+        self.server_thread.start()
+
+    def open_store(self, worker):
+        return RoundedBetStore(lambda round_id: create_store(self.backend, round_id=round_id, worker=worker))
+
+    def open_draw_store(self, round_id):
+        return MergedBetStore([create_store(self.backend, round_id=round_id, worker=worker, read_only=True) for worker in range(self.workers)])
+
+    def stored_bets(self):
+        store = self.open_draw_store(1)
+        try:
+            return store.load()
+        finally:
+            store.close()
+
+    def test_agency_resumes_after_its_last_stored_batch(self):
+        # The agency may come back through another worker
+        granted, _, _ = send_agency_resuming(self.port, 1, [Bet('1', 'first', 'last', '1', '2000-12-20', 1)], leave_after=0)
+        self.assertEqual((protocol.OPTION_RESUME, 0), granted[-1])
+
+    def test_agencies_go_on_through_the_workers_left(self):
+        process, _ = self.server._workers[0]
+        process.kill()
+        process.join(timeout=5)
+
+        bets = {agency: [Bet(str(agency), 'first', 'last', str(agency), '2000-12-20', LOTTERY_WINNER_NUMBER)] for agency in (1, 2)}
+        results = {}
+        agencies = [
+            threading.Thread(target=lambda agency=agency: results.update({agency: send_agency(self.port, agency, bets[agency])}))
+            for agency in bets
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        self.assertEqual(['1'], [winner.document for winner in results[1][1]])
+        self.assertEqual(['2'], [winner.document for winner in results[2][1]])
+
+
+class TestIngestBudget(unittest.TestCase):
+
+    def test_reserving_waits_until_the_batch_fits(self):
+        budget = IngestBudget(IngestLimits(max_batch_bytes=100, max_buffered_bytes=150))
+        budget.reserve(100)
+        reserved = threading.Event()
+        reserver = threading.Thread(target=lambda: (budget.reserve(100), reserved.set()))
+        reserver.start()
+
+        self.assertFalse(reserved.wait(0.1))
+        budget.release(100)
+        self.assertTrue(reserved.wait(5))
+        reserver.join()
+        self.assertEqual(100, budget.buffered)
+
+    def test_bytes_taken_without_waiting_may_go_over(self):
+        budget = IngestBudget(IngestLimits(max_batch_bytes=100, max_buffered_bytes=100))
+        budget.reserve(100)
+        budget.reserve(50, wait=False)
+        self.assertEqual(150, budget.buffered)
+
+    def test_closing_wakes_up_waiting_connections(self):
+        budget = IngestBudget(IngestLimits(max_batch_bytes=100, max_buffered_bytes=100))
+        budget.reserve(100)
+        errors = []
+        def reserve():
+            try:
+                budget.reserve(100)
+            except ConnectionAbortedError as e:
+                errors.append(e)
+        reserver = threading.Thread(target=reserve)
+        reserver.start()
+
+        budget.close()
+        reserver.join(timeout=5)
+        self.assertEqual(1, len(errors))
+
+    def test_limits_must_fit_a_batch(self):
+        for limits in ({'max_batch_bytes': 0}, {'max_batch_bytes': 100, 'max_buffered_bytes': 99}, {'max_decoding': 0}):
+            with self.assertRaises(ValueError):
+                IngestLimits(**limits)
+
+
+class TestListener(unittest.TestCase):
+
+    def test_activated_socket_is_taken_over(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        # As systemd passes it: descriptor 3, LISTEN_PID being the process that takes it
+        script = ("import os; from common.listener import listening_socket; "
+                  "skt = listening_socket(0, 5); print(skt.getsockname()[1], 'LISTEN_FDS' in os.environ)")
+        activate = (f"import os, sys; os.dup2({listener.fileno()}, 3); "
+                    f"os.environ.update(LISTEN_PID=str(os.getpid()), LISTEN_FDS='1'); "
+                    f"os.execv(sys.executable, [sys.executable, '-c', {script!r}])")
+        child = subprocess.run([sys.executable, '-c', activate], pass_fds=(listener.fileno(),),
+                               capture_output=True, text=True, timeout=10,
+                               env=dict(os.environ, PYTHONPATH=os.getcwd()))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        self.assertEqual(f'{port} False', child.stdout.strip(), child.stderr)
+
+    def test_without_activation_the_port_is_bound(self):
+        skt = listening_socket(0, 5)
+        try:
+            with socket.create_connection(('localhost', skt.getsockname()[1])):
+                pass
+        finally:
+            skt.close()
+
+
+class TestServer(ServerEnginesTest, unittest.TestCase):
+    engine = Server
+
+    def test_winners_of_an_agency_that_left_are_skipped(self):
+        with self.assertLogs(level='ERROR') as logs:
+            self.server._send_winners({7: protocol.WinnersFrames([])})
+
+        self.assertIn('action: send_winners | result: fail | agency: 7 | error: disconnected', logs.output[0])
+        # The agencies lock was not left taken
+        self.assertTrue(self.server._client_by_agente_lock.acquire(timeout=1))
+        self.server._client_by_agente_lock.release()
+
+
+class TestServerIngestLimits(IngestLimitsTest, unittest.TestCase):
+    engine = Server
+
+
+class TestAsyncServerIngestLimits(IngestLimitsTest, unittest.TestCase):
+    engine = AsyncServer
+    store = BinaryBetStore
+
+
+class TestAsyncServer(ServerEnginesTest, unittest.TestCase):
+    engine = AsyncServer
+
+
+class TestMultiProcessServer(MultiProcessServerTest, unittest.TestCase):
+    backend = "csv"
+
+
+class TestMultiProcessServerShardedStore(MultiProcessServerTest, unittest.TestCase):
+    backend = "sharded"
+
+
+class TestServerBinaryStore(ServerEnginesTest, unittest.TestCase):
+    engine = Server
+    store = BinaryBetStore
+
+
+class TestAsyncServerShardedStore(ServerEnginesTest, unittest.TestCase):
+    engine = AsyncServer
+    store = ShardedBetStore
+
+
+class TestServerIndexedStore(ServerEnginesTest, unittest.TestCase):
+    engine = Server
+
+    @staticmethod
+    def store():
+        return IndexedBetStore(ShardedBetStore())
+
+
+class TestServerQueryableStore(ServerEnginesTest, unittest.TestCase):
+    engine = Server
+
+    @staticmethod
+    def store():
+        return QueryableBetStore(IndexedBetStore(ShardedBetStore()))
+
+
+class TestAsyncServerQueryableStore(ServerEnginesTest, unittest.TestCase):
+    engine = AsyncServer
+
+    @staticmethod
+    def store():
+        return WriteBehindStore(RoundedBetStore(lambda round_id: QueryableBetStore(
+            create_store("binary", round_id=round_id), round_path(QUERY_INDEX_FILEPATH, round_id))))
+
+    def stored_bets(self):
+        return BinaryBetStore(BINARY_STORAGE_FILEPATH, read_only=True).load()
+
+
+class TestServerWriteBehindStore(ServerEnginesTest, unittest.TestCase):
+    engine = Server
+
+    @staticmethod
+    def store():
+        return WriteBehindStore(CsvBetStore())
+
+
+class TestAsyncServerWriteBehindStore(ServerEnginesTest, unittest.TestCase):
+    engine = AsyncServer
+
+    @staticmethod
+    def store():
+        return WriteBehindStore(RoundedBetStore(lambda round_id: create_store("binary", round_id=round_id)))
+
+    def stored_bets(self):
+        return BinaryBetStore(BINARY_STORAGE_FILEPATH, read_only=True).load()
+
+
+class TestAsyncServerRoundedStore(ServerEnginesTest, unittest.TestCase):
+    engine = AsyncServer
+
+    @staticmethod
+    def store():
+        return RoundedBetStore(lambda round_id: create_store("binary", round_id=round_id))
+
+    def stored_bets(self):
+        return BinaryBetStore(BINARY_STORAGE_FILEPATH, read_only=True).load()
+
+    def test_every_round_is_stored_apart(self):
+        bets_by_agency = {
+            agency: [(1, [Bet(str(agency), 'first', 'last', '1', '2000-12-20', 1)]),
+                     (2, [Bet(str(agency), 'first', 'last', '2', '2000-12-20', 2)] * 3)]
+            for agency in (1, 2)
+        }
+        agencies = [
+            threading.Thread(target=lambda agency=agency: bet_on_rounds(self.port, agency, bets_by_agency[agency]))
+            for agency in bets_by_agency
+        ]
+        for agency in agencies:
+            agency.start()
+        for agency in agencies:
+            agency.join(timeout=5)
+
+        self.assertEqual(2, len(BinaryBetStore(BINARY_STORAGE_FILEPATH, read_only=True).load()))
+        self.assertEqual(6, len(BinaryBetStore("./bets.round-2.bin", read_only=True).load()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,668 @@
+from common.utils import *
+import struct
+from common.storage import CsvBetStore, BinaryBetStore, ShardedBetStore, RoundedBetStore, export_csv
+from common.storage import create_store, round_path, worker_path, MergedBetStore, SHARDED_STORAGE_DIRPATH
+from common.index import IndexedBetStore, BetIndex
+from common.query import QueryableBetStore, count_bets, bets_with_document, bets_with_number
+from common.storage import winners_in_partition
+from common.write_behind import WriteBehindStore
+from common.draw import draw
+from common.batch import decode_batch, decode_batch_v2
+from common import protocol
+import os
+import tempfile
+import threading
+import unittest
+
+
+class TestBinaryBetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bets.bin')
+        self.store = BinaryBetStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_empty_store_loads_nothing(self):
+        self.assertEqual(0, len(self.store.load()))
+        self.assertEqual(0, len(self.store.winners()))
+
+    def test_store_and_load_keeps_fields_and_order(self):
+        to_store = [
+            Bet('0', 'first_0', 'last_0', '10000000', '2000-12-20', 7500),
+            Bet('1', 'ñandú', 'last_1', '10000001', '2000-12-21', 7501),
+        ]
+        self.store.store(to_store[:1])
+        self.store.store(decode_batch(protocol.SerializeBet(to_store[1])))
+
+        from_load = self.store.load()
+
+        self.assertEqual(2, len(from_load))
+        for stored, loaded in zip(to_store, from_load):
+            self.assertEqual(list(stored_fields(stored)), list(stored_fields(loaded)))
+
+    def test_longest_v2_bets_are_stored_and_sent_to_v1_agencies(self):
+        # The longest a v2 batch lets through, 255 bytes as v1
+        longest = Bet('300', 'ñandú', 'b' * 207, '10000001', '2000-12-20', LOTTERY_WINNER_NUMBER)
+        self.store.store(decode_batch_v2(protocol.SerializeBetV2(longest)))
+
+        winners = self.store.winners()
+
+        self.assertEqual([list(stored_fields(longest))], [list(stored_fields(bet)) for bet in winners])
+        message = protocol.SerializeWinners(winners, protocol.PROTOCOL_V1)
+        self.assertEqual(['b' * 207], [bet.last_name for bet in protocol.DeserializeBets(message[11:])])
+
+    def test_winners_only_returns_winner_number_bets(self):
+        self.store.store([
+            Bet('1', 'first', 'last', '1', '2000-12-20', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'first', 'last', '2', '2000-12-20', LOTTERY_WINNER_NUMBER + 1),
+        ])
+        self.store.store([Bet('2', 'first', 'last', '3', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+
+        winners = self.store.winners()
+
+        self.assertEqual([(1, '1'), (2, '3')], [(bet.agency, bet.document) for bet in winners])
+
+    def test_reopened_store_appends(self):
+        self.store.store([Bet('1', 'first', 'last', '1', '2000-12-20', 1)])
+        self.store.close()
+        self.store = BinaryBetStore(self.path)
+        self.store.store([Bet('1', 'first', 'last', '2', '2000-12-20', 2)])
+
+        self.assertEqual(['1', '2'], [bet.document for bet in self.store.load()])
+
+    def test_torn_or_corrupted_records_are_dropped_on_open(self):
+        for damage in (lambda data: data[:-5], lambda data: data[:-1] + bytes([data[-1] ^ 0xff])):
+            self.store.close()
+            os.remove(self.path)
+            self.store = BinaryBetStore(self.path)
+            self.store.store([Bet('1', 'first', 'last', '1', '2000-12-20', 1)])
+            self.store.store([Bet('1', 'first', 'last', '2', '2000-12-20', 2)])
+            self.store.close()
+            with open(self.path, 'rb') as file:
+                data = file.read()
+            with open(self.path, 'wb') as file:
+                file.write(damage(data))
+
+            self.store = BinaryBetStore(self.path)
+            self.store.store([Bet('1', 'first', 'last', '3', '2000-12-20', 3)])
+
+            self.assertEqual(['1', '3'], [bet.document for bet in self.store.load()])
+
+    def test_sequence_numbers_survive_reopening(self):
+        self.store.store(decode_batch(protocol.SerializeBet(Bet('3', 'first', 'last', '1', '2000-12-20', 1))), 0)
+        self.store.store([Bet('3', 'first', 'last', '2', '2000-12-20', 2)], 1)
+        self.store.store([Bet('4', 'first', 'last', '3', '2000-12-20', 3)])
+        self.store.close()
+
+        self.store = BinaryBetStore(self.path)
+
+        self.assertEqual(2, self.store.next_sequence(3))
+        self.assertEqual(0, self.store.next_sequence(4))
+
+    def test_sequence_numbers_are_kept_for_the_agency_of_the_writer(self):
+        writer = self.store.writer(3)
+        writer.store([], 4)
+        self.assertEqual(5, self.store.next_sequence(3))
+        # A batch claiming another agency still counts for the one sending it
+        writer.store(decode_batch(protocol.SerializeBet(Bet('5', 'first', 'last', '1', '2000-12-20', 1))), 5)
+        self.store.close()
+
+        self.store = BinaryBetStore(self.path)
+
+        self.assertEqual(6, self.store.next_sequence(3))
+        self.assertEqual(0, self.store.next_sequence(5))
+
+    def test_missing_log_reads_as_empty_when_read_only(self):
+        store = BinaryBetStore(os.path.join(self.directory.name, 'missing.bin'), read_only=True)
+
+        self.assertEqual(0, len(store.load()))
+        self.assertEqual(0, len(store.winners()))
+        self.assertFalse(os.path.exists(store.path))
+
+    def test_legacy_log_can_only_be_read(self):
+        payload = protocol.SerializeBet(Bet('1', 'first', 'last', '1', '2000-12-20', 7500))
+        with open(self.path, 'wb') as file:
+            file.write(BinaryBetStore.LEGACY_FILE_MAGIC + struct.pack('<IIqI', 1, len(payload), 7500, 0) + payload)
+
+        self.assertEqual(['1'], [bet.document for bet in BinaryBetStore(self.path, read_only=True).load()])
+        with self.assertRaises(ValueError):
+            BinaryBetStore(self.path)
+
+    def test_export_csv_writes_bets_csv_format(self):
+        csv_path = os.path.join(self.directory.name, 'bets.csv')
+        self.store.store([Bet('1', 'first', 'last', '1', '2000-12-20', 7500)])
+
+        self.assertEqual(1, export_csv(self.store, csv_path))
+        with open(csv_path) as file:
+            self.assertEqual('1,first,last,1,2000-12-20,7500\n', file.read())
+
+
+class TestCsvBetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'bets.csv')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_torn_row_is_dropped_on_open(self):
+        with open(self.path, 'w') as file:
+            file.write('1,first,last,1,2000-12-20,7500\n1,first,la')
+
+        store = CsvBetStore(self.path)
+        store.store([Bet('1', 'first', 'last', '2', '2000-12-20', 7501)])
+        store.close()
+
+        self.assertEqual(['1', '2'], [bet.document for bet in store.load()])
+
+    def test_read_only_store_leaves_a_torn_row(self):
+        with open(self.path, 'w') as file:
+            file.write('1,first,last,1,2000-12-20,7500\n1,first,la')
+
+        CsvBetStore(self.path, read_only=True).close()
+
+        with open(self.path) as file:
+            self.assertEqual('1,first,last,1,2000-12-20,7500\n1,first,la', file.read())
+
+    def test_uploads_can_not_be_resumed(self):
+        self.assertFalse(getattr(CsvBetStore(self.path), 'resumable', False))
+
+
+class TestShardedBetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = ShardedBetStore(self.directory.name)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_each_agency_writes_its_own_segment(self):
+        self.store.writer(2).store([Bet('2', 'first', 'last', '2', '2000-12-20', 2)])
+        self.store.writer(1).store([Bet('1', 'first', 'last', '1', '2000-12-20', 1)])
+
+        self.assertEqual(['agency-1.bin', 'agency-2.bin'], sorted(os.listdir(self.directory.name)))
+        self.assertEqual(['1', '2'], [bet.document for bet in self.store.load()])
+
+    def test_concurrent_writers_keep_every_bet(self):
+        def write(agency):
+            writer = self.store.writer(agency)
+            for number in range(50):
+                writer.store([Bet(str(agency), 'first', 'last', str(number), '2000-12-20', number)])
+
+        writers = [threading.Thread(target=write, args=(agency,)) for agency in range(1, 5)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+
+        self.assertEqual(200, len(self.store.load()))
+
+    def test_next_sequence_of_each_segment(self):
+        self.store.store([Bet('2', 'first', 'last', '1', '2000-12-20', 1)], 7)
+
+        reopened = ShardedBetStore(self.directory.name)
+        try:
+            self.assertEqual(8, reopened.next_sequence(2))
+        finally:
+            reopened.close()
+        self.assertEqual(0, self.store.next_sequence(3))
+
+    def test_read_only_store_opens_segments_as_they_are(self):
+        self.store.writer(1).store([Bet('1', 'first', 'last', '1', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+        segment = os.path.join(self.directory.name, 'agency-1.bin')
+        # What another process may still be appending
+        with open(segment, 'ab') as file:
+            file.write(b'\x01\x00')
+        size = os.path.getsize(segment)
+
+        reader = ShardedBetStore(self.directory.name, read_only=True)
+        reader.close()
+
+        self.assertEqual(size, os.path.getsize(segment))
+
+    def test_read_only_store_creates_nothing(self):
+        path = os.path.join(self.directory.name, 'missing')
+        store = ShardedBetStore(path, read_only=True)
+
+        self.assertEqual(0, len(store.load()))
+        self.assertEqual([], store.partitions(2))
+        store.close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_empty_batches_keep_the_sequence_of_their_writer(self):
+        self.store.writer(2).store([], 3)
+
+        self.assertEqual(4, self.store.next_sequence(2))
+
+    def test_reopened_store_finds_segments_and_reads_them_in_parallel(self):
+        self.store.writer(1).store([Bet('1', 'first', 'last', '1', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+        self.store.writer(2).store([Bet('2', 'first', 'last', '2', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+        self.store.close()
+
+        self.store = ShardedBetStore(self.directory.name, readers=2)
+
+        self.assertEqual([1, 2], [bet.agency for bet in self.store.winners()])
+        self.assertEqual(2, len(self.store.load()))
+
+
+class TestIndexedBetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.directory.name, 'bets.idx')
+        self.store = self._open()
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def _open(self):
+        return IndexedBetStore(ShardedBetStore(os.path.join(self.directory.name, 'bets')), self.index_path)
+
+    def _store_bets(self):
+        self.store.writer(1).store([
+            Bet('1', 'first', 'last', '1', '2000-12-20', LOTTERY_WINNER_NUMBER),
+            Bet('1', 'first', 'last', '2', '2000-12-20', 1),
+        ])
+        self.store.writer(2).store(decode_batch(protocol.SerializeBet(
+            Bet('2', 'first', 'last', '3', '2000-12-20', LOTTERY_WINNER_NUMBER))))
+
+    def test_winners_come_from_the_index(self):
+        self._store_bets()
+
+        self.assertEqual([(1, '1'), (2, '3')], [(bet.agency, bet.document) for bet in self.store.winners()])
+
+    def test_reopened_store_reloads_the_index(self):
+        self._store_bets()
+        self.store.close()
+
+        self.store = self._open()
+
+        self.assertEqual(3, self.store.count())
+        self.assertEqual(['1', '3'], [bet.document for bet in self.store.winners()])
+
+    def test_index_out_of_sync_is_rebuilt_from_the_store(self):
+        self._store_bets()
+        self.store.close()
+        os.remove(self.index_path)
+
+        self.store = self._open()
+
+        self.assertEqual(3, self.store.count())
+        self.assertEqual(['1', '3'], [bet.document for bet in self.store.winners()])
+
+    def test_index_is_read_on_the_first_lookup(self):
+        self._store_bets()
+        self.store.close()
+
+        self.store = self._open()
+        self.assertFalse(self.store._index._loaded)
+        self.store.writer(3).store([Bet('3', 'first', 'last', '4', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+
+        self.assertEqual(4, self.store.count())
+        self.assertEqual(['1', '3', '4'], [bet.document for bet in self.store.winners()])
+
+    def test_torn_index_block_is_dropped_on_open(self):
+        self._store_bets()
+        self.store.close()
+        with open(self.index_path, 'ab') as file:
+            file.write(BetIndex.BLOCK_HEADER.pack(1, 5) + b'torn')
+
+        self.store = self._open()
+        self.store.writer(3).store([Bet('3', 'first', 'last', '4', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+        self.store.close()
+        self.store = self._open()
+
+        self.assertEqual(4, self.store.count())
+        self.assertEqual(['1', '3', '4'], [bet.document for bet in self.store.winners()])
+
+    def test_index_over_a_single_file_store(self):
+        self.store.close()
+        self.store = IndexedBetStore(BinaryBetStore(os.path.join(self.directory.name, 'bets.bin')), self.index_path)
+        self._store_bets()
+        self.store.close()
+        os.remove(self.index_path)
+
+        self.store = IndexedBetStore(BinaryBetStore(os.path.join(self.directory.name, 'bets.bin')), self.index_path)
+
+        self.assertEqual([(1, '1'), (2, '3')], [(bet.agency, bet.document) for bet in self.store.winners()])
+
+    def test_csv_store_can_not_be_indexed(self):
+        with self.assertRaises(ValueError):
+            IndexedBetStore(CsvBetStore(), self.index_path)
+
+    def test_bets_of_a_single_agency_keep_their_sequence(self):
+        self.store.store([Bet('1', 'first', 'last', '1', '2000-12-20', 1), Bet('1', 'first', 'last', '2', '2000-12-20', 2)], 4)
+        self.store.store([Bet('2', 'first', 'last', '3', '2000-12-20', 1), Bet('3', 'first', 'last', '4', '2000-12-20', 2)], 9)
+
+        self.assertEqual(5, self.store.next_sequence(1))
+        # Mixed agencies: no agency owns the sequence number
+        self.assertEqual((0, 0), (self.store.next_sequence(2), self.store.next_sequence(3)))
+
+
+class TestQueryableBetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.index_path = os.path.join(self.directory.name, 'bets.qidx')
+        self.store = self._open()
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def _open(self):
+        return QueryableBetStore(ShardedBetStore(os.path.join(self.directory.name, 'bets')), self.index_path)
+
+    def _store_bets(self, store):
+        store.writer(1).store([
+            Bet('1', 'first', 'last', '1', '2000-12-20', 7),
+            Bet('1', 'first', 'last', '2', '2000-12-20', 8),
+            Bet('1', 'other', 'last', '1', '2000-12-20', 8),
+        ])
+        store.writer(2).store(decode_batch(protocol.SerializeBet(
+            Bet('2', 'first', 'last', '1', '2000-12-20', 7))))
+
+    def _assert_answers(self, store):
+        self.assertEqual(3, count_bets(store, 1))
+        self.assertEqual(1, count_bets(store, 2))
+        self.assertEqual(0, count_bets(store, 3))
+        self.assertEqual([('first', 7), ('other', 8)],
+                         sorted((bet.first_name, bet.number) for bet in bets_with_document(store, 1, '1')))
+        self.assertEqual([(2, '1')], [(bet.agency, bet.document) for bet in bets_with_document(store, 2, '1')])
+        self.assertEqual([], bets_with_document(store, 2, '2'))
+        self.assertEqual(['2', '1'], [bet.document for bet in bets_with_number(store, 1, 8)])
+        self.assertEqual([], bets_with_number(store, 2, 8))
+
+    def test_queries_come_from_the_index(self):
+        self._store_bets(self.store)
+
+        self._assert_answers(self.store)
+
+    def test_stores_without_index_are_scanned(self):
+        store = CsvBetStore(os.path.join(self.directory.name, 'bets.csv'))
+        self._store_bets(store)
+
+        self._assert_answers(store)
+        store.close()
+
+    def test_reopened_store_reloads_the_index(self):
+        self._store_bets(self.store)
+        self.store.close()
+
+        self.store = self._open()
+
+        self.assertEqual(3, self.store.count_bets(1))
+        self.assertFalse(self.store._index._loaded)
+        self._assert_answers(self.store)
+
+    def test_index_out_of_sync_is_rebuilt_from_the_store(self):
+        self._store_bets(self.store)
+        self.store.close()
+        os.remove(self.index_path)
+
+        self.store = self._open()
+
+        self._assert_answers(self.store)
+
+    def test_queries_over_the_winner_index(self):
+        self.store.close()
+        self.store = QueryableBetStore(
+            IndexedBetStore(BinaryBetStore(os.path.join(self.directory.name, 'bets.bin')),
+                            os.path.join(self.directory.name, 'bets.idx')),
+            self.index_path)
+        self._store_bets(self.store)
+
+        self._assert_answers(self.store)
+        self.assertEqual([(1, '1'), (2, '1')], [(bet.agency, bet.document) for bet in self.store.winners(7)])
+        self.assertFalse(hasattr(self.store, 'partitions'))
+
+    def test_csv_store_can_not_be_indexed(self):
+        with self.assertRaises(ValueError):
+            QueryableBetStore(CsvBetStore(), self.index_path)
+
+    def test_bets_of_a_single_agency_keep_their_sequence(self):
+        self.store.store([Bet('1', 'first', 'last', '1', '2000-12-20', 1), Bet('1', 'first', 'last', '2', '2000-12-20', 2)], 4)
+        self.store.store([Bet('2', 'first', 'last', '3', '2000-12-20', 1), Bet('3', 'first', 'last', '4', '2000-12-20', 2)], 9)
+
+        self.assertEqual(5, self.store.next_sequence(1))
+        # Mixed agencies: no agency owns the sequence number
+        self.assertEqual((0, 0), (self.store.next_sequence(2), self.store.next_sequence(3)))
+
+
+class TestDraw(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.previous_directory = os.getcwd()
+        os.chdir(self.directory.name)
+        # The ones _fill filled, closed on tearDown
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        os.chdir(self.previous_directory)
+        self.directory.cleanup()
+
+    def _fill(self, store):
+        self.stores.append(store)
+        for agency in range(1, 4):
+            store.writer(agency).store([
+                Bet(str(agency), 'first', 'last', f'{agency}{number}', '2000-12-20',
+                    LOTTERY_WINNER_NUMBER if number % 7 == 0 else number)
+                for number in range(50)
+            ])
+        return store
+
+    def _assert_partitions_find_every_winner(self, store):
+        expected = [(bet.agency, bet.document) for bet in store.winners()]
+
+        for amount in (1, 2, 5):
+            winners = []
+            for partition in store.partitions(amount):
+                winners += [(bet.agency, bet.document) for bet in winners_in_partition(partition)]
+            self.assertEqual(expected, winners)
+        self.assertEqual(24, len(expected))
+
+    def test_csv_partitions_find_every_winner(self):
+        self._assert_partitions_find_every_winner(self._fill(CsvBetStore()))
+
+    def test_binary_partitions_find_every_winner(self):
+        self._assert_partitions_find_every_winner(self._fill(BinaryBetStore()))
+
+    def test_sharded_partitions_find_every_winner(self):
+        self._assert_partitions_find_every_winner(self._fill(ShardedBetStore()))
+
+    def test_parallel_draw_matches_store_winners(self):
+        store = self._fill(BinaryBetStore())
+
+        winners = draw(store, workers=2)
+
+        self.assertEqual([(bet.agency, bet.document) for bet in store.winners()],
+                         [(bet.agency, bet.document) for bet in winners])
+
+    def test_draw_with_another_winner_number(self):
+        store = self._fill(BinaryBetStore())
+
+        winners = draw(store, workers=2, winner_number=3)
+
+        self.assertEqual([(1, '13'), (2, '23'), (3, '33')], [(bet.agency, bet.document) for bet in winners])
+
+
+class TestRoundedBetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_directory = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.previous_directory)
+        self.directory.cleanup()
+
+    def test_round_path_keeps_the_first_round_in_place(self):
+        self.assertEqual('./bets.csv', round_path('./bets.csv', 1))
+        self.assertEqual('./bets.round-2.csv', round_path('./bets.csv', 2))
+        self.assertEqual('./bets.round-3', round_path('./bets', 3))
+
+    def test_every_round_only_sees_its_bets(self):
+        store = RoundedBetStore(lambda round_id: create_store("sharded", round_id=round_id))
+        store.writer(1).store([Bet('1', 'first', 'last', '1', '2000-12-20', LOTTERY_WINNER_NUMBER)])
+
+        store.start_round(2)
+        store.writer(1).store([Bet('1', 'first', 'last', '2', '2000-12-20', 5)] * 2)
+
+        self.assertEqual(2, store.round_id)
+        self.assertEqual(['2', '2'], [bet.document for bet in store.winners(5)])
+        self.assertEqual(0, len(store.winners()))
+        store.close()
+        first_round = ShardedBetStore(round_path(SHARDED_STORAGE_DIRPATH, 1))
+        try:
+            self.assertEqual(1, len(first_round.load()))
+        finally:
+            first_round.close()
+
+
+class TestMergedBetStore(unittest.TestCase):
+
+    def setUp(self):
+        self.previous_directory = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+
+    def tearDown(self):
+        os.chdir(self.previous_directory)
+        self.directory.cleanup()
+
+    def test_worker_path_keeps_the_first_worker_in_place(self):
+        self.assertEqual('./bets.csv', worker_path('./bets.csv', 0))
+        self.assertEqual('./bets.worker-1.csv', worker_path('./bets.csv', 1))
+        self.assertEqual('./bets.worker-2.round-2.bin', round_path(worker_path('./bets.bin', 2), 2))
+
+    def test_every_worker_store_is_drawn(self):
+        for worker in range(2):
+            store = create_store("binary", worker=worker)
+            store.writer(worker).store([Bet(str(worker), 'first', 'last', f'{worker}{i}', '2000-12-20',
+                                            LOTTERY_WINNER_NUMBER if i % 2 else i) for i in range(10)])
+            store.close()
+
+        merged = MergedBetStore([create_store("binary", worker=worker) for worker in range(2)])
+
+        self.assertEqual(20, len(merged.load()))
+        expected = [(bet.agency, bet.document) for bet in merged.winners()]
+        self.assertEqual(10, len(expected))
+        self.assertEqual(expected, [(bet.agency, bet.document) for bet in draw(merged, workers=3)])
+        merged.close()
+
+    def test_indexed_stores_are_not_partitioned(self):
+        merged = MergedBetStore([CsvBetStore(), IndexedBetStore(ShardedBetStore())])
+
+        self.assertFalse(hasattr(merged, 'partitions'))
+        merged.close()
+
+
+class SyncCountingStore(BinaryBetStore):
+    """ Counts the syncs, which wait for `synced` to be set """
+    def __init__(self, path):
+        super().__init__(path)
+        self.syncs = 0
+        self.synced = threading.Event()
+        self.synced.set()
+
+    def sync(self):
+        self.synced.wait()
+        self.syncs += 1
+        super().sync()
+
+
+class TestWriteBehindStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.wrapped = SyncCountingStore(os.path.join(self.directory.name, 'bets.bin'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_concurrent_batches_share_group_commits(self):
+        store = WriteBehindStore(self.wrapped, queue_size=4, commit_interval=0.05)
+
+        def agency(agency_id):
+            writer = store.writer(agency_id)
+            for i in range(20):
+                writer.store(decode_batch(protocol.SerializeBet(Bet(str(agency_id), 'first', 'last', str(i), '2000-12-20', i))))
+            writer.close()
+
+        agencies = [threading.Thread(target=agency, args=(agency_id,)) for agency_id in range(1, 9)]
+        for thread in agencies:
+            thread.start()
+        for thread in agencies:
+            thread.join()
+
+        self.assertEqual(8 * 20, len(store.load()))
+        self.assertLess(self.wrapped.syncs, 8 * 20)
+        store.close()
+
+    def test_batches_are_done_once_synced(self):
+        store = WriteBehindStore(self.wrapped, commit_interval=0)
+        self.wrapped.synced.clear()
+
+        stored = store.writer(1).submit([Bet('1', 'first', 'last', '1', '2000-12-20', 1)])
+
+        self.assertFalse(stored.done())
+        self.wrapped.synced.set()
+        stored.result(timeout=5)
+        store.close()
+
+    def test_full_group_is_committed_without_waiting(self):
+        store = WriteBehindStore(self.wrapped, commit_interval=60, commit_bytes=1)
+
+        store.store([Bet('1', 'first', 'last', '1', '2000-12-20', 1)])
+
+        self.assertEqual(1, self.wrapped.syncs)
+        store.close()
+
+    def test_failed_batch_does_not_fail_its_group(self):
+        store = WriteBehindStore(self.wrapped)
+
+        with self.assertRaises(AttributeError):
+            store.store([None])
+        store.store([Bet('1', 'first', 'last', '1', '2000-12-20', 1)])
+
+        self.assertEqual(1, len(store.load()))
+        store.close()
+
+    def test_next_sequence_waits_for_queued_batches(self):
+        store = WriteBehindStore(self.wrapped, commit_interval=60)
+
+        store.writer(1).submit([Bet('1', 'first', 'last', '1', '2000-12-20', 1)], 4)
+
+        self.assertEqual(5, store.next_sequence(1))
+        self.assertEqual(1, self.wrapped.syncs)
+        store.close()
+
+    def test_close_commits_pending_batches(self):
+        store = WriteBehindStore(self.wrapped, commit_interval=60)
+
+        stored = store.writer(1).submit([Bet('1', 'first', 'last', '1', '2000-12-20', 1)])
+        store.close()
+
+        self.assertTrue(stored.done())
+        self.assertEqual(1, self.wrapped.syncs)
+        self.assertEqual(1, len(BinaryBetStore(self.wrapped.path, read_only=True).load()))
+
+
+def stored_fields(bet):
+    return (getattr(bet, field) for field in Bet.__slots__)
+
+
+if __name__ == '__main__':
+    unittest.main()